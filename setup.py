@@ -5,7 +5,7 @@ setup(
     # Basic package information:
     name = 'zero-users',
     version = '0.1.5',
-    packages = ['users'],
+    packages = find_packages(),
     
     # Packaging options:
     zip_safe = False,
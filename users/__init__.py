@@ -19,6 +19,3 @@ __email__ = 'contact@josezambrana.com'
 __version__ = '0.1'
 __copyright__ = 'Copyright 2012, Mandla Web Studio'
 
-
-# Signals
-from users.listeners import create_profile
@@ -21,8 +21,11 @@ __copyright__ = 'Copyright 2012, Mandla Web Studio'
 
 
 from django.contrib import admin
+from django.utils.translation import ugettext_lazy as _
 
 from users.models import Profile
+from users.bulkmail import send_password_instructions
+from users.sites import get_current_site
 
 
 class ProfileAdmin(admin.ModelAdmin):
@@ -32,6 +35,7 @@ class ProfileAdmin(admin.ModelAdmin):
 
     list_display = ('user', )
     readonly_fields = ('extras', )
+    actions = ['send_password_reset']
     
     def has_add_permission(self, request):
         """
@@ -40,5 +44,21 @@ class ProfileAdmin(admin.ModelAdmin):
         """
         return False
 
+    def send_password_reset(self, request, queryset):
+        """
+        Envía las instrucciones para cambiar la contraseña a los usuarios de
+        los perfiles seleccionados.
+        """
+
+        users = [profile.user for profile in queryset.select_related('user')
+                              if profile.user.email]
+        stats = send_password_instructions(users, get_current_site(request),
+                                           use_https=request.is_secure())
+
+        self.message_user(request, _(u'%(sent)s emails enviados, %(failed)s '
+                                     u'fallidos en %(elapsed).2fs.') % stats)
+    send_password_reset.short_description = _(u'Enviar instrucciones para '
+                                              u'cambiar la contraseña')
+
 admin.site.register(Profile, ProfileAdmin)
 
@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Mandla Web Studio
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+__author__ = 'Jose Maria Zambrana Arze'
+__email__ = 'contact@josezambrana.com'
+__version__ = '0.1'
+__copyright__ = 'Copyright 2012, Mandla Web Studio'
+
+
+import os
+import math
+import struct
+import hashlib
+import logging
+import threading
+
+from time import time
+from datetime import datetime
+
+from django.conf import settings
+from django.db import connection
+from django.contrib.auth.models import User
+
+from users.managers import QUERY_CHUNK_SIZE
+from users.utils import normalize_email
+
+
+#: Número de elementos para el que se dimensiona el filtro.
+AVAILABILITY_CAPACITY = getattr(settings, 'USERS_AVAILABILITY_CAPACITY', 1000000)
+
+#: Probabilidad de falsos positivos con el filtro lleno.
+AVAILABILITY_ERROR_RATE = getattr(settings, 'USERS_AVAILABILITY_ERROR_RATE', 0.01)
+
+#: Archivo donde se guarda la copia del filtro. Si es None no se guarda.
+AVAILABILITY_SNAPSHOT = getattr(settings, 'USERS_AVAILABILITY_SNAPSHOT', None)
+
+#: Segundos entre cada actualización del filtro con los usuarios nuevos.
+AVAILABILITY_REFRESH = getattr(settings, 'USERS_AVAILABILITY_REFRESH', 60)
+
+#: Segundos que se vuelven a revisar en cada actualización, por las
+#: diferencias de reloj y las transacciones que terminan tarde.
+AVAILABILITY_OVERLAP = getattr(settings, 'USERS_AVAILABILITY_OVERLAP', 300)
+
+#: Si es verdadero el filtro sin copia en disco se construye en un hilo y
+#: mientras tanto las consultas van a la base de datos.
+AVAILABILITY_BACKGROUND = getattr(settings, 'USERS_AVAILABILITY_BACKGROUND', True)
+
+
+class BloomFilter(object):
+    """
+    Filtro de Bloom: responde si un elemento definitivamente no está en el
+    conjunto o si posiblemente está, con una probabilidad *error_rate* de
+    falsos positivos para *capacity* elementos.
+    """
+
+    #: Identificador del formato de las copias en disco.
+    magic = 'UBF2'
+
+    header = struct.Struct('!4sQIQQ')
+
+    def __init__(self, capacity=AVAILABILITY_CAPACITY,
+                       error_rate=AVAILABILITY_ERROR_RATE,
+                       size=None, hashes=None):
+        if size is None:
+            size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        if hashes is None:
+            hashes = max(1, int(round(float(size) / capacity * math.log(2))))
+
+        self.size = size
+        self.hashes = hashes
+        self.count = 0
+        self.bits = bytearray((size + 7) // 8)
+
+    def positions(self, item):
+        """
+        Retorna las posiciones de los bits de *item* con doble hashing.
+        """
+
+        if isinstance(item, unicode):
+            item = item.encode('utf-8')
+
+        digest = hashlib.md5(item).digest()
+        h1, h2 = struct.unpack('!QQ', digest)
+
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        for position in self.positions(item):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def dumps(self, watermark=0):
+        """
+        Retorna el filtro serializado junto con *watermark*, la fecha (en
+        segundos) desde la que se deben buscar los perfiles modificados.
+        """
+
+        header = self.header.pack(self.magic, self.size, self.hashes,
+                                  self.count, watermark)
+        return header + str(self.bits)
+
+    @classmethod
+    def loads(cls, data):
+        """
+        Retorna el filtro y el watermark serializados en *data*.
+        """
+
+        magic, size, hashes, count, watermark = cls.header.unpack(data[:cls.header.size])
+        bits = bytearray(data[cls.header.size:])
+
+        if magic != cls.magic or len(bits) != (size + 7) // 8:
+            raise ValueError('Invalid bloom filter snapshot')
+
+        bloom = cls(size=size, hashes=hashes)
+        bloom.count = count
+        bloom.bits = bits
+        return bloom, watermark
+
+
+def username_key(username):
+    return u'u:%s' % username.lower()
+
+
+def email_key(email):
+    return u'e:%s' % normalize_email(email)
+
+
+def add_to_bloom(bloom, username=None, email=None):
+    """
+    Agrega a *bloom* el nombre de usuario y el email.
+    """
+
+    if username:
+        bloom.add(username_key(username))
+    if normalize_email(email):
+        bloom.add(email_key(email))
+
+
+class AvailabilityIndex(object):
+    """
+    Índice en memoria de los nombres de usuario y emails normalizados en uso.
+    Responde sin consultar la base de datos cuando un valor definitivamente
+    está libre y solo ante un posible uso se verifica en la base de datos.
+
+    El filtro se carga de la copia en disco o, si no existe, se construye
+    recorriendo todos los usuarios en un hilo aparte; mientras tanto todas
+    las consultas van a la base de datos. Después se actualiza con la señal
+    post_save de User y cada *refresh* segundos con los perfiles modificados
+    por otros procesos (usuarios nuevos, cambios de nombre de usuario o de
+    email) según su fecha de modificación. Los valores liberados no se
+    eliminan del filtro (solo producen consultas de más) hasta reconstruirlo
+    con el comando users_availability_snapshot.
+    """
+
+    def __init__(self, snapshot=AVAILABILITY_SNAPSHOT, refresh=AVAILABILITY_REFRESH,
+                       background=AVAILABILITY_BACKGROUND):
+        self.snapshot = snapshot
+        self.refresh = refresh
+        self.background = background
+        self.bloom = None
+        self.watermark = 0
+        self.refreshed_at = 0
+        self._lock = threading.RLock()
+        self._loader = None
+
+    @property
+    def loaded(self):
+        return self.bloom is not None
+
+    def has_snapshot(self):
+        return bool(self.snapshot) and os.path.exists(self.snapshot)
+
+    def read_snapshot(self):
+        """
+        Retorna el filtro y el watermark de la copia en disco, o (None, 0) si
+        no hay una copia válida.
+        """
+
+        if not self.has_snapshot():
+            return None, 0
+
+        try:
+            with open(self.snapshot, 'rb') as f:
+                return BloomFilter.loads(f.read())
+        except (IOError, ValueError, struct.error), e:
+            logging.warning('users: invalid availability snapshot: %s' % e)
+            return None, 0
+
+    def build(self):
+        """
+        Retorna un filtro nuevo con todos los usuarios y el watermark desde
+        el que se deben agregar los perfiles modificados. No bloquea el
+        índice mientras recorre los usuarios.
+        """
+
+        watermark = int(time()) - AVAILABILITY_OVERLAP
+        bloom = BloomFilter()
+
+        users = User.objects.order_by('id').values_list('id', 'username', 'email')
+
+        last_id = 0
+        while True:
+            chunk = list(users.filter(id__gt=last_id)[:QUERY_CHUNK_SIZE])
+            if not chunk:
+                break
+
+            for user_id, username, email in chunk:
+                add_to_bloom(bloom, username, email)
+
+            last_id = chunk[-1][0]
+
+        return bloom, watermark
+
+    def load(self):
+        """
+        Carga el filtro de la copia en disco o lo construye desde cero.
+        """
+
+        bloom, watermark = self.read_snapshot()
+        if bloom is None:
+            bloom, watermark = self.build()
+
+        with self._lock:
+            self.bloom = bloom
+            self.watermark = watermark
+            self.catch_up()
+
+    def _load_in_background(self):
+        try:
+            self.load()
+        except Exception, e:
+            logging.error('users: availability filter not loaded: %s' % e)
+        finally:
+            # Cada hilo tiene su propia conexión a la base de datos.
+            connection.close()
+
+    def start_loading(self):
+        """
+        Construye el filtro en un hilo aparte si aún no se está construyendo.
+        """
+
+        with self._lock:
+            if self._loader is not None and self._loader.is_alive():
+                return
+
+            self._loader = threading.Thread(target=self._load_in_background,
+                                            name='users-availability')
+            self._loader.daemon = True
+            self._loader.start()
+
+    def catch_up(self):
+        """
+        Agrega al filtro los nombres de usuario y emails de los perfiles
+        modificados desde el watermark.
+        """
+
+        from users.models import Profile
+
+        with self._lock:
+            watermark = int(time()) - AVAILABILITY_OVERLAP
+
+            since = datetime.fromtimestamp(self.watermark)
+            profiles = Profile.objects.filter(updated_at__gte=since)
+            profiles = profiles.order_by('id').values_list('id', 'username',
+                                                           'email_normalized')
+
+            last_id = 0
+            while True:
+                chunk = list(profiles.filter(id__gt=last_id)[:QUERY_CHUNK_SIZE])
+                if not chunk:
+                    break
+
+                for profile_id, username, email in chunk:
+                    self.add(username, email)
+
+                last_id = chunk[-1][0]
+
+            self.watermark = max(self.watermark, watermark)
+            self.refreshed_at = time()
+
+    def ensure_loaded(self):
+        """
+        Retorna verdadero si el filtro está listo para usarse. Sin copia en
+        disco y con *background* el filtro se empieza a construir en un hilo
+        y se retorna falso hasta que termine.
+        """
+
+        if self.bloom is None:
+            if self.background and not self.has_snapshot():
+                self.start_loading()
+                return False
+            self.load()
+        elif time() - self.refreshed_at > self.refresh:
+            self.catch_up()
+
+        return True
+
+    def add(self, username=None, email=None):
+        """
+        Agrega al filtro el nombre de usuario y el email.
+        """
+
+        with self._lock:
+            if self.bloom is None:
+                return
+
+            add_to_bloom(self.bloom, username, email)
+
+    def save(self, path=None):
+        """
+        Guarda el filtro en disco de forma atómica.
+        """
+
+        path = path or self.snapshot
+        if self.bloom is None:
+            self.load()
+
+        with self._lock:
+            data = self.bloom.dumps(self.watermark)
+
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+
+    def reset(self):
+        """
+        Descarta el filtro en memoria, se vuelve a cargar en el siguiente uso.
+        """
+
+        with self._lock:
+            self.bloom = None
+            self.watermark = 0
+
+    def username_available(self, username):
+        """
+        Retorna verdadero si nadie usa el nombre de usuario *username*.
+        """
+
+        if self.ensure_loaded() and username_key(username) not in self.bloom:
+            return True
+
+        return not User.objects.filter(username=username).exists()
+
+    def email_available(self, email):
+        """
+        Retorna verdadero si nadie usa el email *email*.
+        """
+
+        from users.models import Profile
+
+        if self.ensure_loaded() and email_key(email) not in self.bloom:
+            return True
+
+        return not Profile.objects.email_taken(email)
+
+
+#: Índice de disponibilidad utilizado por la vista users_availability.
+availability_index = AvailabilityIndex()
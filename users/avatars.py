@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Mandla Web Studio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+__author__ = 'Jose Maria Zambrana Arze'
+__email__ = 'contact@josezambrana.com'
+__version__ = '0.1'
+__copyright__ = 'Copyright 2012, Mandla Web Studio'
+
+
+import hashlib
+import logging
+
+from datetime import datetime
+
+from users.models import Profile
+from users.cache import actors_cache
+
+
+#: Urls de los avatares por defecto por cada tamaño, se calculan una sola vez.
+_default_avatars = {}
+
+
+def default_avatar_url(size):
+    """
+    Retorna la url del avatar por defecto del tamaño *size*.
+    """
+
+    if size not in _default_avatars:
+        _default_avatars[size] = Profile().default_thumbnail(size)
+
+    return _default_avatars[size]
+
+
+def avatar_url(profile, size='s'):
+    """
+    Retorna la url del avatar de *profile* sin verificar en el storage si el
+    thumbnail existe: si el perfil tiene una imagen se asume que sus
+    thumbnails existen una vez publicados. Mientras se generan se usa la
+    imagen original.
+    """
+
+    if size not in Profile.sizes:
+        raise ValueError('%s is not a valid size' % size)
+
+    if profile is None or not profile.image:
+        return default_avatar_url(size)
+
+    if not profile.thumbnails_ready:
+        return profile.image.url
+
+    return profile.image.storage.url(profile.thumbnail_name(size))
+
+
+def avatar_digest(data):
+    """
+    Retorna el hash con el que se nombran los thumbnails de la imagen *data*.
+    Incluye los tamaños y métodos de los thumbnails, así al cambiarlos los
+    nuevos thumbnails tienen otros nombres.
+    """
+
+    signature = sorted((size, Profile.sizes[size], Profile.methods[size].__name__)
+                       for size in Profile.sizes)
+
+    digest = hashlib.md5(data)
+    digest.update(repr(signature))
+    return digest.hexdigest()[:16]
+
+
+def delete_thumbnails(profile, version):
+    """
+    Elimina del storage los thumbnails de la versión *version* del perfil,
+    nombrados con el nombre de usuario. Los thumbnails con hash pueden
+    compartirse entre perfiles y seguir en páginas guardadas en los caches,
+    los elimina el comando users_gc_avatars.
+    """
+
+    storage = profile.image.storage
+
+    for size in profile.sizes:
+        name = profile.thumbnail_name(size, version=version, avatar_hash='')
+        if storage.exists(name):
+            storage.delete(name)
+
+
+def publish_thumbnails(job):
+    """
+    Genera los thumbnails de la imagen del trabajo *job* en una nueva versión
+    y la publica de forma atómica: el perfil pasa de la versión anterior a la
+    nueva con una sola actualización condicionada, y solo entonces se eliminan
+    los thumbnails anteriores con el nombre de usuario. Si mientras tanto el
+    usuario subió otra imagen los thumbnails generados no se publican.
+
+    Los thumbnails se nombran con el hash de su contenido, así sus urls
+    nunca cambian de contenido y se pueden guardar indefinidamente en los
+    caches. La nueva versión es el id del trabajo y solo sirve para
+    condicionar la publicación.
+    """
+
+    profile = Profile.objects.select_related('user').get(pk=job.profile_id)
+
+    if profile.image.name != job.source:
+        logging.info('thumbnails: image of profile %s was replaced' % profile.pk)
+        return
+
+    old_version = profile.thumbnails_version
+    old_hash = profile.avatar_hash
+    new_version = job.pk
+
+    if old_version == new_version:
+        return
+
+    source = profile.image.storage.open(job.source, 'rb')
+    try:
+        data = source.read()
+    finally:
+        source.close()
+
+    profile.thumbnails_version = new_version
+    profile.avatar_hash = avatar_digest(data)
+    profile.create_thumbnails(data)
+
+    updated = Profile.objects.filter(pk=profile.pk, image=job.source,
+                                     thumbnails_version=old_version)
+    updated = updated.update(thumbnails_version=new_version,
+                             avatar_hash=profile.avatar_hash,
+                             thumbnails_ready=True,
+                             updated_at=datetime.now())
+
+    if updated:
+        if not old_hash:
+            delete_thumbnails(profile, old_version)
+        actors_cache.invalidate([profile.user_id])
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Mandla Web Studio
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+__author__ = 'Jose Maria Zambrana Arze'
+__email__ = 'contact@josezambrana.com'
+__version__ = '0.1'
+__copyright__ = 'Copyright 2012, Mandla Web Studio'
+
+
+import os
+import logging
+
+from datetime import datetime
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+
+from users.models import Profile
+from users.cache import actors_cache
+
+
+#: Tamaño máximo (ancho, alto) de las imágenes de fondo optimizadas.
+BACKGROUND_MAX_SIZE = getattr(settings, 'USERS_BACKGROUND_MAX_SIZE', (1920, 1920))
+
+#: Anchos de las variantes reducidas de las imágenes de fondo.
+BACKGROUND_WIDTHS = getattr(settings, 'USERS_BACKGROUND_WIDTHS', (640, 1024, 1440))
+
+#: Calidad de compresión de las imágenes de fondo.
+BACKGROUND_QUALITY = getattr(settings, 'USERS_BACKGROUND_QUALITY', 82)
+
+#: Si se generan también variantes en formato WebP, cuando PIL lo soporta.
+BACKGROUND_WEBP = getattr(settings, 'USERS_BACKGROUND_WEBP', False)
+
+#: Extensión de los archivos de cada formato.
+EXTENSIONS = {
+    'JPEG': 'jpg',
+    'WEBP': 'webp',
+}
+
+
+def background_formats():
+    """
+    Retorna los formatos en los que se generan las variantes.
+    """
+
+    from users.images import webp_supported
+
+    if BACKGROUND_WEBP and webp_supported():
+        return ('JPEG', 'WEBP')
+
+    return ('JPEG', )
+
+
+def background_name(profile_id, version, width=None, format='JPEG'):
+    """
+    Retorna el nombre en el storage de la imagen de fondo optimizada del
+    perfil *profile_id* en la versión *version*, o de su variante de ancho
+    *width* en el formato *format*.
+    """
+
+    if width is None:
+        name = '%s_%s.jpg' % (profile_id, version)
+    else:
+        name = '%s_%s_%s.%s' % (profile_id, version, width, EXTENSIONS[format])
+
+    return os.path.join('backgrounds', name)
+
+
+def is_optimized(profile):
+    """
+    Retorna verdadero si la imagen de fondo de *profile* es la versión
+    optimizada y no una imagen recién subida.
+    """
+
+    return bool(profile.background_version) and \
+           profile.background.name == background_name(profile.pk,
+                                                      profile.background_version)
+
+
+def background_variants(profile, format='JPEG'):
+    """
+    Retorna una lista de tuplas ``(<ancho>, <url>)`` con las variantes de la
+    imagen de fondo de *profile* en el formato *format*, de menor a mayor e
+    incluyendo la imagen completa, sin consultar al storage. Mientras la
+    imagen no se optimiza solo está la original, sin ancho conocido.
+    """
+
+    background = profile.background
+    if not background:
+        return []
+
+    if format != 'JPEG':
+        if not is_optimized(profile) or format not in background_formats():
+            return []
+    elif not is_optimized(profile):
+        return [(None, background.url)]
+
+    storage = background.storage
+    width = profile.background_width
+
+    variants = [(variant_width, storage.url(background_name(profile.pk,
+                                                            profile.background_version,
+                                                            variant_width, format)))
+                for variant_width in sorted(BACKGROUND_WIDTHS)
+                if variant_width < width]
+
+    if format == 'JPEG':
+        variants.append((width, background.url))
+    else:
+        variants.append((width, storage.url(background_name(profile.pk,
+                                                            profile.background_version,
+                                                            width, format))))
+
+    return variants
+
+
+def background_srcset(profile, format='JPEG'):
+    """
+    Retorna el valor del atributo srcset con las variantes de la imagen de
+    fondo de *profile*.
+    """
+
+    return ', '.join('%s %sw' % (url, width) if width else url
+                     for width, url in background_variants(profile, format))
+
+
+def delete_backgrounds(storage, profile_id, version, widths):
+    """
+    Elimina del storage la imagen optimizada y las variantes de la versión
+    *version* del perfil *profile_id*.
+    """
+
+    names = [background_name(profile_id, version)]
+    for width in widths:
+        for format in EXTENSIONS:
+            names.append(background_name(profile_id, version, width, format))
+
+    for name in names:
+        if storage.exists(name):
+            storage.delete(name)
+
+
+def publish_backgrounds(job):
+    """
+    Optimiza la imagen de fondo del trabajo *job*, genera sus variantes en
+    una nueva versión y la publica de forma atómica igual que los
+    thumbnails de los avatares: el perfil pasa a la nueva versión con una
+    sola actualización condicionada y solo entonces se eliminan la imagen
+    subida y la versión anterior. La hoja de estilo del diseño se vuelve a
+    compilar con las nuevas urls y los colores guardados en ese momento.
+    """
+
+    from users.images import render_backgrounds
+    from users.themes import recompile_theme
+
+    profile = Profile.objects.get(pk=job.profile_id)
+
+    if profile.background.name != job.source:
+        logging.info('backgrounds: background of profile %s was replaced' % profile.pk)
+        return
+
+    old_version = profile.background_version
+    old_width = profile.background_width
+    new_version = job.pk
+
+    if old_version == new_version:
+        return
+
+    storage = profile.background.storage
+    source = storage.open(job.source, 'rb')
+    try:
+        data = source.read()
+    finally:
+        source.close()
+
+    width, master, variants = render_backgrounds(data, BACKGROUND_MAX_SIZE,
+                                                 BACKGROUND_WIDTHS,
+                                                 background_formats(),
+                                                 BACKGROUND_QUALITY)
+
+    name = background_name(profile.pk, new_version)
+    contents = [(name, master)]
+    for (variant_width, format), content in variants.items():
+        contents.append((background_name(profile.pk, new_version, variant_width,
+                                         format), content))
+
+    for file_name, content in contents:
+        if storage.exists(file_name):
+            storage.delete(file_name)
+        storage.save(file_name, ContentFile(content))
+
+    updated = Profile.objects.filter(pk=profile.pk, background=job.source,
+                                     background_version=old_version)
+    updated = updated.update(background=name,
+                             background_version=new_version,
+                             background_width=width,
+                             updated_at=datetime.now())
+
+    widths = list(BACKGROUND_WIDTHS) + [old_width, width]
+
+    if updated:
+        # Los colores se leen de nuevo: pudieron cambiar durante la
+        # optimización y su hoja de estilo no se debe pisar.
+        recompile_theme(profile.pk)
+        delete_backgrounds(storage, profile.pk, old_version, widths)
+        if job.source != name and storage.exists(job.source):
+            storage.delete(job.source)
+        actors_cache.invalidate([profile.user_id])
+    else:
+        delete_backgrounds(storage, profile.pk, new_version, widths)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Mandla Web Studio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+__author__ = 'Jose Maria Zambrana Arze'
+__email__ = 'contact@josezambrana.com'
+__version__ = '0.1'
+__copyright__ = 'Copyright 2012, Mandla Web Studio'
+
+
+import logging
+
+from time import time
+
+from django.conf import settings
+from django.template import Context
+from django.template.loader import get_template
+from django.core.mail import get_connection
+from django.core.mail import EmailMultiAlternatives
+from django.core.exceptions import ImproperlyConfigured
+from django.contrib.auth.tokens import default_token_generator
+from django.utils.http import int_to_base36
+from django.utils.translation import ugettext as _
+
+
+class BulkMailer(object):
+    """
+    Envía el mismo email a muchos destinatarios: los templates se compilan una
+    sola vez, cada mensaje solo renderiza su propio contexto y todos se envían
+    por la misma conexión SMTP.
+    """
+
+    def __init__(self, subject, plain_template, html_template, **kwargs):
+        from common.context_processors import basic
+
+        self.subject = subject
+        self.plain_template = get_template(plain_template)
+        self.html_template = get_template(html_template)
+
+        # Contexto común a todos los mensajes.
+        self.context = dict(basic())
+        self.context['STATIC_URL'] = settings.STATIC_URL
+        self.context.update(kwargs)
+
+    def render(self, **kwargs):
+        """
+        Retorna el texto plano y el html del mensaje con el contexto *kwargs*.
+        """
+
+        context = Context(self.context)
+        context.update(kwargs)
+
+        return (self.plain_template.render(context),
+                self.html_template.render(context))
+
+    def send(self, recipients, from_email=None, connection=None):
+        """
+        Envía un mensaje por cada par ``(<email>, <contexto>)`` de
+        *recipients*. Retorna las estadísticas del envío: mensajes enviados,
+        fallidos, tiempo total, mensajes por segundo y los tiempos de
+        renderizado y envío de cada mensaje en milisegundos.
+        """
+
+        from common.mail import SITE_FROM_EMAIL
+
+        from_email = from_email or SITE_FROM_EMAIL
+        if from_email is None:
+            raise ImproperlyConfigured(u'Se necesita definir una dirección de '
+                                       u'email del sitio.')
+
+        stats = {
+            'sent': 0,
+            'failed': 0,
+            'timings': [],
+        }
+
+        initial = time()
+        connection = connection or get_connection()
+        connection.open()
+
+        try:
+            for email, context in recipients:
+                started = time()
+                message, html_message = self.render(**context)
+                rendered = time()
+
+                mail = EmailMultiAlternatives(self.subject, message, from_email,
+                                              [email], connection=connection)
+                mail.attach_alternative(html_message, 'text/html')
+
+                try:
+                    mail.send()
+                    stats['sent'] += 1
+                except Exception, e:
+                    logging.error('ERROR: bulk mail to %s: %s' % (email, e))
+                    stats['failed'] += 1
+
+                sent = time()
+                stats['timings'].append((email, (rendered - started) * 1000,
+                                                (sent - rendered) * 1000))
+        finally:
+            connection.close()
+
+        stats['elapsed'] = time() - initial
+        total = stats['sent'] + stats['failed']
+        stats['throughput'] = total / stats['elapsed'] if stats['elapsed'] else 0.0
+
+        logging.info('bulk mail "%s": %s sent, %s failed, %.2fs, %.1f msg/s' % (
+                     self.subject, stats['sent'], stats['failed'],
+                     stats['elapsed'], stats['throughput']))
+
+        return stats
+
+
+def send_password_instructions(users, site, use_https=False,
+                               token_generator=default_token_generator,
+                               from_email=None):
+    """
+    Envía las instrucciones para cambiar la contraseña a todos los *users*
+    usando una sola conexión. Retorna las estadísticas del envío.
+    """
+
+    subject = _("Password reset on %s") % site.name
+    mailer = BulkMailer(subject, 'mail.password_instructions.txt',
+                                 'mail.password_instructions.html',
+                                 domain=site.domain,
+                                 site_name=site.name,
+                                 protocol=use_https and 'https' or 'http')
+
+    recipients = []
+    for user in users:
+        context = {
+            'email': user.email,
+            'uid': int_to_base36(user.id),
+            'user': user,
+            'token': token_generator.make_token(user),
+        }
+        recipients.append((user.email, context))
+
+    return mailer.send(recipients, from_email)
@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Mandla Web Studio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+__author__ = 'Jose Maria Zambrana Arze'
+__email__ = 'contact@josezambrana.com'
+__version__ = '0.1'
+__copyright__ = 'Copyright 2012, Mandla Web Studio'
+
+
+import logging
+import hashlib
+import threading
+
+from time import time
+from collections import OrderedDict, deque
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+
+#: Alias del cache compartido (settings.CACHES) para los actores. Si es None
+#: se utiliza un LRU en memoria del proceso, que no ve las invalidaciones de
+#: los demás procesos hasta que expiran sus entradas (ACTORS_CACHE_TIMEOUT).
+ACTORS_CACHE_BACKEND = getattr(settings, 'USERS_ACTORS_CACHE_BACKEND', None)
+
+#: Número máximo de actores en el LRU en memoria.
+ACTORS_CACHE_SIZE = getattr(settings, 'USERS_ACTORS_CACHE_SIZE', 2048)
+
+#: Tiempo de vida en segundos de un actor en el cache.
+ACTORS_CACHE_TIMEOUT = getattr(settings, 'USERS_ACTORS_CACHE_TIMEOUT', 300)
+
+#: Alias del cache compartido para la resolución de nombres de usuario. Si es
+#: None solo se utiliza el LRU en memoria del proceso.
+USERNAMES_CACHE_BACKEND = getattr(settings, 'USERS_USERNAMES_CACHE_BACKEND', None)
+
+#: Número máximo de nombres de usuario en el LRU en memoria.
+USERNAMES_CACHE_SIZE = getattr(settings, 'USERS_USERNAMES_CACHE_SIZE', 4096)
+
+#: Tiempo de vida en segundos de un nombre de usuario en el cache compartido.
+USERNAMES_CACHE_TIMEOUT = getattr(settings, 'USERS_USERNAMES_CACHE_TIMEOUT', 3600)
+
+#: Tiempo de vida en segundos de un nombre de usuario en el LRU en memoria.
+#: Acota cuánto tarda un proceso en ver las invalidaciones de los demás.
+USERNAMES_LOCAL_TIMEOUT = getattr(settings, 'USERS_USERNAMES_LOCAL_TIMEOUT', 60)
+
+#: Tiempo de vida en segundos de los nombres de usuario que no existen.
+USERNAMES_NEGATIVE_TIMEOUT = getattr(settings, 'USERS_USERNAMES_NEGATIVE_TIMEOUT', 60)
+
+
+class LRUCache(object):
+    """
+    Cache en memoria acotado a *max_size* elementos que descarta los menos
+    usados recientemente. Implementa el mismo subconjunto de la interfaz de
+    los backends de cache de django que usa la app (get_many, set_many,
+    delete_many, clear) para que ambos sean intercambiables.
+    """
+
+    def __init__(self, max_size=1000, timeout=None):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get_many(self, keys):
+        """
+        Retorna un diccionario con las claves de *keys* que estan en el cache.
+        """
+
+        result = {}
+        now = time()
+
+        with self._lock:
+            for key in keys:
+                item = self._data.pop(key, None)
+
+                if item is None:
+                    continue
+
+                expires, value = item
+                if expires is not None and expires < now:
+                    continue
+
+                # Lo volvemos a insertar al final como el más reciente.
+                self._data[key] = item
+                result[key] = value
+
+        return result
+
+    def set_many(self, data, timeout=None):
+        """
+        Almacena los pares clave/valor de *data* descartando los elementos
+        más antiguos si se supera el tamaño máximo.
+        """
+
+        timeout = timeout or self.timeout
+        expires = time() + timeout if timeout else None
+
+        with self._lock:
+            for key, value in data.items():
+                self._data.pop(key, None)
+                self._data[key] = (expires, value)
+
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete_many(self, keys):
+        """
+        Elimina del cache las claves de *keys*.
+        """
+
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class ActorCache(object):
+    """
+    Cache de dos niveles para los actores (usuario y perfil) que se muestran
+    en las vistas.
+
+    El primer nivel es un mapa de identidad por petición que se guarda en el
+    objeto *request*, así un mismo actor se carga una sola vez por petición.
+    El segundo nivel es compartido entre peticiones: un LRU acotado en memoria
+    o un backend de cache de django con soporte para multi-get. Las entradas
+    del segundo nivel se invalidan con las señales de User y Profile; con el
+    LRU en memoria solo en el proceso que guardó el modelo, los demás las
+    descartan al expirar.
+    """
+
+    #: Prefijo de las claves en el cache compartido.
+    prefix = 'users:actor:'
+
+    #: Atributo del request donde se guarda el mapa de identidad.
+    request_attr = '_users_actors'
+
+    def __init__(self, backend=None, timeout=ACTORS_CACHE_TIMEOUT):
+        self.backend = backend
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.request_hits = 0
+
+    def get_backend(self):
+        """
+        Retorna el backend del segundo nivel.
+        """
+
+        if self.backend is None:
+            if ACTORS_CACHE_BACKEND is not None:
+                self.backend = get_cache(ACTORS_CACHE_BACKEND)
+            else:
+                self.backend = LRUCache(ACTORS_CACHE_SIZE, self.timeout)
+
+        return self.backend
+
+    def make_key(self, actor_id):
+        return '%s%s' % (self.prefix, actor_id)
+
+    def get_many(self, ids, loader, request=None):
+        """
+        Retorna un diccionario con los actores de *ids* indexados por su id.
+
+        Los actores que no estan en ninguno de los dos niveles se cargan con
+        *loader*, una función que recibe la lista de ids faltantes y retorna
+        un diccionario ``{<id>: <actor>}``.
+        """
+
+        ids = [int(actor_id) for actor_id in ids]
+        result = {}
+
+        # Primer nivel: mapa de identidad de la petición.
+        identity_map = None
+        if request is not None:
+            identity_map = getattr(request, self.request_attr, None)
+            if identity_map is None:
+                identity_map = {}
+                setattr(request, self.request_attr, identity_map)
+
+            for actor_id in ids:
+                if actor_id in identity_map:
+                    result[actor_id] = identity_map[actor_id]
+                    self.request_hits += 1
+
+        # Segundo nivel: cache compartido.
+        missing = [actor_id for actor_id in ids if actor_id not in result]
+        if missing:
+            backend = self.get_backend()
+            keys = dict((self.make_key(actor_id), actor_id) for actor_id in missing)
+            cached = backend.get_many(keys.keys())
+
+            for key, actor in cached.items():
+                result[keys[key]] = actor
+
+            self.hits += len(cached)
+
+            missing = [actor_id for actor_id in missing if actor_id not in result]
+
+        # Cargamos los que faltan y los guardamos en el cache.
+        if missing:
+            self.misses += len(missing)
+            loaded = loader(missing)
+
+            if loaded:
+                data = dict((self.make_key(actor_id), actor)
+                            for actor_id, actor in loaded.items())
+                self.get_backend().set_many(data, self.timeout)
+                result.update(loaded)
+
+        if identity_map is not None:
+            identity_map.update(result)
+
+        logging.debug('actors cache: %s' % self.stats())
+
+        return result
+
+    def invalidate(self, ids):
+        """
+        Elimina del cache compartido los actores de *ids*.
+        """
+
+        keys = [self.make_key(int(actor_id)) for actor_id in ids]
+        self.get_backend().delete_many(keys)
+
+    def clear(self):
+        """
+        Limpia el cache y reinicia los contadores.
+        """
+
+        self.get_backend().clear()
+        self.hits = self.misses = self.request_hits = 0
+
+    def stats(self):
+        """
+        Retorna los contadores de aciertos y fallos del cache en este proceso.
+        """
+
+        total = self.hits + self.misses
+        ratio = float(self.hits) / total if total else 0.0
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'request_hits': self.request_hits,
+            'hit_ratio': ratio,
+        }
+
+
+#: Cache de actores utilizado por las vistas.
+actors_cache = ActorCache()
+
+
+class UsernameResolver(object):
+    """
+    Resuelve nombres de usuario a ids de usuario con un LRU acotado en memoria
+    delante de un cache compartido opcional. Los nombres que no existen
+    también se guardan (cache negativo) por un tiempo corto, así las
+    peticiones a subdominios inexistentes no llegan a la base de datos.
+
+    Las entradas se invalidan con las señales de User. Los demás procesos las
+    ven al expirar su LRU, las vistas además verifican que el usuario
+    resuelto siga teniendo ese nombre.
+    """
+
+    #: Prefijo de las claves en el cache compartido.
+    prefix = 'users:username:'
+
+    #: Valor que representa un nombre de usuario inexistente.
+    missing = 0
+
+    #: Número de mediciones de latencia que se conservan.
+    window = 1000
+
+    def __init__(self, backend=None, size=USERNAMES_CACHE_SIZE,
+                                     timeout=USERNAMES_CACHE_TIMEOUT,
+                                     local_timeout=USERNAMES_LOCAL_TIMEOUT,
+                                     negative_timeout=USERNAMES_NEGATIVE_TIMEOUT):
+        self.backend = backend
+        self.timeout = timeout
+        self.negative_timeout = negative_timeout
+        self.local = LRUCache(size, local_timeout)
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def get_backend(self):
+        """
+        Retorna el cache compartido o None si no se utiliza.
+        """
+
+        if self.backend is None and USERNAMES_CACHE_BACKEND is not None:
+            self.backend = get_cache(USERNAMES_CACHE_BACKEND)
+
+        return self.backend
+
+    def make_key(self, username):
+        # Los nombres de usuario pueden tener caracteres que memcached no
+        # acepta en las claves.
+        if isinstance(username, unicode):
+            username = username.encode('utf-8')
+
+        return '%s%s' % (self.prefix, hashlib.md5(username).hexdigest())
+
+    def resolve(self, username, loader):
+        """
+        Retorna el id del usuario *username* o None si no existe. Si no está
+        en el cache se obtiene con *loader*, una función que recibe el nombre
+        de usuario y retorna el id o None.
+        """
+
+        started = time()
+        key = self.make_key(username)
+
+        source = 'local'
+        user_id = self.local.get_many([key]).get(key)
+
+        if user_id is None:
+            source = 'shared'
+            backend = self.get_backend()
+            if backend is not None:
+                user_id = backend.get_many([key]).get(key)
+
+            if user_id is None:
+                source = 'db'
+                user_id = loader(username) or self.missing
+                if backend is not None:
+                    timeout = user_id and self.timeout or self.negative_timeout
+                    backend.set_many({key: user_id}, timeout)
+
+            # Los nombres inexistentes se conservan menos tiempo.
+            negative = user_id == self.missing
+            self.local.set_many({key: user_id},
+                                negative and self.negative_timeout or None)
+
+        self.record(source, user_id == self.missing, time() - started)
+
+        return user_id or None
+
+    def invalidate(self, usernames):
+        """
+        Elimina del cache los nombres de usuario de *usernames*.
+        """
+
+        keys = [self.make_key(username) for username in usernames if username]
+
+        self.local.delete_many(keys)
+
+        backend = self.get_backend()
+        if backend is not None:
+            backend.delete_many(keys)
+
+    def clear(self):
+        """
+        Limpia el LRU en memoria y reinicia los contadores. El cache
+        compartido no se limpia porque puede tener datos de otras apps.
+        """
+
+        self.local.clear()
+        self.reset_stats()
+
+    def record(self, source, negative, elapsed):
+        """
+        Registra el origen y la latencia de una resolución.
+        """
+
+        with self._lock:
+            self.counts[source] += 1
+            if negative:
+                self.counts['negative'] += 1
+            self.latencies.append(elapsed)
+
+    def reset_stats(self):
+        with self._lock:
+            self.counts = {'local': 0, 'shared': 0, 'db': 0, 'negative': 0}
+            self.latencies = deque(maxlen=self.window)
+
+    def stats(self):
+        """
+        Retorna los contadores por origen de las resoluciones de este proceso
+        y las latencias en milisegundos de las últimas *window* resoluciones.
+        """
+
+        with self._lock:
+            counts = dict(self.counts)
+            latencies = sorted(self.latencies)
+
+        lookups = counts['local'] + counts['shared'] + counts['db']
+        cached = counts['local'] + counts['shared']
+
+        def percentile(value):
+            if not latencies:
+                return 0.0
+            index = min(len(latencies) - 1, int(len(latencies) * value))
+            return latencies[index] * 1000
+
+        counts.update({
+            'lookups': lookups,
+            'hit_ratio': float(cached) / lookups if lookups else 0.0,
+            'avg_ms': sum(latencies) * 1000 / len(latencies) if latencies else 0.0,
+            'p50_ms': percentile(0.5),
+            'p95_ms': percentile(0.95),
+            'max_ms': latencies[-1] * 1000 if latencies else 0.0,
+        })
+
+        return counts
+
+
+#: Resolución de nombres de usuario utilizada por las vistas de perfil.
+usernames_cache = UsernameResolver()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Mandla Web Studio
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+__author__ = 'Jose Maria Zambrana Arze'
+__email__ = 'contact@josezambrana.com'
+__version__ = '0.1'
+__copyright__ = 'Copyright 2012, Mandla Web Studio'
+
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.template import Context
+from django.template.loader import get_template
+
+from users.avatars import avatar_url
+
+
+#: Alias del cache (settings.CACHES) de las tarjetas de usuario.
+CARDS_CACHE_BACKEND = getattr(settings, 'USERS_CARDS_CACHE_BACKEND', 'default')
+
+#: Tiempo de vida en segundos de una tarjeta en el cache.
+CARDS_CACHE_TIMEOUT = getattr(settings, 'USERS_CARDS_CACHE_TIMEOUT', 60 * 60 * 24)
+
+#: Versión del template de las tarjetas, se debe cambiar al modificarlo para
+#: descartar las tarjetas guardadas.
+CARDS_VERSION = getattr(settings, 'USERS_CARDS_VERSION', 1)
+
+#: Template de las tarjetas de usuario.
+CARD_TEMPLATE = 'object.users.card.html'
+
+
+def card_key(profile, size):
+    """
+    Retorna la clave de la tarjeta de *profile* con avatar de tamaño *size*.
+    La versión es la fecha de la última modificación del perfil, así las
+    tarjetas se invalidan solas al cambiar el perfil.
+    """
+
+    version = profile.updated_at.strftime('%Y%m%d%H%M%S%f') if profile.updated_at else 0
+    return 'users:card:%s:%s:%s:%s' % (CARDS_VERSION, profile.user_id, version, size)
+
+
+def render_card(profile, size, template=None):
+    """
+    Renderiza la tarjeta de *profile*.
+    """
+
+    template = template or get_template(CARD_TEMPLATE)
+    return template.render(Context({
+        'user_profile': profile,
+        'avatar': avatar_url(profile, size),
+        'size': size,
+    }))
+
+
+def render_cards(profiles, size='s', cache=None):
+    """
+    Retorna el html de las tarjetas de *profiles* en orden. Las tarjetas se
+    obtienen del cache con una sola consulta y solo se renderizan las que
+    faltan. Con *cache* False se renderizan todas.
+    """
+
+    profiles = list(profiles)
+    if cache is None:
+        cache = get_cache(CARDS_CACHE_BACKEND)
+
+    keys = [card_key(profile, size) for profile in profiles]
+    cards = cache.get_many(keys) if cache else {}
+
+    missing = {}
+    template = None
+    for key, profile in zip(keys, profiles):
+        if key not in cards:
+            template = template or get_template(CARD_TEMPLATE)
+            cards[key] = missing[key] = render_card(profile, size, template)
+
+    if missing and cache:
+        cache.set_many(missing, CARDS_CACHE_TIMEOUT)
+
+    return u''.join(cards[key] for key in keys)
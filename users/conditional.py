@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Mandla Web Studio
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+__author__ = 'Jose Maria Zambrana Arze'
+__email__ = 'contact@josezambrana.com'
+__version__ = '0.1'
+__copyright__ = 'Copyright 2012, Mandla Web Studio'
+
+
+import time
+import hashlib
+
+from django.conf import settings
+from django.http import HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.encoding import smart_str
+from django.utils.http import http_date, parse_http_date_safe
+from django.utils.http import parse_etags, quote_etag
+
+
+#: Versión de los ETag, se debe cambiar al modificar los templates de las
+#: vistas para que los clientes no usen sus copias anteriores.
+ETAG_VERSION = getattr(settings, 'USERS_ETAG_VERSION', 1)
+
+
+class ConditionalGetMixin(object):
+    """
+    Responde las peticiones GET condicionales (If-None-Match y
+    If-Modified-Since) con un 304 sin renderizar el template. Las vistas
+    definen *get_validators* a partir de los datos que ya obtuvieron para el
+    contexto, el renderizado es lo que se evita.
+
+    El ETag incluye al usuario que ve la página y la respuesta varía según la
+    cookie, así las copias de un usuario no se entregan a otro. Si hay
+    mensajes pendientes de mostrar la página se renderiza siempre.
+    """
+
+    etag_version = ETAG_VERSION
+
+    def get_validators(self, context):
+        """
+        Retorna una tupla con la lista de valores de los que depende la página
+        (o None) y la fecha de su última modificación (o None).
+        """
+
+        return None, None
+
+    def conditional_enabled(self):
+        if self.request.method not in ('GET', 'HEAD'):
+            return False
+
+        storage = getattr(self.request, '_messages', None)
+        return storage is None or not len(storage)
+
+    def make_etag(self, values):
+        viewer = getattr(self.request.user, 'id', None) or 0
+        values = [self.etag_version, self.get_format(), viewer] + list(values)
+        return hashlib.md5('|'.join(smart_str(value) for value in values)).hexdigest()
+
+    def not_modified(self, etag, last_modified):
+        """
+        Retorna verdadero si la copia del cliente sigue siendo válida.
+        """
+
+        if_none_match = self.request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            etags = parse_etags(if_none_match)
+            return etag is not None and (etag in etags or '*' in etags)
+
+        if_modified_since = self.request.META.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since and last_modified is not None:
+            since = parse_http_date_safe(if_modified_since)
+            return since is not None and \
+                   int(time.mktime(last_modified.timetuple())) <= since
+
+        return False
+
+    def render_to_response(self, context, **response_kwargs):
+        if not self.conditional_enabled():
+            return super(ConditionalGetMixin, self).render_to_response(context, **response_kwargs)
+
+        values, last_modified = self.get_validators(context)
+        etag = self.make_etag(values) if values is not None else None
+
+        if self.not_modified(etag, last_modified):
+            response = HttpResponseNotModified()
+        else:
+            response = super(ConditionalGetMixin, self).render_to_response(context, **response_kwargs)
+
+        if etag is not None:
+            response['ETag'] = quote_etag(etag)
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(time.mktime(last_modified.timetuple()))
+
+        patch_vary_headers(response, ('Cookie', ))
+        return response
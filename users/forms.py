@@ -24,39 +24,103 @@ import logging
 import re
 
 from django import forms
-from django.core.exceptions import MultipleObjectsReturned
-from django.forms.widgets import Widget
-from django.forms.fields import Field
+from django.db import transaction
 from django.conf import settings
 from django.forms import ModelForm
 
 from django.contrib.auth.models import User
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.forms import PasswordResetForm
-from django.contrib.localflavor.es import forms as es_forms
 from django.contrib.auth.tokens import default_token_generator
 
-from django.contrib.sites.models import Site, get_current_site
 
 from django.utils.translation import ugettext_lazy as _
-from django.utils.http import int_to_base36
-from django.utils.safestring import mark_safe
-from django.utils.encoding import force_unicode
 
-from common.mail import Mailer
-
-from thumbnails.templatetags.thumbnails_tags import thumbnail_url
 from thumbnails.forms import ThumbnailField
 from thumbnails.utils import validate_file_size
 
 from users.models import Profile
+from users.middleware import RESERVED_SUBDOMAINS
+from users.sites import get_current_site
+from users.signals import user_changed
+from users.utils import save_fields
+from users.themes import THEME_FIELDS, compile_theme
 
 
 UPPER_RE = re.compile('[A-Z]+')
 USERNAME_RE = re.compile(r'^[a-z0-9\-]+$')
 
 
-current_site = Site.objects.get_current()
+def validate_username(username):
+    """
+    Valida el formato de un nombre de usuario nuevo. Lo utilizan el
+    formulario de registro y la vista de disponibilidad.
+    """
+
+    if not username or not USERNAME_RE.match(username):
+        raise forms.ValidationError(_(u"Solo se permiten caracteres alfanuméricos y el caracter -"))
+
+    max_length = User._meta.get_field('username').max_length
+    if len(username) > max_length:
+        raise forms.ValidationError(_(u'El nombre de usuario puede tener hasta %s caracteres.') % max_length)
+
+    # Los subdominios reservados no pueden ser perfiles.
+    if username in RESERVED_SUBDOMAINS:
+        raise forms.ValidationError(_(u'El nombre de usuario no está disponible.'))
+
+    return username
+
+
+class ChangedFieldsMixin(object):
+    """
+    Mixin para los formularios de configuración que guardan solo los campos
+    modificados del objeto. Si no cambió nada no se realiza ninguna consulta.
+    Los objetos con *save_changed*, como los perfiles, llevan su propio
+    seguimiento de cambios; para los demás se usa *changed_data* y se envía
+    *changed_signal* en lugar de post_save.
+    """
+
+    #: Señal que se envía con los campos guardados.
+    changed_signal = None
+
+    #: Campos guardados en el último *save*.
+    saved_fields = ()
+
+    def get_changed_fields(self, instance):
+        """
+        Retorna los nombres de los campos modificados de *instance*.
+        """
+
+        if hasattr(instance, 'changed_fields'):
+            return instance.changed_fields()
+
+        names = set(field.name for field in instance._meta.fields)
+        return [name for name in self.changed_data if name in names]
+
+    def save_changed(self, instance):
+        """
+        Guarda los campos modificados de *instance*. Retorna sus nombres.
+        """
+
+        if instance.pk is None:
+            instance.save()
+            fields = [field.name for field in instance._meta.fields]
+        elif hasattr(instance, 'save_changed'):
+            fields = instance.save_changed()
+        else:
+            fields = self.get_changed_fields(instance)
+            save_fields(instance, fields, signal=self.changed_signal)
+
+        self.saved_fields = fields
+        return fields
+
+    def save(self, commit=True):
+        instance = super(ChangedFieldsMixin, self).save(commit=False)
+
+        if commit:
+            self.save_changed(instance)
+
+        return instance
 
 
 class MixinClean(object):
@@ -79,7 +143,7 @@ class MixinClean(object):
             raise forms.ValidationError(_(u'El email es obligatorio'))
 
         username = self.cleaned_data.get('username')
-        if email and User.objects.filter(email=email).exclude(username=username).count():
+        if Profile.objects.email_taken(email, username):
             raise forms.ValidationError(u'El email debe ser único.')
 
         return email
@@ -134,39 +198,46 @@ class RegisterForm(UserCreationForm, MixinClean):
         """
 
         username = self.cleaned_data.get('username')
-
-        if not USERNAME_RE.match(username):
-            raise forms.ValidationError(_(u"Solo se permiten caracteres alfanuméricos y el caracter -"))
+        validate_username(username)
 
         return username.lower()
 
     def save(self, *args, **kwargs):
         """
-        Almacena en la base de datos el nuevo usuario y envia un mail de 
-        bienvenida.
+        Almacena en la base de datos el nuevo usuario y encola el mail de 
+        bienvenida en la bandeja de salida, los dos en la misma transacción:
+        si no se puede encolar el mail tampoco se crea el usuario.
         """
         
-        # Crea el usuario
-        user = super(RegisterForm, self).save(*args, **kwargs)
-        
-        # Envia el mail de bienvenida.
-        context = {
-            'user': user,
-        }
-        subject = _(u'%(firstname)s Bienvenido a %(sitename)s') % ({
-            'firstname': user.first_name, 
-            'sitename': current_site.name
-        })
-
-        mail = Mailer(subject, 'mail.welcome.txt',
-                               'mail.welcome.html', 
-                               **context)
-        mail.send(user.email)
+        # El envío de emails se importa al usarse, no al cargar el formulario.
+        from users.outbox import enqueue_mail, outbox_worker_mode, outbox_worker
+
+        with transaction.commit_on_success():
+            # Crea el usuario
+            user = super(RegisterForm, self).save(*args, **kwargs)
+            
+            # Envia el mail de bienvenida.
+            context = {
+                'user': user,
+            }
+            subject = _(u'%(firstname)s Bienvenido a %(sitename)s') % ({
+                'firstname': user.first_name, 
+                'sitename': get_current_site().name
+            })
+
+            enqueue_mail(user.email, subject, 'mail.welcome.txt',
+                                              'mail.welcome.html',
+                                              wake=False,
+                                              **context)
+
+        # El worker se despierta cuando el mail ya está guardado.
+        if outbox_worker_mode() == 'thread':
+            outbox_worker().wake()
 
         return user
 
 
-class UserForm(forms.ModelForm, MixinClean):
+class UserForm(ChangedFieldsMixin, forms.ModelForm, MixinClean):
     """
     Formulario para configurar los datos del usuario: nombres, apellidos, email
     contraseña.
@@ -182,6 +253,8 @@ class UserForm(forms.ModelForm, MixinClean):
                                             " for verification."),
                                 required=False)
     
+    changed_signal = user_changed
+
     class Meta:
         model = User
         fields = ("first_name", "last_name", "email")
@@ -202,11 +275,19 @@ class UserForm(forms.ModelForm, MixinClean):
 
         username = self.instance.username
 
-        if email and User.objects.filter(email=email).exclude(username=username).exists():
+        if Profile.objects.email_taken(email, username):
             raise forms.ValidationError(u'El email debe ser único.')
         
         return email
 
+    def get_changed_fields(self, instance):
+        fields = super(UserForm, self).get_changed_fields(instance)
+
+        if self.cleaned_data.get("password1"):
+            fields.append('password')
+
+        return fields
+
     def save(self, commit=True):
         user = super(UserForm, self).save(commit=False)
         
@@ -214,12 +295,12 @@ class UserForm(forms.ModelForm, MixinClean):
             user.set_password(self.cleaned_data["password1"])
         
         if commit:
-            user.save()
+            self.save_changed(user)
         
         return user
 
 
-class ProfileForm(forms.ModelForm):
+class ProfileForm(ChangedFieldsMixin, forms.ModelForm):
     """
     Formulario para configurar el perfil del usuario.
     """
@@ -238,18 +319,27 @@ class ProfileForm(forms.ModelForm):
             
         return image
 
-    def save(self):
-        image = self.cleaned_data.get('image')
-        
-        profile = super(ProfileForm, self).save(commit=True)
-        
-        if image is not None:
-            profile.create_thumbnails()
+    def save(self, commit=True):
+        from users.tasks import enqueue_thumbnails
+
+        profile = super(ProfileForm, self).save(commit=False)
+
+        # Los thumbnails se generan fuera de la petición, mientras tanto se
+        # muestra la imagen original. Sin una imagen nueva no hay cambios.
+        new_image = bool(profile.image) and 'image' in self.get_changed_fields(profile)
+        if new_image:
+            profile.thumbnails_ready = False
+
+        if commit:
+            self.save_changed(profile)
+
+            if new_image:
+                enqueue_thumbnails(profile)
         
         return profile
 
 
-class DesignForm(forms.ModelForm):
+class DesignForm(ChangedFieldsMixin, forms.ModelForm):
     """
     Formulario para configurar el diseño del perfil de un usuario.
     """
@@ -259,31 +349,52 @@ class DesignForm(forms.ModelForm):
         fields = ('background', 'background_color', 'links_color', 
                   'button_background', 'button_color')
 
+    def save(self, commit=True):
+        """
+        Guarda el diseño y compila su hoja de estilo si cambió.
+        """
+
+        from users.tasks import enqueue_thumbnails
+
+        profile = super(DesignForm, self).save(commit=False)
+
+        if commit:
+            changed = set(self.get_changed_fields(profile)) & set(THEME_FIELDS)
+            new_background = 'background' in changed and bool(profile.background)
+
+            if new_background:
+                # La hoja de estilo usa la url definitiva de la imagen, que se
+                # muestra tal como se subió hasta que se optimiza.
+                background = profile.background
+                if not background._committed:
+                    background.save(background.name, background, save=False)
+
+            if changed:
+                profile.theme_hash = compile_theme(profile)
+
+            self.save_changed(profile)
+
+            if new_background:
+                enqueue_thumbnails(profile, field='background')
+
+        return profile
+
 
 class PasswordResetForm(PasswordResetForm): 
     def save(self, **kwargs):
+        """
+        Envía las instrucciones para cambiar la contraseña a todos los
+        usuarios con el email solicitado usando una sola conexión.
+        """
+
+        from users.bulkmail import send_password_instructions
+
         use_https = kwargs.pop('use_https', False)
         token_generator = kwargs.pop('token_generator', default_token_generator)
         request = kwargs.pop('request', None)
         from_email = kwargs.pop('from_email', None)
         
-        for user in self.users_cache:
-            site_name = current_site.name
-            domain = current_site.domain
-            
-            subject = _("Password reset on %s") % site_name
-            context = {
-                'email': user.email,
-                'domain': domain,
-                'site_name': site_name,
-                'uid': int_to_base36(user.id),
-                'user': user,
-                'token': token_generator.make_token(user),
-                'protocol': use_https and 'https' or 'http',
-            }
-            
-            mail = Mailer(subject, 'mail.password_instructions.txt',
-                                   'mail.password_instructions.html', 
-                                   **context)
-            mail.send(user.email, from_email)
-
+        return send_password_instructions(self.users_cache, get_current_site(request),
+                                          use_https=use_https,
+                                          token_generator=token_generator,
+                                          from_email=from_email)
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Mandla Web Studio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+__author__ = 'Jose Maria Zambrana Arze'
+__email__ = 'contact@josezambrana.com'
+__version__ = '0.1'
+__copyright__ = 'Copyright 2012, Mandla Web Studio'
+
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+
+#: Transformaciones que corrigen cada orientación EXIF (etiqueta 274).
+ORIENTATIONS = {
+    2: ('FLIP_LEFT_RIGHT', ),
+    3: ('ROTATE_180', ),
+    4: ('FLIP_TOP_BOTTOM', ),
+    5: ('FLIP_LEFT_RIGHT', 'ROTATE_90'),
+    6: ('ROTATE_270', ),
+    7: ('FLIP_LEFT_RIGHT', 'ROTATE_270'),
+    8: ('ROTATE_90', ),
+}
+
+
+def image_module():
+    """
+    Retorna el módulo Image de PIL, se importa solo al procesar imágenes.
+    """
+
+    try:
+        from PIL import Image
+    except ImportError:
+        import Image
+
+    return Image
+
+
+def open_image(data):
+    """
+    Decodifica la imagen contenida en *data*.
+    """
+
+    return image_module().open(StringIO(data))
+
+
+def webp_supported():
+    """
+    Retorna verdadero si PIL puede guardar imágenes en formato WebP.
+    """
+
+    Image = image_module()
+    Image.init()
+    return 'WEBP' in Image.SAVE
+
+
+def apply_orientation(image):
+    """
+    Gira *image* según la orientación EXIF de la cámara, que se pierde al
+    descartar los metadatos.
+    """
+
+    try:
+        exif = image._getexif() or {}
+    except Exception:
+        return image
+
+    Image = image_module()
+    for name in ORIENTATIONS.get(exif.get(274), ()):
+        image = image.transpose(getattr(Image, name))
+
+    return image
+
+
+def encode_image(image, format='JPEG', quality=85):
+    """
+    Retorna el contenido de *image* en formato *format*, JPEG progresivo u
+    otro formato soportado por PIL como WEBP. No se copian los metadatos
+    (EXIF, perfiles ICC) de la imagen original.
+    """
+
+    options = {'quality': quality}
+    if format == 'JPEG':
+        options.update(optimize=True, progressive=True)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+
+    output = StringIO()
+    image.save(output, format, **options)
+    return output.getvalue()
+
+
+def render_thumbnails(data, sizes, methods):
+    """
+    Genera los thumbnails de todos los tamaños de *sizes* decodificando la
+    imagen *data* una sola vez. Retorna un diccionario con el nombre de cada
+    tamaño y el contenido JPEG de su thumbnail.
+
+    Los tamaños se generan de mayor a menor y cada uno se reduce a partir del
+    anterior (reducción en cascada), así cada paso trabaja sobre una imagen
+    más pequeña.
+    """
+
+    image = open_image(data)
+
+    # Para los JPEG pedimos al decodificador una escala reducida cercana al
+    # tamaño más grande que necesitamos.
+    largest = max(sizes.values())
+    image.draft('RGB', (largest[0] * 2, largest[1] * 2))
+    image.load()
+
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    thumbnails = {}
+    ordered = sorted(sizes.items(), key=lambda item: item[1][0], reverse=True)
+
+    for name, (width, height) in ordered:
+        image = methods[name].apply(image, width, height)
+        thumbnails[name] = encode_image(image)
+
+    return thumbnails
+
+
+def render_backgrounds(data, max_size, widths, formats=('JPEG', ), quality=85):
+    """
+    Optimiza la imagen de fondo *data*: corrige su orientación, descarta
+    los metadatos, la reduce hasta *max_size* y la vuelve a comprimir.
+    Retorna el ancho y el contenido JPEG de la imagen optimizada y un
+    diccionario con el contenido de cada variante ``(<ancho>, <formato>)``.
+
+    Las variantes se generan para los anchos de *widths* menores al de la
+    imagen, en cascada de mayor a menor, en cada formato de *formats*. Los
+    formatos distintos de JPEG se generan también con el ancho completo.
+    """
+
+    Image = image_module()
+
+    image = open_image(data)
+    image.draft('RGB', max_size)
+    image = apply_orientation(image)
+
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    image.thumbnail(max_size, Image.ANTIALIAS)
+
+    width, height = image.size
+    master_width = width
+    master = encode_image(image, 'JPEG', quality)
+
+    variants = {}
+    for format in formats:
+        if format != 'JPEG':
+            variants[(master_width, format)] = encode_image(image, format, quality)
+
+    for variant_width in sorted(widths, reverse=True):
+        if variant_width >= width:
+            continue
+
+        variant_height = max(1, int(round(height * variant_width / float(width))))
+        image = image.resize((variant_width, variant_height), Image.ANTIALIAS)
+        width, height = image.size
+
+        for format in formats:
+            variants[(variant_width, format)] = encode_image(image, format, quality)
+
+    return master_width, master, variants
@@ -22,15 +22,23 @@ __copyright__ = 'Copyright 2012, Mandla Web Studio'
 
 import logging
 
+from datetime import datetime
+from contextlib import contextmanager
+
 from django.db import transaction
-from django.dispatch import receiver
+from django.db import IntegrityError
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save
-from django.contrib.auth.signals import user_logged_in
-from django.contrib import messages
+from django.db.models.signals import post_delete
+
+from users.cache import actors_cache, usernames_cache
+from users.utils import normalize_email
+from users.availability import availability_index
+from users.search import SEARCH_FIELDS
+from users.search import update_search_index, remove_from_search_index
+from users.signals import profile_changed, user_changed
 
 
-@receiver(post_save, sender=User)
 def create_profile(sender, instance, created, using, *args, **kwargs):
     """
     Crea el perfil de usuario cuando se crea un usuario.
@@ -40,10 +48,193 @@ def create_profile(sender, instance, created, using, *args, **kwargs):
     if created:
         try:
             sp_id = transaction.savepoint()
-            profile = Profile(user=instance, username=instance.username)
+            profile = Profile(user=instance, username=instance.username,
+                                             first_name=instance.first_name,
+                                             last_name=instance.last_name)
             profile.save()
             transaction.savepoint_commit(sp_id)
         except Exception, e:
             logging.error('ERROR: %s ' % e)
             transaction.savepoint_rollback(sp_id)
-    
+
+
+def sync_profile_display(sender, instance, created, *args, **kwargs):
+    """
+    Copia al perfil los campos del usuario que se muestran en los listados y
+    su email normalizado.
+    """
+    from users.models import Profile
+
+    values = dict((field, getattr(instance, field)) for field in Profile.display_fields)
+    values['email_normalized'] = normalize_email(instance.email)
+
+    # Solo actualiza la fila si algún campo es distinto.
+    profiles = Profile.objects.filter(user=instance)
+
+    sp_id = transaction.savepoint()
+    try:
+        updated = profiles.exclude(**values).update(updated_at=datetime.now(),
+                                                    **values)
+        transaction.savepoint_commit(sp_id)
+    except IntegrityError:
+        # Otro perfil ya tiene el email, por ejemplo usuarios antiguos con
+        # emails repetidos. Este perfil queda sin email normalizado.
+        transaction.savepoint_rollback(sp_id)
+        logging.warning('users: email %s is already in use' % instance.email)
+
+        values['email_normalized'] = None
+        updated = profiles.exclude(**values).update(updated_at=datetime.now(),
+                                                    **values)
+
+    # update() no envía señales, actualizamos el índice de búsqueda.
+    if updated:
+        update_search_index(profiles.only('id', *SEARCH_FIELDS))
+
+
+@contextmanager
+def profile_listener_suspended():
+    """
+    Desconecta temporalmente *create_profile* para que los usuarios creados
+    dentro del bloque no creen su perfil uno por uno, por ejemplo en las
+    importaciones masivas que insertan los perfiles por lotes.
+    """
+
+    post_save.disconnect(sender=User, dispatch_uid='users.create_profile')
+    try:
+        yield
+    finally:
+        post_save.connect(create_profile, sender=User,
+                          dispatch_uid='users.create_profile')
+
+
+def invalidate_user_actor(sender, instance, *args, **kwargs):
+    """
+    Elimina del cache de actores al usuario modificado o eliminado.
+    """
+
+    actors_cache.invalidate([instance.pk])
+
+
+def invalidate_username(sender, instance, *args, **kwargs):
+    """
+    Elimina del cache la resolución del nombre del usuario creado, modificado
+    o eliminado, también las negativas de un nombre recién ocupado. El
+    nombre anterior de un usuario renombrado se corrige al resolverlo.
+    """
+
+    usernames_cache.invalidate([instance.username])
+
+
+def update_availability(sender, instance, *args, **kwargs):
+    """
+    Agrega al filtro de disponibilidad el nombre y el email del usuario.
+    """
+
+    availability_index.add(instance.username, instance.email)
+
+
+def invalidate_profile_actor(sender, instance, *args, **kwargs):
+    """
+    Elimina del cache de actores al dueño del perfil modificado o eliminado.
+    """
+
+    actors_cache.invalidate([instance.user_id])
+
+
+def index_profile(sender, instance, *args, **kwargs):
+    """
+    Actualiza el perfil en el índice de búsqueda.
+    """
+
+    update_search_index([instance])
+
+
+def unindex_profile(sender, instance, *args, **kwargs):
+    """
+    Elimina el perfil del índice de búsqueda.
+    """
+
+    remove_from_search_index([instance.pk])
+
+
+def user_fields_changed(sender, instance, fields, *args, **kwargs):
+    """
+    Actualiza solo lo que depende de los campos *fields* del usuario
+    guardados sin post_save.
+    """
+
+    from users.models import Profile
+
+    fields = set(fields)
+
+    if fields & set(Profile.display_fields + ('email', )):
+        sync_profile_display(sender, instance, created=False)
+
+    # El actor guarda al usuario completo.
+    invalidate_user_actor(sender, instance)
+
+    if 'username' in fields:
+        invalidate_username(sender, instance)
+
+    if fields & set(['username', 'email']):
+        update_availability(sender, instance)
+
+
+def profile_fields_changed(sender, instance, fields, *args, **kwargs):
+    """
+    Actualiza solo lo que depende de los campos *fields* del perfil
+    guardados sin post_save.
+    """
+
+    # El actor guarda al perfil completo.
+    invalidate_profile_actor(sender, instance)
+
+    if set(fields) & set(SEARCH_FIELDS):
+        index_profile(sender, instance)
+
+
+def connect_signals():
+    """
+    Conecta los listeners de la aplicación. Se llama una sola vez al cargar
+    users.models, cuando los modelos de los que dependen ya están
+    registrados; el *dispatch_uid* evita registrarlos dos veces si el módulo
+    se importa por otra ruta.
+    """
+
+    from users.models import Profile
+    from users.sites import invalidate_sites
+    from django.contrib.sites.models import Site
+
+    post_save.connect(create_profile, sender=User,
+                      dispatch_uid='users.create_profile')
+    post_save.connect(sync_profile_display, sender=User,
+                      dispatch_uid='users.sync_profile_display')
+    post_save.connect(update_availability, sender=User,
+                      dispatch_uid='users.update_availability')
+
+    for signal in (post_save, post_delete):
+        name = signal is post_save and 'save' or 'delete'
+
+        signal.connect(invalidate_user_actor, sender=User,
+                       dispatch_uid='users.invalidate_user_actor.%s' % name)
+        signal.connect(invalidate_username, sender=User,
+                       dispatch_uid='users.invalidate_username.%s' % name)
+
+        # Invalidamos el cache de actores cuando cambia un perfil.
+        signal.connect(invalidate_profile_actor, sender=Profile,
+                       dispatch_uid='users.invalidate_profile_actor.%s' % name)
+
+        signal.connect(invalidate_sites, sender=Site,
+                       dispatch_uid='users.invalidate_sites.%s' % name)
+
+    # Mantenemos actualizado el índice de búsqueda de perfiles.
+    post_save.connect(index_profile, sender=Profile,
+                      dispatch_uid='users.index_profile')
+    post_delete.connect(unindex_profile, sender=Profile,
+                        dispatch_uid='users.unindex_profile')
+
+    # Los guardados parciales de los formularios de configuración.
+    user_changed.connect(user_fields_changed, sender=User,
+                         dispatch_uid='users.user_fields_changed')
+    profile_changed.connect(profile_fields_changed, sender=Profile,
+                            dispatch_uid='users.profile_fields_changed')
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Mandla Web Studio
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+__author__ = 'Jose Maria Zambrana Arze'
+__email__ = 'contact@josezambrana.com'
+__version__ = '0.1'
+__copyright__ = 'Copyright 2012, Mandla Web Studio'
+
+
+from time import time
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from users.availability import AvailabilityIndex, AVAILABILITY_SNAPSHOT
+
+
+class Command(BaseCommand):
+    """
+    Guarda en disco el filtro de disponibilidad de nombres de usuario y
+    emails para que los procesos lo carguen al iniciar sin recorrer todos los
+    usuarios. Por defecto se parte de la copia anterior y solo se agregan los
+    perfiles modificados desde entonces; con --rebuild se construye desde
+    cero, lo que además descarta los valores que ya no están en uso.
+    """
+
+    help = 'Saves the username and email availability filter to disk.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--path', dest='path', default=None,
+                    help='Snapshot file, by default USERS_AVAILABILITY_SNAPSHOT.'),
+        make_option('--rebuild', action='store_true', dest='rebuild',
+                    default=False, help='Ignore the previous snapshot.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        path = options['path'] or AVAILABILITY_SNAPSHOT
+        if not path:
+            raise CommandError('Set USERS_AVAILABILITY_SNAPSHOT or use --path')
+
+        initial = time()
+        index = AvailabilityIndex(snapshot=None if options['rebuild'] else path)
+        index.load()
+        index.save(path)
+
+        if verbosity:
+            self.stdout.write('%s entries up to %s saved to %s in %.2fs\n' % (
+                              index.bloom.count,
+                              datetime.fromtimestamp(index.watermark), path,
+                              time() - initial))
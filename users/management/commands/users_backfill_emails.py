@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Mandla Web Studio
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+__author__ = 'Jose Maria Zambrana Arze'
+__email__ = 'contact@josezambrana.com'
+__version__ = '0.1'
+__copyright__ = 'Copyright 2012, Mandla Web Studio'
+
+
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.contrib.auth.models import User
+
+from users.models import Profile
+from users.utils import normalize_email
+
+
+class Command(BaseCommand):
+    """
+    Completa el email normalizado de los perfiles a partir del email de sus
+    usuarios, por ejemplo después de agregar la columna email_normalized.
+
+    Los usuarios se recorren por bloques de ids, con una transacción por
+    bloque. Si varios usuarios tienen el mismo email solo el más antiguo lo
+    conserva en su perfil, los demás se listan para revisarlos.
+    """
+
+    help = 'Fills the normalized email of every profile.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+                    help='Number of users processed per batch.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        batch_size = options['batch_size']
+
+        users = User.objects.order_by('id').values_list('id', 'email')
+
+        updated = 0
+        duplicated = []
+        last_id = 0
+        while True:
+            chunk = list(users.filter(id__gt=last_id)[:batch_size])
+            if not chunk:
+                break
+
+            last_id = chunk[-1][0]
+            emails = dict((user_id, normalize_email(email)) for user_id, email in chunk)
+
+            profiles = Profile.objects.filter(user__in=emails.keys())
+            current = dict(profiles.values_list('user_id', 'email_normalized'))
+
+            # Los emails que ya tiene otro perfil.
+            wanted = set(email for email in emails.values() if email)
+            taken = Profile.objects.filter(email_normalized__in=wanted)
+            taken = dict(taken.values_list('email_normalized', 'user_id'))
+
+            with transaction.commit_on_success():
+                for user_id, email in chunk:
+                    normalized = emails[user_id]
+                    if user_id not in current or current[user_id] == normalized:
+                        continue
+
+                    owner = taken.get(normalized)
+                    if owner is not None and owner < user_id:
+                        duplicated.append((user_id, email))
+                        normalized = None
+                    elif normalized is not None:
+                        if owner is not None and owner != user_id:
+                            # Un usuario más nuevo tiene el email, se le quita
+                            # y se lista cuando se procese su bloque.
+                            Profile.objects.filter(user=owner).update(
+                                email_normalized=None,
+                                updated_at=datetime.now())
+                            if owner in current:
+                                current[owner] = None
+                            updated += 1
+                        taken[normalized] = user_id
+
+                    if current[user_id] != normalized:
+                        profile = Profile.objects.filter(user=user_id)
+                        profile.update(email_normalized=normalized,
+                                       updated_at=datetime.now())
+                        updated += 1
+
+        if verbosity:
+            self.stdout.write('%s profiles updated\n' % updated)
+            for user_id, email in duplicated:
+                self.stdout.write('duplicated email: user %s <%s>\n' % (user_id, email))
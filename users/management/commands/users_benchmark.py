@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Mandla Web Studio
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+__author__ = 'Jose Maria Zambrana Arze'
+__email__ = 'contact@josezambrana.com'
+__version__ = '0.1'
+__copyright__ = 'Copyright 2012, Mandla Web Studio'
+
+
+import os
+import sys
+import subprocess
+
+from time import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test.client import RequestFactory
+from django.contrib.auth import authenticate, login as auth_login
+from django.contrib.sessions.middleware import SessionMiddleware
+
+
+class Command(BaseCommand):
+    """
+    Mide el rendimiento de las partes críticas de la app. Los datos que se
+    crean durante las mediciones se descartan al terminar: el registro, que
+    confirma su propia transacción, se mide en una base de datos de pruebas
+    que se destruye al terminar y los demás se deshacen con un rollback.
+
+    Benchmarks disponibles:
+
+    * signup: registros por segundo identificando al usuario con
+      authenticate (verifica de nuevo la contraseña) y con login_new_user.
+    * usernames: resoluciones de nombres de usuario por segundo con el cache
+      vacío y con el cache lleno, para nombres existentes y no existentes.
+    * search: latencia de las búsquedas de perfiles por prefijos de nombres
+      de usuario (objetivo: menos de 50ms con un millón de usuarios).
+    * index: tiempo de renderizado de las tarjetas del listado de usuarios
+      sin cache, con el cache vacío y con el cache lleno.
+    * startup: tiempo de importación de los módulos de la app y número de
+      consultas que realizan, en un proceso nuevo, y los módulos que cargan
+      users, users.models y users.forms por separado.
+    """
+
+    args = '<benchmark>'
+    help = 'Runs a users benchmark: signup, usernames, search, index, startup.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--iterations', type='int', dest='iterations', default=50,
+                    help='Number of iterations.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: users_benchmark %s' % self.args)
+
+        name = args[0]
+        method = getattr(self, 'benchmark_%s' % name, None)
+        if method is None:
+            raise CommandError('Unknown benchmark: %s' % name)
+
+        if name in self.test_db_benchmarks:
+            self.run_in_test_db(method, **options)
+            return
+
+        # Todo lo que se crea se descarta al terminar.
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            method(**options)
+        finally:
+            transaction.rollback()
+            transaction.leave_transaction_management()
+
+    #: Benchmarks que confirman transacciones y se ejecutan en una base de
+    #: datos de pruebas.
+    test_db_benchmarks = ('signup', )
+
+    def run_in_test_db(self, method, **options):
+        """
+        Ejecuta *method* en una base de datos de pruebas creada como la de
+        los tests y la destruye al terminar. El worker del outbox en memoria
+        se desactiva para no enviar los emails de bienvenida.
+        """
+
+        from django.db import connection
+
+        # Como el comando test de South, crea las tablas de las apps con
+        # migraciones.
+        if 'south' in settings.INSTALLED_APPS:
+            from south.management.commands import patch_for_test_db_setup
+            patch_for_test_db_setup()
+
+        old_name = connection.settings_dict['NAME']
+        old_worker = getattr(settings, 'USERS_OUTBOX_WORKER', 'thread')
+        settings.USERS_OUTBOX_WORKER = None
+
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            method(**options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            settings.USERS_OUTBOX_WORKER = old_worker
+
+    def report(self, label, count, elapsed):
+        rate = count / elapsed if elapsed else 0.0
+        self.stdout.write('%-30s %6d in %8.3fs  %10.1f/s  %8.2fms each\n' % (
+                          label, count, elapsed, rate,
+                          elapsed * 1000 / count if count else 0.0))
+
+    def benchmark_signup(self, iterations=50, **options):
+        """
+        Compara el registro identificando al usuario con authenticate y con
+        login_new_user. El costo depende del hasher de contraseñas
+        configurado (PASSWORD_HASHERS en django 1.4 o superior).
+        """
+
+        from users.forms import RegisterForm
+        from users.views import login_new_user
+
+        hashers = getattr(settings, 'PASSWORD_HASHERS', ['sha1'])
+        self.stdout.write('password hasher: %s\n' % hashers[0])
+
+        factory = RequestFactory()
+        sessions = SessionMiddleware()
+
+        def signup(prefix, index, trusted):
+            password = 'benchmark-pass'
+            username = 'bench-%s-%s' % (prefix, index)
+            form = RegisterForm({
+                'first_name': 'Bench',
+                'last_name': 'Mark',
+                'username': username,
+                'password1': password,
+                'password2': password,
+                'email': '%s@example.com' % username,
+            })
+            if not form.is_valid():
+                raise CommandError('Invalid signup data: %s' % form.errors)
+
+            request = factory.post('/')
+            sessions.process_request(request)
+
+            user = form.save()
+            if trusted:
+                login_new_user(request, user)
+            else:
+                user = authenticate(username=username, password=password)
+                auth_login(request, user)
+
+        for label, prefix, trusted in (('signup + authenticate', 'a', False),
+                                       ('signup + login_new_user', 't', True)):
+            initial = time()
+            for index in range(iterations):
+                signup(prefix, index, trusted)
+            self.report(label, iterations, time() - initial)
+
+    def benchmark_usernames(self, iterations=50, **options):
+        """
+        Compara la resolución de nombres de usuario consultando la base de
+        datos y usando el cache, y muestra las latencias registradas.
+        """
+
+        from django.contrib.auth.models import User
+        from users.cache import usernames_cache
+        from users.views import load_user_id
+
+        usernames = list(User.objects.values_list('username', flat=True)[:iterations])
+        unknown = ['bench-unknown-%s' % index for index in range(iterations)]
+
+        for label, names in (('existing', usernames), ('unknown', unknown)):
+            usernames_cache.clear()
+
+            initial = time()
+            for username in names:
+                User.objects.filter(username=username).exists()
+            self.report('%s: database' % label, len(names), time() - initial)
+
+            initial = time()
+            for username in names:
+                usernames_cache.resolve(username, load_user_id)
+            self.report('%s: cold cache' % label, len(names), time() - initial)
+
+            initial = time()
+            for username in names:
+                usernames_cache.resolve(username, load_user_id)
+            self.report('%s: warm cache' % label, len(names), time() - initial)
+
+            stats = usernames_cache.stats()
+            self.stdout.write('  p50 %.3fms  p95 %.3fms  max %.3fms  hit ratio %.2f\n' % (
+                              stats['p50_ms'], stats['p95_ms'], stats['max_ms'],
+                              stats['hit_ratio']))
+
+    def benchmark_search(self, iterations=50, **options):
+        """
+        Mide la latencia de las búsquedas con prefijos de 2, 3 y 5 letras de
+        nombres de usuario existentes.
+        """
+
+        from django.contrib.auth.models import User
+        from users.search import search_index
+
+        if not search_index.enabled:
+            raise CommandError('USERS_SEARCH_PATH is not set, the search is disabled.')
+
+        usernames = list(User.objects.order_by('?').values_list('username', flat=True)[:iterations])
+        self.stdout.write('search engine: %s\n' % search_index.engine)
+
+        for length in (2, 3, 5):
+            latencies = []
+            initial = time()
+            for username in usernames:
+                started = time()
+                search_index.search(username[:length])
+                latencies.append(time() - started)
+            self.report('prefix of %s letters' % length, len(usernames), time() - initial)
+
+            if latencies:
+                latencies.sort()
+                self.stdout.write('  p50 %.3fms  p95 %.3fms  max %.3fms\n' % (
+                                  latencies[len(latencies) // 2] * 1000,
+                                  latencies[int(len(latencies) * 0.95)] * 1000,
+                                  latencies[-1] * 1000))
+
+    def benchmark_index(self, iterations=50, **options):
+        """
+        Compara el renderizado de una página de tarjetas del listado de
+        usuarios sin cache y con el cache de tarjetas.
+        """
+
+        from django.core.cache import get_cache
+        from users.models import Profile
+        from users.cards import render_cards, card_key, CARDS_CACHE_BACKEND
+
+        profiles = list(Profile.objects.listing().order_by('-id')[:50])
+        cache = get_cache(CARDS_CACHE_BACKEND)
+        self.stdout.write('%s cards per page, cache: %s\n' % (
+                          len(profiles), cache.__class__.__name__))
+
+        initial = time()
+        for index in range(iterations):
+            render_cards(profiles, cache=False)
+        self.report('render without cache', iterations, time() - initial)
+
+        initial = time()
+        for index in range(iterations):
+            cache.delete_many([card_key(profile, 's') for profile in profiles])
+            render_cards(profiles, cache=cache)
+        self.report('render with cold cache', iterations, time() - initial)
+
+        initial = time()
+        for index in range(iterations):
+            render_cards(profiles, cache=cache)
+        self.report('render with warm cache', iterations, time() - initial)
+
+    #: Script que importa los módulos de la app en un proceso nuevo.
+    startup_script = """
+import time
+from django.conf import settings
+settings.DEBUG = True
+from django.db import connection
+started = time.time()
+import users.models, users.forms, users.views, users.admin, users.urls
+print len(connection.queries), time.time() - started
+"""
+
+    #: Script que importa *module* y muestra el número de módulos cargados y
+    #: el tiempo.
+    modules_script = """
+import sys, time
+loaded = len(sys.modules)
+started = time.time()
+__import__(%r)
+print len(sys.modules) - loaded, time.time() - started
+"""
+
+    #: Módulos que se importan por separado.
+    import_modules = ('users', 'users.models', 'users.forms')
+
+    def subprocess_env(self):
+        """
+        Retorna el entorno de los procesos nuevos, con el sys.path de este
+        proceso para que encuentren los módulos del proyecto aunque
+        manage.py los haya añadido al arrancar.
+        """
+
+        env = os.environ.copy()
+        env['PYTHONPATH'] = os.pathsep.join(path for path in sys.path if path)
+        return env
+
+    def import_stats(self, module):
+        """
+        Importa *module* en un proceso nuevo. Retorna el número de módulos
+        que se cargaron y el tiempo de importación en segundos.
+        """
+
+        output = subprocess.Popen([sys.executable, '-c', self.modules_script % module],
+                                  env=self.subprocess_env(),
+                                  stdout=subprocess.PIPE).communicate()[0]
+        count, elapsed = output.split()[-2:]
+        return int(count), float(elapsed)
+
+    def benchmark_startup(self, iterations=50, **options):
+        """
+        Importa los módulos de la app en *iterations* procesos nuevos y
+        muestra el tiempo de importación y las consultas realizadas.
+        """
+
+        iterations = min(iterations, 10)
+        timings = []
+
+        initial = time()
+        for index in range(iterations):
+            output = subprocess.Popen([sys.executable, '-c', self.startup_script],
+                                      env=self.subprocess_env(),
+                                      stdout=subprocess.PIPE).communicate()[0]
+            queries, elapsed = output.split()[-2:]
+            timings.append(float(elapsed))
+        self.report('process start', iterations, time() - initial)
+
+        timings.sort()
+        self.stdout.write('import-time queries: %s\n' % queries)
+        self.stdout.write('import time: min %.1fms  median %.1fms  max %.1fms\n' % (
+                          timings[0] * 1000, timings[len(timings) // 2] * 1000,
+                          timings[-1] * 1000))
+
+        for module in self.import_modules:
+            count, elapsed = self.import_stats(module)
+            self.stdout.write('import %-19s %4d modules  %8.1fms\n' % (
+                              module, count, elapsed * 1000))
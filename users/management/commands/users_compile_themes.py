@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Mandla Web Studio
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+__author__ = 'Jose Maria Zambrana Arze'
+__email__ = 'contact@josezambrana.com'
+__version__ = '0.1'
+__copyright__ = 'Copyright 2012, Mandla Web Studio'
+
+
+from time import time
+from datetime import datetime
+from optparse import make_option
+
+from django.db.models import Q
+from django.core.management.base import BaseCommand
+
+from users.models import Profile
+from users.cache import actors_cache
+from users.themes import THEME_FIELDS, compile_theme
+
+
+class Command(BaseCommand):
+    """
+    Compila las hojas de estilo de los perfiles con diseño, por ejemplo los
+    configurados antes de que existieran o después de cambiar el template
+    de las hojas de estilo. Al guardar el diseño se compilan solas.
+    """
+
+    help = 'Compiles the theme stylesheets of the profiles with a design.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+                    help='Number of profiles compiled per batch.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        batch_size = options['batch_size']
+
+        initial = time()
+
+        designed = Q()
+        for field in THEME_FIELDS:
+            designed |= Q(**{'%s__gt' % field: ''})
+
+        profiles = Profile.objects.filter(designed).order_by('id')
+        profiles = profiles.only('id', 'user', *(THEME_FIELDS + ('theme_hash', )))
+
+        compiled = updated = 0
+        last_id = 0
+        while True:
+            chunk = list(profiles.filter(id__gt=last_id)[:batch_size])
+            if not chunk:
+                break
+
+            changed = []
+            for profile in chunk:
+                digest = compile_theme(profile)
+                compiled += 1
+
+                if digest != profile.theme_hash:
+                    Profile.objects.filter(pk=profile.pk).update(
+                        theme_hash=digest, updated_at=datetime.now())
+                    changed.append(profile.user_id)
+
+            # update() no envía señales.
+            actors_cache.invalidate(changed)
+            updated += len(changed)
+            last_id = chunk[-1].pk
+
+            if verbosity > 1:
+                self.stdout.write('%s profiles compiled\n' % compiled)
+
+        if verbosity:
+            self.stdout.write('%s profiles compiled, %s updated in %.2fs\n' % (
+                              compiled, updated, time() - initial))
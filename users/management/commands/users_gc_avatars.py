@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Mandla Web Studio
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+__author__ = 'Jose Maria Zambrana Arze'
+__email__ = 'contact@josezambrana.com'
+__version__ = '0.1'
+__copyright__ = 'Copyright 2012, Mandla Web Studio'
+
+
+import os
+import re
+
+from time import time
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from users.models import Profile
+from users.managers import chunked
+
+
+#: Tamaños de los thumbnails en los nombres de los archivos.
+SIZES = '|'.join(re.escape(size) for size in sorted(Profile.sizes.keys()))
+
+#: Nombre de los thumbnails con hash: <hash>_<tamaño>.jpg
+HASHED_RE = re.compile(r'^([0-9a-f]{16})_(%s)\.jpg$' % SIZES)
+
+#: Nombre de los thumbnails anteriores: <usuario>_<tamaño>[_<versión>].jpg
+LEGACY_RE = re.compile(r'^.+_(%s)(_\d+)?\.jpg$' % SIZES)
+
+
+class Command(BaseCommand):
+    """
+    Elimina del storage los thumbnails de avatares que ya no usa ningún
+    perfil: los reemplazados por una imagen nueva, los que quedaron con el
+    nombre de usuario anterior y los de trabajos que no se publicaron. Los
+    archivos modificados hace menos de --grace-hours se conservan, pueden
+    ser de un trabajo en curso o estar en páginas guardadas en los caches.
+    Los archivos cuyo nombre no es el de un thumbnail nunca se eliminan.
+    """
+
+    help = 'Deletes the avatar thumbnails no profile uses anymore.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--grace-hours', type='int', dest='grace_hours', default=48,
+                    help='Keep the files modified in the last hours.'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False,
+                    help='Only report the files that would be deleted.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        dry_run = options['dry_run']
+
+        initial = time()
+        limit = datetime.now() - timedelta(hours=options['grace_hours'])
+
+        storage = Profile._meta.get_field('image').storage
+        basepath = Profile().thumbnail_basepath()
+
+        if not storage.exists(basepath):
+            return
+
+        hashes, names = self.referenced()
+
+        candidates = []
+        for name in storage.listdir(basepath)[1]:
+            match = HASHED_RE.match(name)
+            if match and match.group(1) in hashes:
+                continue
+
+            # El directorio puede ser compartido, solo se consideran los
+            # archivos con nombre de thumbnail.
+            if not match and not LEGACY_RE.match(name):
+                continue
+
+            path = os.path.join(basepath, name)
+            if not match and path in names:
+                continue
+
+            try:
+                if storage.modified_time(path) > limit:
+                    continue
+            except NotImplementedError:
+                # Sin fecha de modificación solo se eliminan sin espera.
+                if options['grace_hours']:
+                    continue
+
+            candidates.append((match and match.group(1), path))
+
+        # Un perfil pudo publicar un hash existente mientras se recorría el
+        # storage, se vuelve a verificar justo antes de eliminar.
+        deleted = size = 0
+        for chunk in chunked(candidates):
+            digests = set(digest for digest, path in chunk if digest)
+            used = set(Profile.objects.filter(avatar_hash__in=digests)
+                                      .values_list('avatar_hash', flat=True))
+
+            for digest, path in chunk:
+                if digest in used:
+                    continue
+
+                size += storage.size(path)
+                deleted += 1
+
+                if verbosity > 1:
+                    self.stdout.write('%s\n' % path)
+
+                if not dry_run:
+                    storage.delete(path)
+
+        if verbosity:
+            self.stdout.write('%s%s files deleted, %.1f KB in %.2fs\n' % (
+                              dry_run and '[dry run] ' or '', deleted,
+                              size / 1024.0, time() - initial))
+
+    def referenced(self):
+        """
+        Retorna los hashes de los thumbnails en uso y los nombres de las
+        imágenes originales y de los thumbnails anteriores, nombrados con el
+        nombre de usuario.
+        """
+
+        hashes = set()
+        names = set()
+
+        profiles = Profile.objects.exclude(image='').exclude(image=None)
+        profiles = profiles.only('id', 'user', 'username', 'image',
+                                 'thumbnails_version', 'avatar_hash')
+        profiles = profiles.order_by('id')
+
+        last_id = 0
+        while True:
+            chunk = list(profiles.filter(id__gt=last_id)[:1000])
+            if not chunk:
+                break
+
+            for profile in chunk:
+                # Por si las imágenes originales están en el mismo directorio.
+                names.add(profile.image.name)
+
+                if profile.avatar_hash:
+                    hashes.add(profile.avatar_hash)
+                else:
+                    names.update(profile.thumbnail_name(size)
+                                 for size in profile.sizes)
+
+            last_id = chunk[-1].pk
+
+        return hashes, names
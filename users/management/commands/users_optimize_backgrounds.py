@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Mandla Web Studio
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+__author__ = 'Jose Maria Zambrana Arze'
+__email__ = 'contact@josezambrana.com'
+__version__ = '0.1'
+__copyright__ = 'Copyright 2012, Mandla Web Studio'
+
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from users.models import Profile
+from users.backgrounds import is_optimized
+from users.tasks import enqueue_thumbnails
+from users.tasks import run_jobs_in_pool
+
+
+class Command(BaseCommand):
+    """
+    Optimiza las imágenes de fondo de los perfiles y genera sus variantes,
+    por ejemplo las subidas antes de que se optimizaran o después de cambiar
+    USERS_BACKGROUND_WIDTHS. Los trabajos se reparten entre varios procesos.
+    """
+
+    help = 'Optimizes the background images of the profiles.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=1,
+                    help='Number of processes optimizing backgrounds.'),
+        make_option('--all', action='store_true', dest='all', default=False,
+                    help='Also reprocess the backgrounds already optimized.'),
+        make_option('--enqueue-only', action='store_true', dest='enqueue_only',
+                    default=False,
+                    help='Only enqueue the jobs for the thumbnails workers.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        profiles = Profile.objects.exclude(background='').exclude(background=None)
+        profiles = profiles.only('id', 'background', 'background_version')
+        profiles = profiles.order_by('id')
+
+        # Recorremos los perfiles por bloques de ids para no cargarlos todos.
+        enqueued = 0
+        last_id = 0
+        while True:
+            chunk = list(profiles.filter(id__gt=last_id)[:500])
+            if not chunk:
+                break
+
+            for profile in chunk:
+                if options['all'] or not is_optimized(profile):
+                    enqueue_thumbnails(profile, field='background', wake=False)
+                    enqueued += 1
+
+            last_id = chunk[-1].id
+
+        if verbosity:
+            self.stdout.write('%s profiles enqueued\n' % enqueued)
+
+        if options['enqueue_only']:
+            return
+
+        processed = run_jobs_in_pool(options['workers'])
+
+        if verbosity:
+            self.stdout.write('%s jobs processed\n' % processed)
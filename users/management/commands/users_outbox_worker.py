@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Mandla Web Studio
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+__author__ = 'Jose Maria Zambrana Arze'
+__email__ = 'contact@josezambrana.com'
+__version__ = '0.1'
+__copyright__ = 'Copyright 2012, Mandla Web Studio'
+
+
+import time
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from users.outbox import drain_outbox
+from users.outbox import OUTBOX_BATCH_SIZE
+from users.outbox import OUTBOX_MAX_WORKERS
+
+
+class Command(BaseCommand):
+    """
+    Envía los emails pendientes de la bandeja de salida.
+
+    Para probarlo con un servidor SMTP local de depuración::
+
+        python -m smtpd -n -c DebuggingServer localhost:1025
+        python manage.py users_outbox_worker --once --host localhost --port 1025
+    """
+
+    help = 'Sends the pending mails of the users outbox.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', dest='once', default=False,
+                    help='Send the pending mails and exit.'),
+        make_option('--sleep', type='int', dest='sleep', default=5,
+                    help='Seconds to wait when the outbox is empty.'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=OUTBOX_BATCH_SIZE,
+                    help='Mails sent per SMTP connection.'),
+        make_option('--workers', type='int', dest='workers',
+                    default=OUTBOX_MAX_WORKERS,
+                    help='Maximum number of simultaneous SMTP connections.'),
+        make_option('--host', dest='host', default=None,
+                    help='SMTP host, defaults to settings.EMAIL_HOST.'),
+        make_option('--port', type='int', dest='port', default=None,
+                    help='SMTP port, defaults to settings.EMAIL_PORT.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        connection_kwargs = {}
+        for key in ('host', 'port'):
+            if options[key] is not None:
+                connection_kwargs[key] = options[key]
+
+        while True:
+            sent = drain_outbox(batch_size=options['batch_size'],
+                                workers=options['workers'],
+                                **connection_kwargs)
+
+            if verbosity > 1 and sent:
+                self.stdout.write('%s mails sent\n' % sent)
+
+            if options['once']:
+                break
+
+            if not sent:
+                connection.close()
+                time.sleep(options['sleep'])
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Mandla Web Studio
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+__author__ = 'Jose Maria Zambrana Arze'
+__email__ = 'contact@josezambrana.com'
+__version__ = '0.1'
+__copyright__ = 'Copyright 2012, Mandla Web Studio'
+
+
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.contrib.auth.models import User
+
+from users.models import Profile
+from users.utils import bulk_insert
+
+
+class Command(BaseCommand):
+    """
+    Compara los campos que los perfiles copian del usuario (nombre de usuario,
+    nombre y apellidos) y corrige los que no coinciden, por ejemplo después de
+    actualizar usuarios con *update()* o directamente en la base de datos, que
+    no envían señales. También crea los perfiles que falten.
+
+    Los usuarios se recorren por bloques de ids, con una transacción por
+    bloque.
+    """
+
+    help = 'Fixes the user fields copied into the profiles.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+                    help='Number of users compared per batch.'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False, help='Only report the differences.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        batch_size = options['batch_size']
+        dry_run = options['dry_run']
+
+        fields = Profile.display_fields
+        users = User.objects.order_by('id').values_list('id', *fields)
+
+        updated = created = 0
+        last_id = 0
+        while True:
+            chunk = list(users.filter(id__gt=last_id)[:batch_size])
+            if not chunk:
+                break
+
+            last_id = chunk[-1][0]
+            ids = [row[0] for row in chunk]
+
+            profiles = Profile.objects.filter(user__in=ids)
+            profiles = dict((row[0], row[1:]) for row in
+                            profiles.values_list('user_id', *fields))
+
+            drifted = []
+            missing = []
+            for row in chunk:
+                user_id, values = row[0], row[1:]
+                if user_id not in profiles:
+                    missing.append(Profile(user_id=user_id, **dict(zip(fields, values))))
+                elif profiles[user_id] != values:
+                    drifted.append((user_id, dict(zip(fields, values))))
+
+            updated += len(drifted)
+            created += len(missing)
+
+            if dry_run:
+                continue
+
+            now = datetime.now()
+            with transaction.commit_on_success():
+                for user_id, values in drifted:
+                    Profile.objects.filter(user=user_id).update(updated_at=now, **values)
+                bulk_insert(Profile, missing)
+
+        if verbosity:
+            prefix = dry_run and 'Would have ' or ''
+            self.stdout.write('%supdated %s profiles, %screated %s profiles\n' % (
+                              prefix, updated, prefix.lower(), created))
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Mandla Web Studio
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+__author__ = 'Jose Maria Zambrana Arze'
+__email__ = 'contact@josezambrana.com'
+__version__ = '0.1'
+__copyright__ = 'Copyright 2012, Mandla Web Studio'
+
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from users.models import Profile
+from users.tasks import enqueue_thumbnails
+from users.tasks import run_jobs_in_pool
+
+
+class Command(BaseCommand):
+    """
+    Vuelve a generar los thumbnails de todos los perfiles con avatar, por
+    ejemplo después de cambiar Profile.sizes.
+    """
+
+    help = 'Regenerates the avatar thumbnails of every profile.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=1,
+                    help='Number of processes generating thumbnails.'),
+        make_option('--enqueue-only', action='store_true', dest='enqueue_only',
+                    default=False,
+                    help='Only enqueue the jobs for the thumbnails workers.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        profiles = Profile.objects.exclude(image='').exclude(image=None)
+        profiles = profiles.only('id', 'image').order_by('id')
+
+        # Recorremos los perfiles por bloques de ids para no cargarlos todos.
+        enqueued = 0
+        last_id = 0
+        while True:
+            chunk = list(profiles.filter(id__gt=last_id)[:500])
+            if not chunk:
+                break
+
+            for profile in chunk:
+                enqueue_thumbnails(profile, wake=False)
+
+            enqueued += len(chunk)
+            last_id = chunk[-1].id
+
+        if verbosity:
+            self.stdout.write('%s profiles enqueued\n' % enqueued)
+
+        if options['enqueue_only']:
+            return
+
+        processed = run_jobs_in_pool(options['workers'])
+
+        if verbosity:
+            self.stdout.write('%s jobs processed\n' % processed)
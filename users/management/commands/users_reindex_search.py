@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Mandla Web Studio
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+__author__ = 'Jose Maria Zambrana Arze'
+__email__ = 'contact@josezambrana.com'
+__version__ = '0.1'
+__copyright__ = 'Copyright 2012, Mandla Web Studio'
+
+
+from time import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from users.models import Profile
+from users.search import search_index, SEARCH_FIELDS
+
+
+class Command(BaseCommand):
+    """
+    Reconstruye el índice de búsqueda de perfiles recorriendo los perfiles
+    por bloques de ids. Las señales mantienen el índice actualizado después.
+    """
+
+    help = 'Rebuilds the profiles search index.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=5000,
+                    help='Number of profiles indexed per batch.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        batch_size = options['batch_size']
+
+        if not search_index.enabled:
+            raise CommandError('USERS_SEARCH_PATH is not set, the search is disabled.')
+
+        initial = time()
+        search_index.clear()
+
+        profiles = Profile.objects.order_by('id').values_list('id', *SEARCH_FIELDS)
+
+        indexed = 0
+        last_id = 0
+        while True:
+            chunk = list(profiles.filter(id__gt=last_id)[:batch_size])
+            if not chunk:
+                break
+
+            rows = [tuple(value or u'' for value in row) for row in chunk]
+            search_index.index_rows(rows)
+
+            indexed += len(rows)
+            last_id = chunk[-1][0]
+
+            if verbosity > 1:
+                self.stdout.write('%s profiles indexed\n' % indexed)
+
+        if verbosity:
+            self.stdout.write('%s profiles indexed with %s in %s, %.2fs\n' % (
+                              indexed, search_index.engine, search_index.path,
+                              time() - initial))
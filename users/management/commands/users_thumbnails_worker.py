@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Mandla Web Studio
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+__author__ = 'Jose Maria Zambrana Arze'
+__email__ = 'contact@josezambrana.com'
+__version__ = '0.1'
+__copyright__ = 'Copyright 2012, Mandla Web Studio'
+
+
+import time
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from users.tasks import run_pending_jobs
+from users.tasks import JOBS_POLL_INTERVAL
+
+
+class Command(BaseCommand):
+    """
+    Procesa la cola de trabajos de thumbnails de los perfiles.
+    """
+
+    help = 'Processes the queue of pending profile thumbnail jobs.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', dest='once', default=False,
+                    help='Process the pending jobs and exit.'),
+        make_option('--sleep', type='int', dest='sleep', default=JOBS_POLL_INTERVAL,
+                    help='Seconds to wait when the queue is empty.'),
+        make_option('--limit', type='int', dest='limit', default=100,
+                    help='Maximum number of jobs per round.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        while True:
+            processed = run_pending_jobs(limit=options['limit'])
+
+            if verbosity > 1 and processed:
+                self.stdout.write('%s jobs processed\n' % processed)
+
+            if options['once']:
+                break
+
+            if not processed:
+                connection.close()
+                time.sleep(options['sleep'])
@@ -22,7 +22,58 @@ __copyright__ = 'Copyright 2012, Mandla Web Studio'
 
 from django.db import models
 from django.db.models import Manager
+from django.conf import settings
 from django.template.defaultfilters import slugify
+from django.utils.datastructures import SortedDict
+
+from users.utils import normalize_email
+
+
+#: Número máximo de ids por consulta, por debajo del límite de parámetros de
+#: la base de datos (999 en sqlite).
+QUERY_CHUNK_SIZE = getattr(settings, 'USERS_QUERY_CHUNK_SIZE', 500)
+
+#: Número de intentos de una actualización de *extras* cuando otro proceso
+#: la modifica al mismo tiempo.
+EXTRAS_MAX_RETRIES = getattr(settings, 'USERS_EXTRAS_MAX_RETRIES', 5)
+
+#: Si es verdadero los emails también se buscan en auth_user, para los
+#: usuarios sin email normalizado. Solo hace falta al actualizar un sitio
+#: existente hasta ejecutar users_backfill_emails: la consulta no usa ningún
+#: índice.
+EMAIL_LEGACY_CHECK = getattr(settings, 'USERS_EMAIL_LEGACY_CHECK', False)
+
+
+class ExtrasConflict(Exception):
+    """
+    Otro proceso modificó los *extras* del perfil en cada uno de los intentos
+    de actualizarlos.
+    """
+
+
+class Actor(object):
+    """
+    Registro liviano con el usuario y el perfil de un actor. Las vistas que
+    trabajan solo con la tabla de perfiles crean actores sin usuario.
+    """
+
+    def __init__(self, user=None, profile=None):
+        self.id = user.id if user is not None else profile.user_id
+        self.user = user
+        self.profile = profile
+
+    def __repr__(self):
+        return '<Actor: %s>' % self.id
+
+
+def chunked(items, size=QUERY_CHUNK_SIZE):
+    """
+    Divide la lista *items* en listas de máximo *size* elementos.
+    """
+
+    items = list(items)
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
 
 
 class ProfileManager(Manager):
@@ -30,6 +81,53 @@ class ProfileManager(Manager):
     Manejador de objetos de perfil.
     """
     
+    #: Campos que necesitan los listados de perfiles.
+    listing_fields = ('id', 'user', 'username', 'first_name', 'last_name',
+                      'image', 'thumbnails_ready', 'thumbnails_version',
+                      'avatar_hash', 'last_published', 'updated_at')
+
+    #: Campos pesados que no necesitan las lecturas frecuentes.
+    deferred_fields = ('extras', )
+
+    def listing(self):
+        """
+        Retorna los perfiles con solo los campos que se muestran en los
+        listados, que se ordenan con el índice (last_published, id).
+        """
+
+        return self.only(*self.listing_fields)
+
+    def email_taken(self, email, username=None):
+        """
+        Retorna verdadero si *email* pertenece a otro usuario distinto de
+        *username*, sin distinguir mayúsculas. La consulta usa el índice único
+        de *email_normalized*; mientras *USERS_EMAIL_LEGACY_CHECK* esté activo
+        también se buscan los usuarios cuyo perfil aún no tiene el email
+        normalizado.
+        """
+
+        from django.contrib.auth.models import User
+
+        email = normalize_email(email)
+        if email is None:
+            return False
+
+        profiles = self.filter(email_normalized=email)
+        if username is not None:
+            profiles = profiles.exclude(username=username)
+
+        if profiles.exists():
+            return True
+
+        if not EMAIL_LEGACY_CHECK:
+            return False
+
+        users = User.objects.filter(email__iexact=email)
+        if username is not None:
+            users = users.exclude(username=username)
+
+        return users.exists()
+
     def profiles_dict(self, users_ids):
         """
         Retorna un diccionario donde las claves son los ids de los usuarios
@@ -38,7 +136,7 @@ class ProfileManager(Manager):
 
         profiles_dict = {}
 
-        profiles = self.filter(user__pk__in=users_ids)
+        profiles = self.defer(*self.deferred_fields).filter(user__pk__in=users_ids)
 
         for profile in profiles:
             key = str(profile.user_id)
@@ -46,4 +144,68 @@ class ProfileManager(Manager):
 
         return profiles_dict
 
+    def actors_for(self, users_ids):
+        """
+        Retorna un diccionario ordenado igual que *users_ids* donde las claves
+        son los ids (enteros) de los usuarios y los valores sus actores.
+
+        Los usuarios y sus perfiles se cargan en una sola consulta por cada
+        bloque de ids.
+        """
+
+        from django.contrib.auth.models import User
+
+        users_ids = [int(user_id) for user_id in users_ids]
+        found = {}
+
+        for chunk in chunked(users_ids):
+            profiles = self.select_related('user').defer(*self.deferred_fields)
+            profiles = profiles.filter(user__pk__in=chunk)
+            for profile in profiles:
+                found[profile.user_id] = Actor(profile.user, profile)
+
+        # Usuarios que por algún motivo aún no tienen perfil.
+        missing = [user_id for user_id in users_ids if user_id not in found]
+        for chunk in chunked(missing):
+            for user in User.objects.filter(pk__in=chunk):
+                found[user.id] = Actor(user)
+
+        actors = SortedDict()
+        for user_id in users_ids:
+            if user_id in found:
+                actors[user_id] = found[user_id]
+
+        return actors
+
+    def update_extras(self, pk, mutate, retries=EXTRAS_MAX_RETRIES):
+        """
+        Aplica *mutate* a los *extras* del perfil *pk* y guarda solo esa
+        columna. *mutate* recibe el diccionario actual, lo modifica y retorna
+        una tupla ``(<cambió>, <resultado>)``; si no cambió nada no se
+        escribe.
+
+        La escritura se condiciona a *extras_version*: si otro proceso
+        modificó los extras desde la lectura se vuelve a leer y a aplicar
+        *mutate*, hasta *retries* veces, después se lanza *ExtrasConflict*.
+        Retorna los extras guardados, su versión y el resultado de *mutate*.
+        """
+
+        field = self.model._meta.get_field('extras')
+
+        for attempt in range(retries):
+            raw, version = self.filter(pk=pk).values_list('extras',
+                                                          'extras_version').get()
+            extras = field.to_python(raw)
+
+            changed, result = mutate(extras)
+            if not changed:
+                return extras, version, result
+
+            updated = self.filter(pk=pk, extras_version=version)
+            updated = updated.update(extras=extras, extras_version=version + 1)
+
+            if updated:
+                return extras, version + 1, result
 
+        raise ExtrasConflict(u'Extras of profile %s changed in all %s attempts' % (
+                             pk, retries))
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Mandla Web Studio
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+__author__ = 'Jose Maria Zambrana Arze'
+__email__ = 'contact@josezambrana.com'
+__version__ = '0.1'
+__copyright__ = 'Copyright 2012, Mandla Web Studio'
+
+
+from django.conf import settings
+
+from users.utils import profile_domain
+
+
+#: Subdominios que no pertenecen a ningún usuario.
+RESERVED_SUBDOMAINS = getattr(settings, 'USERS_RESERVED_SUBDOMAINS',
+                              ('www', 'static', 'media', 'api', 'mail'))
+
+#: Urlconf de las peticiones a los subdominios de los usuarios.
+SUBDOMAIN_URLCONF = getattr(settings, 'USERS_SUBDOMAIN_URLCONF',
+                            'users.subdomain_urls')
+
+
+def profile_username(host, domain):
+    """
+    Retorna el nombre de usuario del subdominio *host* de *domain* o None si
+    *host* no es el subdominio de un usuario.
+    """
+
+    host = host.lower()
+    domain = domain.lower()
+
+    # Comparamos el puerto solo si el dominio lo incluye.
+    if ':' not in domain:
+        host = host.split(':')[0]
+
+    suffix = '.%s' % domain
+    if not host.endswith(suffix):
+        return None
+
+    username = host[:-len(suffix)]
+    if not username or '.' in username or username in RESERVED_SUBDOMAINS:
+        return None
+
+    return username
+
+
+class SubdomainProfileMiddleware(object):
+    """
+    Atiende las peticiones a http://<username>.<dominio> directamente con el
+    perfil del usuario, sin redirecciones. La raíz del subdominio muestra el
+    perfil (UsersProfile) y las demás urls del sitio siguen funcionando.
+
+    El nombre de usuario se resuelve con el cache de nombres de usuario, así
+    los subdominios existentes y los inexistentes no consultan la base de
+    datos en cada petición. Se agrega en settings.MIDDLEWARE_CLASSES::
+
+        'users.middleware.SubdomainProfileMiddleware',
+    """
+
+    def process_request(self, request):
+        username = profile_username(request.get_host(), profile_domain(request))
+        if username is None:
+            return None
+
+        request.profile_username = username
+        request.urlconf = SUBDOMAIN_URLCONF
+        return None
@@ -21,17 +21,17 @@ __copyright__ = 'Copyright 2012, Mandla Web Studio'
 
 
 import os
-import uuid
+import copy
 import logging
 
-from time import time
+from datetime import datetime
 
-from django.db import models
+from django.db import models, router
 from django.conf import settings
+from django.core.files.base import ContentFile
 from django.core.urlresolvers import reverse
+from django.db.models.fields.files import FieldFile
 from django.contrib.auth.models import User
-from django.contrib.sites.models import Site
-from django.contrib.contenttypes.models import ContentType
 
 from django.utils.translation import ugettext_lazy as _
 
@@ -40,9 +40,9 @@ from common.fields import ColorField
 from thumbnails.models import ThumbnailMixin
 
 from users.managers import ProfileManager
-
-
-current_site = Site.objects.get_current()
+from users.listeners import connect_signals
+from users.utils import profile_url, save_fields
+from users.signals import profile_changed
 
 
 class Profile(ThumbnailMixin):
@@ -58,7 +58,22 @@ class Profile(ThumbnailMixin):
                                                          blank=True,
                                                          null=True)
 
-    # Fecha de la última publicación realizada.
+    #: Nombre del usuario, copia de User.first_name para los listados.
+    first_name = models.CharField(_(u'Nombre'), max_length=30, blank=True,
+                                                              default='')
+
+    #: Apellidos del usuario, copia de User.last_name para los listados.
+    last_name = models.CharField(_(u'Apellidos'), max_length=30, blank=True,
+                                                                 default='')
+
+    #: Email del usuario normalizado con *normalize_email*. El índice único
+    #: permite verificar que un email no esté en uso sin recorrer auth_user.
+    email_normalized = models.CharField(_(u'Email normalizado'), max_length=254,
+                                        unique=True, null=True, blank=True,
+                                        editable=False)
+
+    # Fecha de la última publicación realizada. El índice de los listados
+    # (last_published, id) se crea en la migración 0004.
     last_published = models.DateTimeField(_(u'Última publicación'), auto_now_add=True)
     
     #: descripción del usuario.
@@ -70,8 +85,21 @@ class Profile(ThumbnailMixin):
     #: Campo para almacenar información adicional
     extras = DictField(_('Extras'), null=False, blank=True, default={})
 
+    #: Versión de *extras*, aumenta con cada actualización parcial.
+    extras_version = models.PositiveIntegerField(_(u'Versión de los extras'),
+                                                 default=0, editable=False)
+
     #: Imagen de fondo del perfil.
     background = models.ImageField(_(u'Imagen de fondo'), blank=True, null=True, upload_to='backgrounds')
+
+    #: Versión de la imagen de fondo optimizada, cero mientras se usa la
+    #: imagen tal como se subió. Ver *users.backgrounds*.
+    background_version = models.PositiveIntegerField(_(u'Versión del fondo'),
+                                                     default=0, editable=False)
+
+    #: Ancho de la imagen de fondo optimizada.
+    background_width = models.PositiveIntegerField(_(u'Ancho del fondo'),
+                                                   default=0, editable=False)
     
     #: Color de fondo del perfil.
     background_color = ColorField(_(u'Color de fondo'), blank=True, null=True)
@@ -85,8 +113,37 @@ class Profile(ThumbnailMixin):
     #: Color del texto de los botones
     button_color = ColorField(_(u'Color texto botones'), blank=True, null=True)
 
+    #: Hash de la hoja de estilo compilada con el diseño, ver *users.themes*.
+    theme_hash = models.CharField(_(u'Hoja de estilo'), max_length=32, blank=True,
+                                  default='', editable=False)
+
+    #: Si los thumbnails de la imagen actual ya fueron generados.
+    thumbnails_ready = models.BooleanField(_(u'Thumbnails listos'), default=True)
+
+    #: Versión del conjunto de thumbnails publicado.
+    thumbnails_version = models.PositiveIntegerField(_(u'Versión de los thumbnails'),
+                                                     default=0)
+
+    #: Hash del contenido de la imagen y de los tamaños de los thumbnails,
+    #: nombra los thumbnails. Vacío en los thumbnails anteriores, que se
+    #: nombran con el nombre de usuario y la versión.
+    avatar_hash = models.CharField(_(u'Hash del avatar'), max_length=32, blank=True,
+                                   default='', editable=False)
+
+    #: Fecha de la última modificación. Las actualizaciones con *update()*
+    #: de los campos que se muestran deben asignarla explícitamente.
+    updated_at = models.DateTimeField(_(u'Actualizado en'), auto_now=True,
+                                                            default=datetime.now,
+                                                            db_index=True)
+
 
     objects = ProfileManager()
+
+    #: Campos copiados del usuario, se mantienen sincronizados con señales.
+    display_fields = ('username', 'first_name', 'last_name')
+
+    #: Campos que solo se guardan con las actualizaciones de los extras.
+    extras_fields = ('extras', 'extras_version')
     
     #: Los tamaños permitidos en los avatares
     sizes = {
@@ -107,17 +164,399 @@ class Profile(ThumbnailMixin):
         'l': 'avatar_l.png',
     }
 
-    def thumbnail_name(self, size):
+    def thumbnail_name(self, size, version=None, avatar_hash=None):
         """
-        Retorna el nombre del thumbnail del tamaño *size*
+        Retorna el nombre del thumbnail del tamaño *size*. Los thumbnails
+        con hash del contenido (*avatar_hash*) se nombran con el hash y
+        nunca cambian; los anteriores con el nombre de usuario y la versión
+        *version* de los thumbnails. Por defecto se usan el hash y la
+        versión actuales.
         """
-        
-        thumb_name = '%s_%s.jpg' % (self.user.username, str(size))
+
+        if avatar_hash is None and version is None:
+            avatar_hash = self.avatar_hash
+
+        if avatar_hash:
+            thumb_name = '%s_%s.jpg' % (avatar_hash, str(size))
+            return os.path.join(self.thumbnail_basepath(), thumb_name)
+
+        if version is None:
+            version = self.thumbnails_version
+
+        # Usamos la copia del nombre de usuario para no cargar al usuario.
+        username = self.username or self.user.username
+
+        if version:
+            thumb_name = '%s_%s_%s.jpg' % (username, str(size), version)
+        else:
+            thumb_name = '%s_%s.jpg' % (username, str(size))
+
         return os.path.join(self.thumbnail_basepath(), thumb_name)
-    
+
+    def create_thumbnails(self, data=None):
+        """
+        Crea los thumbnails de todos los tamaños decodificando la imagen una
+        sola vez. *data* es el contenido de la imagen si ya se leyó.
+
+        Los thumbnails con hash no cambian nunca: si ya existen, por ejemplo
+        porque otro perfil subió la misma imagen, no se vuelven a generar.
+        """
+
+        from users.images import render_thumbnails
+
+        storage = self.image.storage
+
+        if self.avatar_hash:
+            names = [self.thumbnail_name(size) for size in self.sizes]
+            if all(storage.exists(name) for name in names):
+                return
+
+        if data is None:
+            source = storage.open(self.image.name, 'rb')
+            try:
+                data = source.read()
+            finally:
+                source.close()
+
+        thumbnails = render_thumbnails(data, self.sizes, self.methods)
+
+        for size, content in thumbnails.items():
+            name = self.thumbnail_name(size)
+            if storage.exists(name):
+                # Un thumbnail con hash ya tiene este mismo contenido.
+                if self.avatar_hash:
+                    continue
+                storage.delete(name)
+            storage.save(name, ContentFile(content))
+
+    def __init__(self, *args, **kwargs):
+        super(Profile, self).__init__(*args, **kwargs)
+        self._reset_changes()
+
+    def _tracked_value(self, field):
+        """
+        Retorna el valor de *field* que se compara para saber si cambió.
+        """
+
+        value = getattr(self, field.attname)
+
+        if isinstance(value, FieldFile):
+            return value.name
+
+        # Los diccionarios de DictField se modifican en el mismo objeto.
+        if isinstance(value, (dict, list)):
+            return copy.deepcopy(value)
+
+        return value
+
+    def _reset_changes(self):
+        """
+        Guarda los valores actuales como los valores de la base de datos. Los
+        campos diferidos y aún no cargados se omiten.
+        """
+
+        self._loaded_values = dict((field.attname, self._tracked_value(field))
+                                   for field in self._meta.fields
+                                   if field.attname in self.__dict__)
+
+    def changed_fields(self):
+        """
+        Retorna los nombres de los campos modificados desde que se cargó o se
+        guardó el perfil.
+        """
+
+        changed = []
+
+        # Los perfiles guardados en el cache antes del seguimiento de cambios
+        # no tienen valores cargados, todos sus campos cuentan como cambiados.
+        loaded = self.__dict__.get('_loaded_values', {})
+
+        for field in self._meta.fields:
+            if field.primary_key or field.attname not in self.__dict__:
+                continue
+
+            value = getattr(self, field.attname)
+
+            # Un archivo nuevo puede tener el mismo nombre que el anterior.
+            if isinstance(value, FieldFile) and not value._committed:
+                changed.append(field.name)
+            elif field.attname not in loaded:
+                # Un campo diferido que se cargó después.
+                changed.append(field.name)
+            elif self._tracked_value(field) != loaded[field.attname]:
+                changed.append(field.name)
+
+        return changed
+
+    def save(self, *args, **kwargs):
+        """
+        Guarda el perfil. Un perfil que ya existe guarda *extras* y
+        *extras_version* solo si se modificaron en esta instancia: una
+        instancia con extras viejos no pisa los que otro proceso guardó
+        después con *set_extra*, *incr_extra* o *delete_extra*. Se envían
+        pre_save y post_save como en un save normal.
+        """
+
+        if self.pk is None or args or kwargs or not self._save_existing():
+            super(Profile, self).save(*args, **kwargs)
+
+        self._reset_changes()
+
+    def _save_existing(self):
+        """
+        Actualiza todas las columnas del perfil excepto las de los extras que
+        no cambiaron. Si se asignaron los extras sin su versión, la versión
+        aumenta para que las actualizaciones parciales en curso se repitan.
+        Retorna falso si el perfil no existe en la base de datos.
+        """
+
+        model = self.__class__
+        if model._deferred:
+            model = model._meta.proxy_for_model
+
+        changed = self.changed_fields()
+        extras_changed = [name for name in self.extras_fields if name in changed]
+        fields = [field.name for field in model._meta.fields
+                             if not field.primary_key
+                             and (field.name not in self.extras_fields
+                                  or field.name in extras_changed)]
+
+        using = router.db_for_write(model, instance=self)
+        models.signals.pre_save.send(sender=model, instance=self, raw=False,
+                                     using=using)
+        if not save_fields(self, fields, using=using):
+            return False
+
+        if extras_changed == ['extras']:
+            rows = model._default_manager.using(using).filter(pk=self.pk)
+            rows.update(extras_version=models.F('extras_version') + 1)
+            self.extras_version = rows.values_list('extras_version', flat=True).get()
+
+        self._state.db = using
+        models.signals.post_save.send(sender=model, instance=self, created=False,
+                                      raw=False, using=using)
+        return True
+
+    def save_changed(self):
+        """
+        Guarda solo las columnas de los campos modificados y envía la señal
+        *profile_changed* en lugar de post_save. Si no cambió nada no se
+        realiza ninguna consulta. Un perfil nuevo se guarda completo. Retorna
+        los nombres de los campos guardados.
+        """
+
+        if self.pk is None:
+            self.save()
+            return [field.name for field in self._meta.fields]
+
+        fields = self.changed_fields()
+        save_fields(self, fields, signal=profile_changed)
+        self._reset_changes()
+
+        return fields
+
+    def _update_extras(self, mutate):
+        """
+        Actualiza los extras con *ProfileManager.update_extras* y copia en la
+        instancia los valores guardados.
+        """
+
+        from users.cache import actors_cache
+
+        extras, version, result = Profile.objects.update_extras(self.pk, mutate)
+
+        if version != self.extras_version:
+            # update() no envía señales.
+            actors_cache.invalidate([self.user_id])
+
+        self.extras = extras
+        self.extras_version = version
+
+        # Los extras guardados ya no cuentan como cambios pendientes.
+        loaded = self.__dict__.setdefault('_loaded_values', {})
+        loaded['extras'] = copy.deepcopy(extras)
+        loaded['extras_version'] = version
+        return result
+
+    def set_extra(self, key, value):
+        """
+        Asigna *value* a la clave *key* de los extras.
+        """
+
+        def mutate(extras):
+            changed = key not in extras or extras[key] != value
+            extras[key] = value
+            return changed, value
+
+        return self._update_extras(mutate)
+
+    def incr_extra(self, key, delta=1):
+        """
+        Suma *delta* a la clave numérica *key* de los extras, que empieza en
+        cero. Retorna el nuevo valor.
+        """
+
+        def mutate(extras):
+            extras[key] = extras.get(key, 0) + delta
+            return bool(delta), extras[key]
+
+        return self._update_extras(mutate)
+
+    def delete_extra(self, key):
+        """
+        Elimina la clave *key* de los extras. Retorna falso si no existía.
+        """
+
+        def mutate(extras):
+            found = key in extras
+            extras.pop(key, None)
+            return found, found
+
+        return self._update_extras(mutate)
+
+    def theme_url(self):
+        """
+        Retorna la url de la hoja de estilo con el diseño del perfil o None
+        si no tiene diseño.
+        """
+
+        if not self.theme_hash:
+            return None
+
+        return reverse('users_theme', args=[self.theme_hash])
+
     def get_absolute_url(self):
         """
         Retorna el path absoluto del perfil.
         """
         
-        return "http://%s.%s" % (self.username, current_site.domain)
+        return profile_url(self.username or self.user.username)
+
+
+class ThumbnailJob(models.Model):
+    """
+    Trabajo pendiente para generar los thumbnails de una imagen de un perfil
+    fuera del ciclo de la petición.
+    """
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    STATUS_CHOICES = (
+        (PENDING, _(u'Pendiente')),
+        (RUNNING, _(u'En proceso')),
+        (DONE, _(u'Terminado')),
+        (FAILED, _(u'Fallido')),
+    )
+
+    #: Perfil al que pertenece la imagen.
+    profile = models.ForeignKey(Profile, related_name='thumbnail_jobs')
+
+    #: Campo del perfil con la imagen a procesar.
+    field = models.CharField(_(u'Campo'), max_length=50, default='image')
+
+    #: Nombre de la imagen cuando se creó el trabajo.
+    source = models.CharField(_(u'Imagen'), max_length=5120)
+
+    #: Estado del trabajo.
+    status = models.CharField(_(u'Estado'), max_length=10, choices=STATUS_CHOICES,
+                                                          default=PENDING,
+                                                          db_index=True)
+
+    #: Número de intentos realizados.
+    attempts = models.PositiveIntegerField(_(u'Intentos'), default=0)
+
+    #: Fecha a partir de la cual se puede ejecutar el trabajo.
+    run_after = models.DateTimeField(_(u'Ejecutar después de'), default=datetime.now,
+                                                               db_index=True)
+
+    #: Fecha en la que un worker tomó el trabajo.
+    locked_at = models.DateTimeField(_(u'Tomado en'), blank=True, null=True)
+
+    #: Último error registrado.
+    last_error = models.TextField(_(u'Último error'), blank=True, default='')
+
+    #: Fecha de creación.
+    created_at = models.DateTimeField(_(u'Creado en'), auto_now_add=True)
+
+    class Meta:
+        ordering = ('created_at', )
+
+    def __unicode__(self):
+        return u'%s:%s (%s)' % (self.profile_id, self.field, self.status)
+
+
+class OutboxMail(models.Model):
+    """
+    Email pendiente de envío. Los emails se guardan en la misma transacción
+    que los genera y un worker los envía después.
+    """
+
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+
+    STATUS_CHOICES = (
+        (PENDING, _(u'Pendiente')),
+        (SENDING, _(u'Enviando')),
+        (SENT, _(u'Enviado')),
+        (FAILED, _(u'Fallido')),
+    )
+
+    #: Destinatario.
+    to_email = models.EmailField(_(u'Para'), max_length=254)
+
+    #: Remitente.
+    from_email = models.CharField(_(u'De'), max_length=255)
+
+    #: Asunto.
+    subject = models.CharField(_(u'Asunto'), max_length=255)
+
+    #: Cuerpo en texto plano.
+    body = models.TextField(_(u'Mensaje'))
+
+    #: Cuerpo en html.
+    html_body = models.TextField(_(u'Mensaje html'), blank=True, default='')
+
+    #: Estado del envío.
+    status = models.CharField(_(u'Estado'), max_length=10, choices=STATUS_CHOICES,
+                                                          default=PENDING,
+                                                          db_index=True)
+
+    #: Número de intentos realizados.
+    attempts = models.PositiveIntegerField(_(u'Intentos'), default=0)
+
+    #: Fecha a partir de la cual se puede enviar.
+    run_after = models.DateTimeField(_(u'Enviar después de'), default=datetime.now,
+                                                             db_index=True)
+
+    #: Identificador del lote del worker que tomó el email.
+    locked_by = models.CharField(_(u'Tomado por'), max_length=32, blank=True,
+                                                                 default='',
+                                                                 db_index=True)
+
+    #: Fecha en la que un worker tomó el email.
+    locked_at = models.DateTimeField(_(u'Tomado en'), blank=True, null=True)
+
+    #: Último error registrado.
+    last_error = models.TextField(_(u'Último error'), blank=True, default='')
+
+    #: Fecha de creación.
+    created_at = models.DateTimeField(_(u'Creado en'), auto_now_add=True)
+
+    #: Fecha de envío.
+    sent_at = models.DateTimeField(_(u'Enviado en'), blank=True, null=True)
+
+    class Meta:
+        ordering = ('created_at', )
+
+    def __unicode__(self):
+        return u'%s: %s (%s)' % (self.to_email, self.subject, self.status)
+
+
+# Django registra los modelos al importar este módulo, es el momento en que
+# la aplicación está lista para conectar sus listeners.
+connect_signals()
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Mandla Web Studio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+__author__ = 'Jose Maria Zambrana Arze'
+__email__ = 'contact@josezambrana.com'
+__version__ = '0.1'
+__copyright__ = 'Copyright 2012, Mandla Web Studio'
+
+
+import os
+import uuid
+import logging
+import threading
+import traceback
+
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import F
+from django.core.mail import get_connection
+from django.core.mail import EmailMultiAlternatives
+from django.core.exceptions import ImproperlyConfigured
+
+from users.models import OutboxMail
+from users.tasks import get_worker
+
+
+#: Número de emails que se envían por cada conexión SMTP.
+OUTBOX_BATCH_SIZE = getattr(settings, 'USERS_OUTBOX_BATCH_SIZE', 50)
+
+#: Número máximo de conexiones SMTP simultáneas.
+OUTBOX_MAX_WORKERS = getattr(settings, 'USERS_OUTBOX_MAX_WORKERS', 2)
+
+#: Número máximo de intentos de envío de un email.
+OUTBOX_MAX_ATTEMPTS = getattr(settings, 'USERS_OUTBOX_MAX_ATTEMPTS', 5)
+
+#: Segundos de espera antes del primer reintento, se duplica en cada intento.
+OUTBOX_RETRY_DELAY = getattr(settings, 'USERS_OUTBOX_RETRY_DELAY', 60)
+
+#: Segundos después de los cuales un lote tomado se considera abandonado.
+OUTBOX_LOCK_TIMEOUT = getattr(settings, 'USERS_OUTBOX_LOCK_TIMEOUT', 600)
+
+
+def outbox_worker_mode():
+    """
+    Retorna cómo se envían los emails: 'thread' con un worker en memoria
+    dentro del mismo proceso, o None si lo hace un proceso externo con el
+    comando users_outbox_worker.
+    """
+
+    return getattr(settings, 'USERS_OUTBOX_WORKER', 'thread')
+
+
+def enqueue_mail(emails, subject, plain_template, html_template,
+                 from_email=None, wake=True, **context):
+    """
+    Renderiza el email y lo guarda en la bandeja de salida, uno por cada
+    destinatario de *emails*. Retorna la lista de emails creados. Con *wake*
+    falso no se despierta al worker en memoria, por ejemplo cuando los
+    emails se guardan dentro de una transacción que aún no termina.
+    """
+
+    from common.mail import Mailer, SITE_FROM_EMAIL
+
+    if isinstance(emails, basestring):
+        emails = [emails]
+
+    from_email = from_email or SITE_FROM_EMAIL
+    if from_email is None:
+        raise ImproperlyConfigured(u'Se necesita definir una dirección de '
+                                   u'email del sitio.')
+
+    body = Mailer._render(plain_template, **context)
+    html_body = Mailer._render(html_template, **context)
+
+    mails = []
+    for email in emails:
+        mail = OutboxMail.objects.create(to_email=email,
+                                         from_email=from_email,
+                                         subject=unicode(subject),
+                                         body=body,
+                                         html_body=html_body)
+        mails.append(mail)
+
+    if wake and outbox_worker_mode() == 'thread':
+        outbox_worker().wake()
+
+    return mails
+
+
+def requeue_stale_mails():
+    """
+    Vuelve a encolar los emails tomados por workers que no terminaron.
+    """
+
+    limit = datetime.now() - timedelta(seconds=OUTBOX_LOCK_TIMEOUT)
+    stale = OutboxMail.objects.filter(status=OutboxMail.SENDING,
+                                      locked_at__lt=limit)
+    return stale.update(status=OutboxMail.PENDING, locked_by='', locked_at=None)
+
+
+def claim_batch(size=OUTBOX_BATCH_SIZE):
+    """
+    Toma un lote de hasta *size* emails pendientes para este worker.
+    """
+
+    now = datetime.now()
+    pending = OutboxMail.objects.filter(status=OutboxMail.PENDING,
+                                        run_after__lte=now)
+    ids = list(pending.values_list('id', flat=True)[:size])
+
+    if not ids:
+        return []
+
+    # Solo nos quedamos con los que ningún otro worker tomó.
+    token = uuid.uuid4().hex
+    claimed = OutboxMail.objects.filter(pk__in=ids, status=OutboxMail.PENDING)
+    claimed.update(status=OutboxMail.SENDING, locked_by=token, locked_at=now,
+                   attempts=F('attempts') + 1)
+
+    return list(OutboxMail.objects.filter(locked_by=token,
+                                          status=OutboxMail.SENDING))
+
+
+def mail_failed(mail, error):
+    """
+    Registra el error de envío y programa el reintento con una espera
+    exponencial hasta agotar los intentos.
+    """
+
+    logging.error('ERROR: outbox mail %s: %s' % (mail.pk, error))
+
+    mail.last_error = traceback.format_exc()
+    mail.locked_by = ''
+    mail.locked_at = None
+
+    if mail.attempts >= OUTBOX_MAX_ATTEMPTS:
+        mail.status = OutboxMail.FAILED
+    else:
+        delay = OUTBOX_RETRY_DELAY * (2 ** (mail.attempts - 1))
+        mail.status = OutboxMail.PENDING
+        mail.run_after = datetime.now() + timedelta(seconds=delay)
+
+    mail.save()
+
+
+def send_batch(mails, **connection_kwargs):
+    """
+    Envía los emails de *mails* usando una sola conexión SMTP. Retorna el
+    número de emails enviados.
+    """
+
+    try:
+        smtp = get_connection(**connection_kwargs)
+        smtp.open()
+    except Exception, e:
+        for mail in mails:
+            mail_failed(mail, e)
+        return 0
+
+    sent = 0
+    try:
+        for mail in mails:
+            message = EmailMultiAlternatives(mail.subject, mail.body,
+                                             mail.from_email, [mail.to_email],
+                                             connection=smtp)
+            if mail.html_body:
+                message.attach_alternative(mail.html_body, 'text/html')
+
+            try:
+                message.send()
+            except Exception, e:
+                mail_failed(mail, e)
+                continue
+
+            mail.status = OutboxMail.SENT
+            mail.sent_at = datetime.now()
+            mail.locked_by = ''
+            mail.last_error = ''
+            mail.save()
+            sent += 1
+    finally:
+        smtp.close()
+
+    return sent
+
+
+def _drain(batch_size, connection_kwargs, results, close_connection=True):
+    """
+    Envía lotes hasta vaciar la bandeja de salida. Se ejecuta en cada hilo de
+    *drain_outbox*.
+    """
+
+    sent = 0
+
+    try:
+        while True:
+            mails = claim_batch(batch_size)
+            if not mails:
+                break
+            sent += send_batch(mails, **connection_kwargs)
+    finally:
+        results.append(sent)
+
+        # Cada hilo tiene su propia conexión a la base de datos.
+        if close_connection:
+            connection.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(size):
+    """
+    Retorna el pool de *size* hilos de este proceso para enviar emails,
+    creándolo la primera vez. Se crea uno nuevo después de un fork.
+    """
+
+    key = (size, os.getpid())
+
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ThreadPool(size)
+            _pools[key] = pool
+
+    return pool
+
+
+def drain_outbox(batch_size=OUTBOX_BATCH_SIZE, workers=OUTBOX_MAX_WORKERS,
+                 **connection_kwargs):
+    """
+    Envía todos los emails pendientes con a lo sumo *workers* conexiones SMTP
+    simultáneas, cada una enviando lotes de *batch_size* emails. Los hilos
+    de un mismo proceso se reutilizan entre llamadas. Los argumentos
+    adicionales se pasan a *get_connection*, por ejemplo host y port para
+    probar con un servidor SMTP local de depuración::
+
+        python -m smtpd -n -c DebuggingServer localhost:1025
+
+    Retorna el número de emails enviados.
+    """
+
+    requeue_stale_mails()
+
+    results = []
+
+    if workers <= 1:
+        _drain(batch_size, connection_kwargs, results, close_connection=False)
+        return sum(results)
+
+    get_pool(workers).map(lambda index: _drain(batch_size, connection_kwargs,
+                                               results),
+                          range(workers))
+
+    return sum(results)
+
+
+def outbox_worker():
+    return get_worker('users-outbox', drain_outbox)
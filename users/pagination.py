@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Mandla Web Studio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+__author__ = 'Jose Maria Zambrana Arze'
+__email__ = 'contact@josezambrana.com'
+__version__ = '0.1'
+__copyright__ = 'Copyright 2012, Mandla Web Studio'
+
+
+import base64
+import binascii
+
+from datetime import datetime
+
+from django.http import Http404
+from django.db.models import Q
+from django.core.exceptions import ValidationError
+from django.utils import simplejson as json
+
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(values):
+    """
+    Codifica los valores de la clave de ordenamiento en un token opaco.
+    """
+
+    data = []
+    for value in values:
+        if isinstance(value, datetime):
+            value = 'd:%s' % value.strftime(DATETIME_FORMAT)
+        data.append(value)
+
+    return base64.urlsafe_b64encode(json.dumps(data)).rstrip('=')
+
+
+def decode_cursor(token):
+    """
+    Decodifica un token generado con *encode_cursor*. Lanza ValueError si el
+    token no es válido.
+    """
+
+    try:
+        token = str(token)
+        token += '=' * (-len(token) % 4)
+        data = json.loads(base64.urlsafe_b64decode(token))
+    except (TypeError, UnicodeError, binascii.Error):
+        raise ValueError('Invalid cursor: %s' % token)
+
+    if not isinstance(data, list):
+        raise ValueError('Invalid cursor: %s' % token)
+
+    values = []
+    for value in data:
+        if isinstance(value, basestring) and value.startswith('d:'):
+            value = datetime.strptime(value[2:], DATETIME_FORMAT)
+        values.append(value)
+
+    return values
+
+
+def clean_cursor(model, fields, values):
+    """
+    Retorna *values* convertidos a los tipos de los campos *fields* de
+    *model*. Lanza ValueError si no hay un valor por campo o si alguno no es
+    válido para su campo.
+    """
+
+    if len(values) != len(fields):
+        raise ValueError('Invalid cursor: %s values for %s fields' % (
+                         len(values), len(fields)))
+
+    cleaned = []
+    for name, value in zip(fields, values):
+        field = model._meta.get_field(name)
+        if value is None or isinstance(value, (list, dict)):
+            raise ValueError('Invalid cursor value for %s: %r' % (name, value))
+
+        try:
+            cleaned.append(field.to_python(value))
+        except (TypeError, ValidationError):
+            raise ValueError('Invalid cursor value for %s: %r' % (name, value))
+
+    return cleaned
+
+
+def seek_filter(fields, values, reverse=False):
+    """
+    Retorna el filtro que selecciona las filas que estan después (o antes si
+    *reverse* es verdadero) de *values* en un orden descendente por *fields*.
+    """
+
+    lookup = 'gt' if reverse else 'lt'
+    condition = None
+    equal = {}
+
+    for field, value in zip(fields, values):
+        filters = dict(equal)
+        filters['%s__%s' % (field, lookup)] = value
+
+        if condition is None:
+            condition = Q(**filters)
+        else:
+            condition = condition | Q(**filters)
+
+        equal[field] = value
+
+    return condition
+
+
+class CursorPage(object):
+    """
+    Página de resultados obtenida con paginación por cursor.
+    """
+
+    def __init__(self, rows, fields, order, has_next, has_previous):
+        self.rows = rows
+        self.fields = fields
+        self.order = order
+        self.has_next = has_next
+        self.has_previous = has_previous
+
+    def cursor_for(self, row):
+        return encode_cursor([getattr(row, field) for field in self.fields])
+
+    @property
+    def next_cursor(self):
+        if self.has_next and self.rows:
+            return self.cursor_for(self.rows[-1])
+
+        return None
+
+    @property
+    def previous_cursor(self):
+        if self.has_previous and self.rows:
+            return self.cursor_for(self.rows[0])
+
+        return None
+
+
+class CursorPaginationMixin(object):
+    """
+    Mixin para vistas de listas que pagina buscando sobre una clave indexada
+    (keyset) en lugar de usar OFFSET y COUNT(*), así el costo de una página es
+    el mismo sin importar su profundidad.
+
+    Las páginas se navegan con los parámetros ``after`` y ``before`` que
+    contienen tokens opacos y el orden se elige con ``order``.
+    """
+
+    #: Activa la paginación por cursor para todas las peticiones.
+    cursor_pagination = False
+
+    #: Número de objetos por página.
+    cursor_per_page = 50
+
+    #: Ordenamientos permitidos. Cada uno es una tupla de campos que se ordenan
+    #: de forma descendente, el último debe ser único (ej. el id).
+    cursor_orderings = {
+        'recent': ('id', ),
+    }
+
+    #: Ordenamiento por defecto.
+    default_cursor_ordering = 'recent'
+
+    def is_cursor_mode(self):
+        """
+        Retorna verdadero si la petición se tiene que paginar por cursor.
+        """
+
+        params = self.request.GET
+        return self.cursor_pagination or 'after' in params or \
+               'before' in params or 'order' in params
+
+    def get_cursor_ordering(self):
+        """
+        Retorna el nombre y los campos del ordenamiento solicitado.
+        """
+
+        order = self.request.GET.get('order', self.default_cursor_ordering)
+
+        if order not in self.cursor_orderings:
+            raise Http404(u'Orden inválido: %s' % order)
+
+        return order, self.cursor_orderings[order]
+
+    def get_cursor_queryset(self):
+        """
+        Retorna el queryset sobre el que se aplica la paginación.
+        """
+
+        return super(CursorPaginationMixin, self).get_queryset()
+
+    def get_cursor_objects(self, rows):
+        """
+        Convierte las filas de la página en la lista de objetos de la vista.
+        """
+
+        return rows
+
+    def paginate_cursor(self):
+        """
+        Retorna la página solicitada.
+        """
+
+        order, fields = self.get_cursor_ordering()
+        per_page = self.cursor_per_page
+        queryset = self.get_cursor_queryset()
+
+        after = self.request.GET.get('after')
+        before = self.request.GET.get('before')
+
+        try:
+            if before:
+                values = clean_cursor(queryset.model, fields, decode_cursor(before))
+                queryset = queryset.filter(seek_filter(fields, values, reverse=True))
+                queryset = queryset.order_by(*fields)
+            else:
+                if after:
+                    values = clean_cursor(queryset.model, fields, decode_cursor(after))
+                    queryset = queryset.filter(seek_filter(fields, values))
+                queryset = queryset.order_by(*['-%s' % field for field in fields])
+        except ValueError:
+            raise Http404(u'Cursor inválido')
+
+        rows = list(queryset[:per_page + 1])
+        has_more = len(rows) > per_page
+        rows = rows[:per_page]
+
+        if before:
+            rows.reverse()
+            return CursorPage(rows, fields, order, True, has_more)
+
+        return CursorPage(rows, fields, order, has_more, bool(after))
+
+    def get_queryset(self):
+        if not self.is_cursor_mode():
+            return super(CursorPaginationMixin, self).get_queryset()
+
+        self.cursor_page = self.paginate_cursor()
+        return self.get_cursor_objects(self.cursor_page.rows)
+
+    def get_paginate_by(self, queryset):
+        if self.is_cursor_mode():
+            return None
+
+        return super(CursorPaginationMixin, self).get_paginate_by(queryset)
+
+    def get_context_data(self, **kwargs):
+        context = super(CursorPaginationMixin, self).get_context_data(**kwargs)
+        context['cursor_page'] = getattr(self, 'cursor_page', None)
+        return context
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Mandla Web Studio
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+__author__ = 'Jose Maria Zambrana Arze'
+__email__ = 'contact@josezambrana.com'
+__version__ = '0.1'
+__copyright__ = 'Copyright 2012, Mandla Web Studio'
+
+
+import re
+import logging
+import sqlite3
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+#: Archivo SQLite con el índice de búsqueda de perfiles. Si es None la
+#: búsqueda está desactivada: el índice no se actualiza y el listado ignora
+#: ?q=.
+SEARCH_PATH = getattr(settings, 'USERS_SEARCH_PATH', None)
+
+#: Número máximo de palabras que se consideran de una búsqueda.
+SEARCH_MAX_TERMS = getattr(settings, 'USERS_SEARCH_MAX_TERMS', 6)
+
+#: Campos del perfil que se indexan, en orden de importancia.
+SEARCH_FIELDS = ('username', 'first_name', 'last_name', 'description')
+
+#: Peso de cada campo en el ranking bm25.
+SEARCH_WEIGHTS = (10.0, 5.0, 5.0, 1.0)
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+class SearchIndex(object):
+    """
+    Índice de búsqueda de texto completo de los perfiles en un archivo SQLite
+    aparte con FTS5 (o FTS4 si la versión de SQLite no lo soporta). Cubre el
+    nombre de usuario, nombre, apellidos y descripción; las búsquedas son por
+    prefijo de cada palabra y se ordenan con bm25 dando más peso al nombre de
+    usuario. Con FTS4 los resultados se ordenan del perfil más reciente al
+    más antiguo.
+
+    El índice se actualiza con las señales de Profile y User y se reconstruye
+    con el comando users_reindex_search. Cada hilo usa su propia conexión.
+    Sin *path* el índice está desactivado.
+    """
+
+    table = 'profiles'
+
+    def __init__(self, path=SEARCH_PATH):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def connection(self):
+        """
+        Retorna la conexión de este hilo, creando la tabla si no existe.
+        """
+
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and getattr(self._local, 'path', None) == self.path:
+            return conn
+
+        if not self.enabled:
+            raise ImproperlyConfigured(u'Se necesita definir la ruta del índice '
+                                       u'de búsqueda en USERS_SEARCH_PATH.')
+
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        self._local.conn = conn
+        self._local.path = self.path
+        self._local.engine = self.create_table(conn)
+        return conn
+
+    @property
+    def engine(self):
+        self.connection()
+        return self._local.engine
+
+    def create_table(self, conn):
+        """
+        Crea la tabla virtual con la mejor extensión disponible. Retorna
+        'fts5' o 'fts4'.
+        """
+
+        row = conn.execute("SELECT sql FROM sqlite_master WHERE name = ?",
+                           (self.table, )).fetchone()
+        if row is not None:
+            return 'fts5' if 'fts5' in row[0].lower() else 'fts4'
+
+        columns = ', '.join(SEARCH_FIELDS)
+        statements = (
+            ('fts5', "CREATE VIRTUAL TABLE %s USING fts5(%s, "
+                     "tokenize='unicode61 remove_diacritics 1', prefix='2 3')"),
+            ('fts4', "CREATE VIRTUAL TABLE %s USING fts4(%s, "
+                     "tokenize=unicode61, prefix=\"2,3\")"),
+            ('fts4', "CREATE VIRTUAL TABLE %s USING fts4(%s, prefix=\"2,3\")"),
+        )
+
+        for engine, sql in statements:
+            try:
+                conn.execute(sql % (self.table, columns))
+                return engine
+            except sqlite3.OperationalError:
+                continue
+
+        raise sqlite3.OperationalError('SQLite has no FTS5 or FTS4 support')
+
+    def rows(self, profiles):
+        """
+        Retorna las filas del índice de los perfiles *profiles*, una lista de
+        tuplas (id, username, first_name, last_name, description).
+        """
+
+        return [(profile.pk, ) + tuple(getattr(profile, field) or u''
+                                       for field in SEARCH_FIELDS)
+                for profile in profiles]
+
+    def index_rows(self, rows):
+        """
+        Agrega o reemplaza en el índice las filas *rows*.
+        """
+
+        if not rows:
+            return
+
+        conn = self.connection()
+        placeholders = ', '.join(['?'] * (len(SEARCH_FIELDS) + 1))
+
+        conn.execute('BEGIN')
+        try:
+            conn.executemany('DELETE FROM %s WHERE rowid = ?' % self.table,
+                             [(row[0], ) for row in rows])
+            conn.executemany('INSERT INTO %s (rowid, %s) VALUES (%s)' % (
+                             self.table, ', '.join(SEARCH_FIELDS), placeholders), rows)
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+
+    def update(self, profiles):
+        """
+        Actualiza en el índice los perfiles *profiles*.
+        """
+
+        self.index_rows(self.rows(profiles))
+
+    def remove(self, ids):
+        """
+        Elimina del índice los perfiles de *ids*.
+        """
+
+        conn = self.connection()
+        conn.executemany('DELETE FROM %s WHERE rowid = ?' % self.table,
+                         [(profile_id, ) for profile_id in ids])
+
+    def clear(self):
+        """
+        Elimina el índice, se vuelve a crear vacío en el siguiente uso.
+        """
+
+        conn = self.connection()
+        conn.execute('DROP TABLE IF EXISTS %s' % self.table)
+        self._local.engine = self.create_table(conn)
+
+    def match_expression(self, query):
+        """
+        Retorna la expresión MATCH de *query*: todas las palabras deben
+        aparecer como prefijo de alguna palabra del perfil.
+        """
+
+        terms = WORD_RE.findall(query.lower())[:SEARCH_MAX_TERMS]
+        return u' '.join(u'%s*' % term for term in terms)
+
+    def search(self, query, limit=50, offset=0):
+        """
+        Retorna los ids de los perfiles que coinciden con *query* ordenados
+        por relevancia, y si hay más resultados después de esta página.
+        """
+
+        expression = self.match_expression(query)
+        if not expression:
+            return [], False
+
+        if self.engine == 'fts5':
+            order = 'bm25(%s, %s)' % (self.table, ', '.join(map(str, SEARCH_WEIGHTS)))
+        else:
+            order = 'rowid DESC'
+
+        sql = 'SELECT rowid FROM %s WHERE %s MATCH ? ORDER BY %s LIMIT ? OFFSET ?' % (
+              self.table, self.table, order)
+
+        try:
+            rows = self.connection().execute(sql, (expression, limit + 1, offset))
+            ids = [row[0] for row in rows]
+        except sqlite3.OperationalError, e:
+            logging.error('ERROR: users search "%s": %s' % (query, e))
+            return [], False
+
+        return ids[:limit], len(ids) > limit
+
+
+class SearchPage(object):
+    """
+    Página de resultados de una búsqueda.
+    """
+
+    def __init__(self, query, number, has_next):
+        self.query = query
+        self.number = number
+        self.has_next = has_next
+        self.has_previous = number > 1
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
+
+
+#: Índice de búsqueda utilizado por UsersIndex.
+search_index = SearchIndex()
+
+
+def update_search_index(profiles):
+    """
+    Actualiza los perfiles en el índice de búsqueda sin interrumpir a quien
+    los guardó si el índice falla o está desactivado.
+    """
+
+    if not search_index.enabled:
+        return
+
+    try:
+        search_index.update(profiles)
+    except sqlite3.Error, e:
+        logging.error('ERROR: users search index: %s' % e)
+
+
+def remove_from_search_index(ids):
+    if not search_index.enabled:
+        return
+
+    try:
+        search_index.remove(ids)
+    except sqlite3.Error, e:
+        logging.error('ERROR: users search index: %s' % e)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Mandla Web Studio
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+__author__ = 'Jose Maria Zambrana Arze'
+__email__ = 'contact@josezambrana.com'
+__version__ = '0.1'
+__copyright__ = 'Copyright 2012, Mandla Web Studio'
+
+
+import threading
+
+from time import time
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.contrib.sites.models import Site
+
+
+#: Alias del cache compartido (settings.CACHES) donde se guarda la versión de
+#: los sitios, para que todos los procesos vean las modificaciones.
+SITES_CACHE_BACKEND = getattr(settings, 'USERS_SITES_CACHE_BACKEND', 'default')
+
+#: Cada cuántos segundos un proceso compara su versión de los sitios con la
+#: del cache compartido.
+SITES_CHECK_INTERVAL = getattr(settings, 'USERS_SITES_CHECK_INTERVAL', 30)
+
+#: Clave de la versión de los sitios en el cache compartido.
+SITES_VERSION_KEY = 'users:sites:version'
+
+#: Tiempo de vida en segundos de la versión en el cache compartido. Si se
+#: pierde, los procesos recargan los sitios una vez más.
+SITES_VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+_sites_by_domain = {}
+_sites_by_id = {}
+_sites_state = {'version': None, 'checked': 0}
+_sites_lock = threading.Lock()
+
+
+def get_sites_version():
+    return get_cache(SITES_CACHE_BACKEND).get(SITES_VERSION_KEY)
+
+
+def check_sites_version():
+    """
+    Descarta los sitios de este proceso si otro proceso los modificó. La
+    versión compartida se consulta como mucho cada SITES_CHECK_INTERVAL
+    segundos.
+    """
+
+    now = time()
+    if now - _sites_state['checked'] < SITES_CHECK_INTERVAL:
+        return
+
+    _sites_state['checked'] = now
+    if get_sites_version() != _sites_state['version']:
+        clear_site_cache()
+
+
+def load_sites():
+    """
+    Carga todos los sitios con una sola consulta la primera vez que se
+    necesitan o cuando cambia su versión en el cache compartido.
+    """
+
+    check_sites_version()
+
+    if not _sites_by_id:
+        with _sites_lock:
+            if not _sites_by_id:
+                version = get_sites_version()
+                sites = list(Site.objects.all())
+                _sites_by_domain.update((site.domain.lower(), site) for site in sites)
+                _sites_by_id.update((site.pk, site) for site in sites)
+                _sites_state['version'] = version
+                _sites_state['checked'] = time()
+
+
+def get_default_site():
+    """
+    Retorna el sitio de settings.SITE_ID.
+    """
+
+    load_sites()
+
+    try:
+        return _sites_by_id[settings.SITE_ID]
+    except KeyError:
+        raise Site.DoesNotExist(u'There is no site with id %s' % settings.SITE_ID)
+
+
+def get_site_by_host(host):
+    """
+    Retorna el sitio cuyo dominio es *host* o el de alguno de sus dominios
+    padre (los perfiles están en <username>.<dominio>), o el sitio por
+    defecto si ninguno coincide.
+    """
+
+    load_sites()
+    host = host.lower()
+
+    candidates = [host]
+    if ':' in host:
+        candidates.append(host.split(':')[0])
+
+    labels = candidates[-1].split('.')
+    candidates.extend('.'.join(labels[index:]) for index in range(1, len(labels) - 1))
+
+    for candidate in candidates:
+        if candidate in _sites_by_domain:
+            return _sites_by_domain[candidate]
+
+    return get_default_site()
+
+
+def get_current_site(request=None):
+    """
+    Retorna el sitio actual: el que corresponde al host de *request* o el de
+    settings.SITE_ID si no hay una petición. A diferencia de
+    Site.objects.get_current() no consulta la base de datos al importar los
+    módulos y los sitios se invalidan cuando se modifican.
+    """
+
+    if request is not None:
+        return get_site_by_host(request.get_host())
+
+    return get_default_site()
+
+
+def clear_site_cache():
+    with _sites_lock:
+        _sites_by_domain.clear()
+        _sites_by_id.clear()
+
+
+def invalidate_sites(sender, *args, **kwargs):
+    """
+    Descarta los sitios guardados cuando se modifica algún sitio y cambia su
+    versión en el cache compartido, así los demás procesos los vuelven a
+    cargar en menos de SITES_CHECK_INTERVAL segundos. Se conecta en
+    *users.listeners.connect_signals*.
+    """
+
+    get_cache(SITES_CACHE_BACKEND).set(SITES_VERSION_KEY, uuid4().hex,
+                                       SITES_VERSION_TIMEOUT)
+    clear_site_cache()
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Mandla Web Studio
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+__author__ = 'Jose Maria Zambrana Arze'
+__email__ = 'contact@josezambrana.com'
+__version__ = '0.1'
+__copyright__ = 'Copyright 2012, Mandla Web Studio'
+
+
+from django.conf import settings
+from django.conf.urls.defaults import *
+
+from users.views import UsersProfile
+
+
+# Urls de los subdominios de los usuarios, ver SubdomainProfileMiddleware.
+urlpatterns = patterns('',
+    url(r'^$', UsersProfile.as_view(), name='users_subdomain_profile'),
+    url(r'', include(settings.ROOT_URLCONF)),
+)
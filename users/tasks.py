@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Mandla Web Studio
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+__author__ = 'Jose Maria Zambrana Arze'
+__email__ = 'contact@josezambrana.com'
+__version__ = '0.1'
+__copyright__ = 'Copyright 2012, Mandla Web Studio'
+
+
+import os
+import logging
+import threading
+import traceback
+
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import F
+
+from users.models import ThumbnailJob
+
+
+#: Número máximo de intentos de un trabajo antes de marcarlo como fallido.
+JOBS_MAX_ATTEMPTS = getattr(settings, 'USERS_JOBS_MAX_ATTEMPTS', 5)
+
+#: Segundos de espera antes del primer reintento, se duplica en cada intento.
+JOBS_RETRY_DELAY = getattr(settings, 'USERS_JOBS_RETRY_DELAY', 30)
+
+#: Segundos después de los cuales un trabajo tomado se considera abandonado.
+JOBS_LOCK_TIMEOUT = getattr(settings, 'USERS_JOBS_LOCK_TIMEOUT', 600)
+
+#: Segundos entre cada revisión de la cola del worker en memoria.
+JOBS_POLL_INTERVAL = getattr(settings, 'USERS_JOBS_POLL_INTERVAL', 5)
+
+
+def thumbnails_worker_mode():
+    """
+    Retorna cómo se procesan los thumbnails: 'thread' (por defecto) con un
+    worker en memoria dentro del mismo proceso, o None si lo hace un proceso
+    externo con el comando users_thumbnails_worker.
+    """
+
+    return getattr(settings, 'USERS_THUMBNAILS_WORKER', 'thread')
+
+
+def get_handlers():
+    """
+    Retorna las funciones que procesan los trabajos según el campo.
+    """
+
+    from users.avatars import publish_thumbnails
+    from users.backgrounds import publish_backgrounds
+
+    return {
+        'image': publish_thumbnails,
+        'background': publish_backgrounds,
+    }
+
+
+def enqueue_thumbnails(profile, field='image', wake=True):
+    """
+    Crea el trabajo para generar los thumbnails del campo *field* de
+    *profile*. Si ya existe un trabajo pendiente para la misma imagen se
+    retorna ese.
+    """
+
+    source = getattr(profile, field).name
+
+    pending = ThumbnailJob.objects.filter(profile=profile, field=field,
+                                          source=source,
+                                          status=ThumbnailJob.PENDING)
+    try:
+        job = pending[0]
+    except IndexError:
+        job = ThumbnailJob.objects.create(profile=profile, field=field,
+                                          source=source)
+
+    if wake and thumbnails_worker_mode() == 'thread':
+        thumbnails_worker().wake()
+
+    return job
+
+
+def requeue_stale_jobs():
+    """
+    Vuelve a encolar los trabajos tomados por workers que no terminaron.
+    """
+
+    limit = datetime.now() - timedelta(seconds=JOBS_LOCK_TIMEOUT)
+    stale = ThumbnailJob.objects.filter(status=ThumbnailJob.RUNNING,
+                                        locked_at__lt=limit)
+    return stale.update(status=ThumbnailJob.PENDING, locked_at=None)
+
+
+def claim_job(job):
+    """
+    Toma el trabajo *job* para este worker. Retorna falso si otro worker lo
+    tomó primero.
+    """
+
+    now = datetime.now()
+    claimed = ThumbnailJob.objects.filter(pk=job.pk, status=ThumbnailJob.PENDING)
+    claimed = claimed.update(status=ThumbnailJob.RUNNING, locked_at=now,
+                             attempts=F('attempts') + 1)
+
+    if claimed:
+        job.status = ThumbnailJob.RUNNING
+        job.locked_at = now
+        job.attempts += 1
+
+    return bool(claimed)
+
+
+def run_job(job):
+    """
+    Ejecuta el trabajo *job*. Si falla se reintenta más tarde con una espera
+    exponencial hasta agotar los intentos.
+    """
+
+    handler = get_handlers().get(job.field)
+
+    try:
+        if handler is None:
+            raise ValueError('There is no handler for %s' % job.field)
+
+        handler(job)
+    except Exception, e:
+        logging.error('ERROR: thumbnail job %s: %s' % (job.pk, e))
+
+        job.last_error = traceback.format_exc()
+        job.locked_at = None
+
+        if job.attempts >= JOBS_MAX_ATTEMPTS:
+            job.status = ThumbnailJob.FAILED
+        else:
+            delay = JOBS_RETRY_DELAY * (2 ** (job.attempts - 1))
+            job.status = ThumbnailJob.PENDING
+            job.run_after = datetime.now() + timedelta(seconds=delay)
+
+        job.save()
+        return False
+
+    job.status = ThumbnailJob.DONE
+    job.last_error = ''
+    job.save()
+    return True
+
+
+def pending_jobs():
+    """
+    Retorna los trabajos listos para ejecutarse.
+    """
+
+    return ThumbnailJob.objects.filter(status=ThumbnailJob.PENDING,
+                                       run_after__lte=datetime.now())
+
+
+def run_pending_jobs(limit=None):
+    """
+    Procesa los trabajos pendientes. Retorna el número de trabajos procesados.
+    """
+
+    requeue_stale_jobs()
+
+    jobs = pending_jobs()
+    if limit is not None:
+        jobs = jobs[:limit]
+
+    processed = 0
+    for job in list(jobs):
+        if claim_job(job):
+            run_job(job)
+            processed += 1
+
+    return processed
+
+
+def _drain_jobs(index):
+    """
+    Procesa trabajos hasta vaciar la cola. Se ejecuta en cada proceso del
+    pool de *run_jobs_in_pool*.
+    """
+
+    processed = 0
+
+    while True:
+        count = run_pending_jobs(limit=20)
+        processed += count
+
+        # Si otros procesos tomaron todo el lote seguimos mientras haya
+        # trabajos pendientes.
+        if not count and not pending_jobs().exists():
+            break
+
+    connection.close()
+    return processed
+
+
+def run_jobs_in_pool(workers=1):
+    """
+    Procesa la cola de trabajos repartiéndola entre *workers* procesos. Los
+    procesos compiten por los trabajos con *claim_job*, así ninguno se procesa
+    dos veces. Retorna el número de trabajos procesados.
+    """
+
+    if workers <= 1:
+        return _drain_jobs(0)
+
+    from multiprocessing import Pool
+
+    # Los procesos hijos no pueden compartir la conexión del padre.
+    connection.close()
+
+    pool = Pool(workers)
+    try:
+        counts = pool.map(_drain_jobs, range(workers))
+    finally:
+        pool.close()
+        pool.join()
+
+    return sum(counts)
+
+
+class BackgroundWorker(threading.Thread):
+    """
+    Worker en memoria que ejecuta *target* en un hilo aparte cada vez que se
+    le despierta o cada *interval* segundos. Permite procesar las colas sin
+    depender de un broker externo.
+    """
+
+    def __init__(self, target, interval=JOBS_POLL_INTERVAL, name=None):
+        super(BackgroundWorker, self).__init__(name=name)
+        self.daemon = True
+        self.target = target
+        self.interval = interval
+        self.event = threading.Event()
+
+    def wake(self):
+        self.event.set()
+
+    def run(self):
+        while True:
+            self.event.wait(self.interval)
+            self.event.clear()
+
+            try:
+                self.target()
+            except Exception, e:
+                logging.error('ERROR: %s: %s' % (self.name, e))
+            finally:
+                # Cada hilo tiene su propia conexión, no la dejamos abierta.
+                connection.close()
+
+
+_workers = {}
+_workers_lock = threading.Lock()
+
+
+def get_worker(name, target):
+    """
+    Retorna el worker en memoria *name* de este proceso iniciándolo si no
+    existe. Se crea uno nuevo después de un fork.
+    """
+
+    key = (name, os.getpid())
+
+    with _workers_lock:
+        worker = _workers.get(key)
+        if worker is None or not worker.is_alive():
+            worker = BackgroundWorker(target, name=name)
+            worker.start()
+            _workers[key] = worker
+
+    return worker
+
+
+def thumbnails_worker():
+    return get_worker('users-thumbnails', run_pending_jobs)
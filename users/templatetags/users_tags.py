@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Mandla Web Studio
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+__author__ = 'Jose Maria Zambrana Arze'
+__email__ = 'contact@josezambrana.com'
+__version__ = '0.1'
+__copyright__ = 'Copyright 2012, Mandla Web Studio'
+
+
+from django import template
+from django.utils.safestring import mark_safe
+
+from users.cards import render_cards
+from users.avatars import avatar_url as get_avatar_url
+from users.backgrounds import background_srcset as get_background_srcset
+from users.utils import profile_url as get_profile_url
+
+
+register = template.Library()
+
+
+@register.filter
+def profile_url(username):
+    """
+    Retorna la url del perfil de *username* en su subdominio::
+
+        <a href="{{ user.username|profile_url }}">...</a>
+    """
+
+    return get_profile_url(username)
+
+
+@register.filter
+def avatar_url(profile, size='s'):
+    """
+    Retorna la url del avatar de tamaño *size* de *profile* sin consultar
+    al storage::
+
+        <img src="{{ user_profile|avatar_url:"m" }}" />
+    """
+
+    return get_avatar_url(profile, size)
+
+
+@register.simple_tag
+def user_cards(profiles, size='s'):
+    """
+    Muestra las tarjetas de los perfiles *profiles* con avatares de tamaño
+    *size*, guardadas en el cache por versión del perfil::
+
+        <ul>{% user_cards object_list "s" %}</ul>
+    """
+
+    return mark_safe(render_cards(profiles, size))
+
+
+@register.filter
+def background_srcset(profile, format='JPEG'):
+    """
+    Retorna el srcset con las variantes de la imagen de fondo de *profile*
+    en el formato *format*::
+
+        <picture>
+            <source type="image/webp" srcset="{{ user_profile|background_srcset:"WEBP" }}" />
+            <img srcset="{{ user_profile|background_srcset }}" sizes="100vw" />
+        </picture>
+    """
+
+    return get_background_srcset(profile, format)
@@ -20,25 +20,136 @@ __version__ = '0.1'
 __copyright__ = 'Copyright 2012, Mandla Web Studio'
 
 
+import os
 import logging
 import re
+import struct
+import tempfile
+from datetime import datetime, timedelta
 from os import path
 
 from django.conf import settings
+from django.db import models
+from django.db.models.signals import post_save
 from django.core import mail
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TransactionTestCase
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
 
 from common.tests import TestBase
 from thumbnails.tests import IMAGE_TEST
 from users.models import Profile
+from users.models import OutboxMail
+from users import outbox
+from users.forms import RegisterForm
+from users.outbox import drain_outbox
+from users.cache import ActorCache
+from users.cache import LRUCache
+from users.cache import UsernameResolver
+from users.cache import actors_cache
+from users.cache import usernames_cache
+from users.managers import ExtrasConflict
+from users.listeners import update_availability
+from users.search import search_index
+from users.utils import normalize_email
 
 
-class TestUsersViews(TestBase):
+def exif_jpeg(data, orientation, make='TestCam'):
+    """
+    Retorna el JPEG *data* con un segmento EXIF con la orientación
+    *orientation* y la marca de cámara *make*, como las fotos de un celular.
+    """
+
+    make = make + '\x00'
+
+    # Cabecera TIFF little endian y un IFD con Make y Orientation.
+    entries = struct.pack('<HHII', 0x010F, 2, len(make), 8 + 2 + 2 * 12 + 4)
+    entries += struct.pack('<HHIHH', 0x0112, 3, 1, orientation, 0)
+    tiff = 'II' + struct.pack('<HI', 42, 8) + struct.pack('<H', 2) + entries
+    tiff += struct.pack('<I', 0) + make
+
+    payload = 'Exif\x00\x00' + tiff
+    segment = '\xff\xe1' + struct.pack('>H', len(payload) + 2) + payload
+
+    # El segmento va después de SOI.
+    return data[:2] + segment + data[2:]
+
+
+class FailingBackend(BaseEmailBackend):
+    """
+    Backend de email que siempre falla, para probar los reintentos.
+    """
+
+    def send_messages(self, messages):
+        raise IOError('SMTP no disponible')
+
+
+def disable_workers():
+    """
+    Desactiva los workers en memoria: en los tests los trabajos en segundo
+    plano se ejecutan explícitamente. Retorna la configuración anterior.
+    """
+
+    old_workers = (getattr(settings, 'USERS_THUMBNAILS_WORKER', 'thread'),
+                   getattr(settings, 'USERS_OUTBOX_WORKER', 'thread'))
+    settings.USERS_THUMBNAILS_WORKER = None
+    settings.USERS_OUTBOX_WORKER = None
+    return old_workers
+
+
+def restore_workers(old_workers):
+    (settings.USERS_THUMBNAILS_WORKER,
+     settings.USERS_OUTBOX_WORKER) = old_workers
+
+
+def temp_search_index():
+    """
+    Apunta el índice de búsqueda a un archivo temporal propio del test.
+    Retorna la ruta anterior y la nueva.
+    """
+
+    fd, name = tempfile.mkstemp(suffix='.sqlite3')
+    os.close(fd)
+    old_path = search_index.path
+    search_index.path = name
+    return old_path, name
+
+
+def restore_search_index(paths):
+    old_path, name = paths
+    search_index.path = old_path
+    if os.path.exists(name):
+        os.remove(name)
+
+
+class UsersTestBase(TestBase):
+    """
+    Base de los tests de la aplicación, sin workers en memoria, con un
+    índice de búsqueda temporal y con los caches del proceso vacíos.
+    """
+
+    def setUp(self):
+        TestBase.setUp(self)
+        self.old_workers = disable_workers()
+        self.search_paths = temp_search_index()
+
+        # Los caches del proceso no deben conservar datos de otros tests.
+        actors_cache.clear()
+        usernames_cache.clear()
+
+    def tearDown(self):
+        restore_search_index(self.search_paths)
+        restore_workers(self.old_workers)
+        TestBase.tearDown(self)
+
+
+class TestUsersViews(UsersTestBase):
     fixtures = ['users'] 
     
     def setUp(self):
-        TestBase.setUp(self)
+        UsersTestBase.setUp(self)
         self.data = {
             "first_name": "Test",
             "last_name": "Fake",
@@ -92,14 +203,85 @@ class TestUsersViews(TestBase):
         # Enviamos la petición para crear un usuario.
         response = self.client_post('users_register', data=self.data)
         assert response.status_code == 302
+
+        # El usuario queda identificado sin volver a verificar la contraseña.
+        user = User.objects.get(username=self.data['username'])
+        self.assertTrue('_auth_user_id' in self.client.session)
+        self.assertEquals(self.client.session['_auth_user_id'], user.pk)
+        self.assertEquals(self.client.session['_auth_user_backend'],
+                          settings.AUTHENTICATION_BACKENDS[0])
         
-        # Verificamos que se envió un mail de bienvenida.
+        # El mail de bienvenida se encola y se envía fuera de la petición.
+        assert mail_count == len(mail.outbox)
+        self.assertEquals(OutboxMail.objects.filter(to_email=self.data['email']).count(), 1)
+
+        self.assertEquals(drain_outbox(workers=1), 1)
         assert (mail_count + 1) == len(mail.outbox)
+        self.assertEquals(mail.outbox[-1].to, [self.data['email']])
 
         # Verificamos que se crea un perfil
         p = Profile.objects.get(user__username=self.data['username'])
         assert p.username == self.data['username']
     
+    def test_outbox_retry(self):
+        """
+        Los emails que no se pueden enviar se reintentan con una espera
+        exponencial hasta agotar los intentos.
+        """
+
+        response = self.client_post('users_register', data=self.data)
+        assert response.status_code == 302
+        outbox_mail = OutboxMail.objects.get(to_email=self.data['email'])
+        backend = 'users.tests.FailingBackend'
+
+        for attempt in range(1, outbox.OUTBOX_MAX_ATTEMPTS + 1):
+            before = datetime.now()
+            self.assertEquals(drain_outbox(workers=1, backend=backend), 0)
+
+            outbox_mail = OutboxMail.objects.get(pk=outbox_mail.pk)
+            self.assertEquals(outbox_mail.attempts, attempt)
+            self.assertTrue('SMTP no disponible' in outbox_mail.last_error)
+
+            if attempt == outbox.OUTBOX_MAX_ATTEMPTS:
+                break
+
+            # El siguiente intento espera el doble que el anterior.
+            self.assertEquals(outbox_mail.status, OutboxMail.PENDING)
+            delay = outbox.OUTBOX_RETRY_DELAY * (2 ** (attempt - 1))
+            self.assertTrue(before + timedelta(seconds=delay) <= outbox_mail.run_after)
+            self.assertTrue(outbox_mail.run_after <= datetime.now() + timedelta(seconds=delay))
+
+            # Antes de tiempo no se vuelve a intentar.
+            self.assertEquals(drain_outbox(workers=1, backend=backend), 0)
+            self.assertEquals(OutboxMail.objects.get(pk=outbox_mail.pk).attempts, attempt)
+
+            OutboxMail.objects.filter(pk=outbox_mail.pk).update(run_after=before)
+
+        self.assertEquals(outbox_mail.status, OutboxMail.FAILED)
+
+        # Un email fallido ya no se vuelve a tomar.
+        self.assertEquals(drain_outbox(workers=1), 0)
+        self.assertEquals(OutboxMail.objects.get(pk=outbox_mail.pk).status,
+                          OutboxMail.FAILED)
+
+    def test_outbox_pool(self):
+        """
+        Los hilos de envío de un proceso se reutilizan entre llamadas.
+        """
+
+        import threading
+
+        pool = outbox.get_pool(2)
+        self.assertTrue(outbox.get_pool(2) is pool)
+        self.assertFalse(outbox.get_pool(3) is pool)
+
+        workers = list(pool._pool)
+        for attempt in range(3):
+            used = pool.map(lambda index: threading.current_thread(), range(10))
+            self.assertTrue(all(thread in workers for thread in used))
+
+        self.assertEquals(pool._pool, workers)
+
     def test_invalid_username(self):
         """
         El sistema debe validar el nombre de usuario antes de crear el usuario.
@@ -228,6 +410,9 @@ class TestUsersViews(TestBase):
         Como usuario debo ser capaz de subir un avatar a mi perfil.
         """
 
+        from users.avatars import avatar_url
+        from users.tasks import run_pending_jobs
+
         self._login()
         image = open(IMAGE_TEST)
 
@@ -237,10 +422,87 @@ class TestUsersViews(TestBase):
         response = self.client_post('users_personal', data=data)
         assert response.status_code == 302
 
-        profile = self.user.get_profile()
+        # Mientras se generan los thumbnails se muestra la imagen original.
+        profile = Profile.objects.get(user=self.user)
+        assert not profile.thumbnails_ready
+        self.assertEquals(avatar_url(profile, 's'), profile.image.url)
+
+        # Los thumbnails se generan fuera de la petición.
+        self.assertEquals(run_pending_jobs(), 1)
+
+        profile = Profile.objects.get(user=self.user)
+        assert profile.thumbnails_ready
         for size in Profile.sizes.keys():
             assert profile.thumbnail_exists(size)
 
+        # Los thumbnails se nombran con el hash del contenido, no con el
+        # nombre de usuario.
+        self.assertEquals(len(profile.avatar_hash), 16)
+        self.assertTrue(profile.avatar_hash in avatar_url(profile, 's'))
+        self.assertFalse(self.user.username in avatar_url(profile, 's'))
+
+    def test_gc_avatars(self):
+        """
+        El recolector elimina solo los thumbnails que ningún perfil usa.
+        """
+
+        from django.core.files.base import ContentFile
+        from django.core.management import call_command
+        from users.tasks import run_pending_jobs
+
+        # Un directorio propio para no tocar otros avatares del storage.
+        old_dir = getattr(settings, 'THUMBNAIL_STORAGE_DIR', None)
+        settings.THUMBNAIL_STORAGE_DIR = 'avatars_gc_test'
+
+        try:
+            self._login()
+            response = self.client_post('users_personal', data={'image': open(IMAGE_TEST)})
+            self.assertEquals(response.status_code, 302)
+            run_pending_jobs()
+
+            profile = Profile.objects.get(user=self.user)
+            storage = profile.image.storage
+            orphan = profile.thumbnail_name('s', avatar_hash='0123456789abcdef')
+            storage.save(orphan, ContentFile('orphan'))
+            legacy = profile.thumbnail_name('s', version=3)
+            storage.save(legacy, ContentFile('legacy'))
+
+            # Archivos de otras aplicaciones en el mismo directorio.
+            unrelated = [storage.save(path.join(profile.thumbnail_basepath(), name),
+                                      ContentFile('unrelated'))
+                         for name in ('logo.png', 'banner.jpg', 'photo_big.jpg')]
+
+            call_command('users_gc_avatars', grace_hours=0, verbosity=0)
+
+            self.assertFalse(storage.exists(orphan))
+            self.assertFalse(storage.exists(legacy))
+            for name in unrelated:
+                self.assertTrue(storage.exists(name))
+                storage.delete(name)
+            for size in Profile.sizes.keys():
+                self.assertTrue(profile.thumbnail_exists(size))
+        finally:
+            if old_dir is None:
+                del settings.THUMBNAIL_STORAGE_DIR
+            else:
+                settings.THUMBNAIL_STORAGE_DIR = old_dir
+
+    def test_render_thumbnails(self):
+        """
+        Todos los tamaños del avatar se generan a partir de una sola imagen
+        decodificada.
+        """
+
+        from users.images import open_image
+        from users.images import render_thumbnails
+
+        data = open(IMAGE_TEST, 'rb').read()
+        thumbnails = render_thumbnails(data, Profile.sizes, Profile.methods)
+
+        self.assertEquals(sorted(thumbnails.keys()), sorted(Profile.sizes.keys()))
+        for size, content in thumbnails.items():
+            self.assertEquals(open_image(content).size, Profile.sizes[size])
+
     def test_change_personal_data(self):
         """
         Como usuario debo ser capaz de añadir mi website y una descripción de
@@ -281,6 +543,27 @@ class TestUsersViews(TestBase):
         assert response.status_code == 302
         assert (mail_count + 1) == len(mail.outbox)
 
+    def test_bulk_password_instructions(self):
+        """
+        Las instrucciones para cambiar la contraseña se pueden enviar a muchos
+        usuarios en un solo envío.
+        """
+
+        from users.sites import get_current_site
+        from users.bulkmail import send_password_instructions
+
+        users = list(User.objects.exclude(email=''))
+        mail_count = len(mail.outbox)
+
+        stats = send_password_instructions(users, get_current_site())
+        self.assertEquals(stats['sent'], len(users))
+        self.assertEquals(len(stats['timings']), len(users))
+        self.assertEquals(mail_count + len(users), len(mail.outbox))
+
+        for user, message in zip(users, mail.outbox[mail_count:]):
+            self.assertEquals(message.to, [user.email])
+            self.assertTrue(user.username in message.body)
+
     def test_reset_confirm(self):
         """
         Como usuario debo ser capaz de cambiar mi contraseña a travez de un 
@@ -358,9 +641,16 @@ class TestUsersViews(TestBase):
                                     'static', 'bg.jpg')
         assert not profile.background
 
+        # Una foto horizontal de 1920x1200 tomada con la cámara girada.
+        from users.images import open_image
+        photo = exif_jpeg(open(background_file, 'rb').read(), orientation=6)
+        uploaded_image = open_image(photo)
+        self.assertEquals(uploaded_image.size, (1920, 1200))
+        self.assertEquals(uploaded_image._getexif().get(274), 6)
+
         # Posteamos la imagen
         data = {
-            "background": open(background_file)
+            "background": SimpleUploadedFile('bg.jpg', photo, 'image/jpeg')
         }
         response = self.client_post('users_design', data=data)
         self.assertEquals(response.status_code, 302)
@@ -368,10 +658,1128 @@ class TestUsersViews(TestBase):
         # Verificamos que se ha subido la imagen
         profile = self._update(profile)
         self.assertTrue(profile.background)
-    
+
+        # Mientras se optimiza se usa la imagen tal como se subió.
+        from users.backgrounds import background_variants, background_srcset
+        from users.tasks import run_pending_jobs
+
+        uploaded = profile.background.name
+        self.assertEquals(background_variants(profile), [(None, profile.background.url)])
+
+        # La imagen se optimiza fuera de la petición.
+        self.assertEquals(run_pending_jobs(), 1)
+
+        profile = self._update(profile)
+        storage = profile.background.storage
+        self.assertNotEquals(profile.background.name, uploaded)
+        self.assertFalse(storage.exists(uploaded))
+
+        # Se descartan los metadatos y la imagen queda girada.
+        optimized = storage.open(profile.background.name).read()
+        image = open_image(optimized)
+        self.assertEquals(image.size, (1200, 1920))
+        self.assertEquals(profile.background_width, 1200)
+        self.assertFalse('exif' in image.info)
+        self.assertFalse('TestCam' in optimized)
+
+        variants = background_variants(profile)
+        self.assertEquals(variants[-1], (profile.background_width,
+                                         profile.background.url))
+        for width, url in variants:
+            self.assertTrue(width <= profile.background_width)
+            self.assertTrue(url in background_srcset(profile))
+
+        # La hoja de estilo usa la imagen optimizada.
+        response = self.client.get(profile.theme_url())
+        self.assertContains(response, profile.background.url)
+
+    def test_background_theme_race(self):
+        """
+        Si los colores cambian mientras se optimiza la imagen de fondo, la
+        hoja de estilo publicada usa los colores nuevos.
+        """
+
+        from users import images
+        from users.tasks import run_pending_jobs
+        from users.themes import read_theme
+
+        self._login()
+        background_file = path.join(path.abspath(path.dirname(__file__)),
+                                    'static', 'bg.jpg')
+        response = self.client_post('users_design', data={
+            'background': open(background_file),
+            'button_color': '#111111',
+        })
+        self.assertEquals(response.status_code, 302)
+        profile = self.get_user().get_profile()
+
+        # Otro proceso cambia el color durante la optimización.
+        render_backgrounds = images.render_backgrounds
+        def concurrent_render(*args, **kwargs):
+            Profile.objects.filter(pk=profile.pk).update(button_color='#222222')
+            return render_backgrounds(*args, **kwargs)
+
+        images.render_backgrounds = concurrent_render
+        try:
+            self.assertEquals(run_pending_jobs(), 1)
+        finally:
+            images.render_backgrounds = render_backgrounds
+
+        profile = self._update(profile)
+        self.assertEquals(profile.button_color, '#222222')
+        css = read_theme(profile.theme_hash)
+        self.assertTrue('#222222' in css)
+        self.assertTrue(profile.background.url in css)
+
+    def test_users_index_cursor(self):
+        """
+        El listado de usuarios se puede paginar por cursor sin contar todas
+        las filas.
+        """
+
+        from users.views import UsersIndex
+
+        class SmallPages(UsersIndex):
+            cursor_per_page = 1
+
+        # Recorremos todas las páginas usando los tokens.
+        seen = []
+        data = {'order': 'recent'}
+        while True:
+            response = self.view_get(SmallPages, data=data)
+            self.assertEquals(response.status_code, 200)
+            page = response.context_data['cursor_page']
+            seen.extend([profile.id for profile in response.context_data['object_list']])
+            if not page.has_next:
+                break
+            data = {'order': 'recent', 'after': page.next_cursor}
+
+        self.assertEquals(sorted(seen, reverse=True), seen)
+        self.assertEquals(len(seen), Profile.objects.count())
+
+        # La página anterior a la última es la penúltima.
+        data = {'order': 'recent', 'before': page.previous_cursor}
+        response = self.view_get(SmallPages, data=data)
+        self.assertEquals([profile.id for profile in response.context_data['object_list']], 
+                          seen[-2:-1])
+
+        # Un cursor inválido no es una página válida.
+        response = self.client_get('users_index', data={'after': '!!'})
+        self.assertEquals(response.status_code, 404)
+
+        # Tampoco uno modificado con otro número de valores o de tipos.
+        from users.pagination import encode_cursor
+        tampered = [
+            {'order': 'recent', 'after': encode_cursor([1, 2])},
+            {'order': 'recent', 'before': encode_cursor(['uno'])},
+            {'order': 'recent', 'after': encode_cursor([[1]])},
+            {'order': 'active', 'after': encode_cursor([1])},
+            {'order': 'active', 'after': encode_cursor(['ayer', 1])},
+            {'order': 'active', 'before': encode_cursor([None, 1])},
+        ]
+        for data in tampered:
+            response = self.client_get('users_index', data=data)
+            self.assertEquals(response.status_code, 404)
+
+    def test_users_index_avatars(self):
+        """
+        El listado de usuarios resuelve las urls de todos los avatares sin
+        consultar el storage.
+        """
+
+        from users import views
+        from users.avatars import default_avatar_url
+
+        self.test_avatar_upload()
+        profile = Profile.objects.get(user=self.user)
+
+        # El template del listado no usa avatars_dict, así que no se calcula.
+        calls = []
+        old_avatar_url = views.avatar_url
+        def avatar_url(profile, size):
+            calls.append(profile)
+            return old_avatar_url(profile, size)
+        views.avatar_url = avatar_url
+
+        try:
+            response = self.client_get('users_index')
+            self.assertEquals(response.status_code, 200)
+            self.assertEquals(calls, [])
+        finally:
+            views.avatar_url = old_avatar_url
+
+        avatars_dict = response.context['avatars_dict']
+        self.assertEquals(avatars_dict[str(self.user.id)],
+                          profile.thumbnail_url('s'))
+        self.assertEquals(avatars_dict['1'], default_avatar_url('s'))
+        self.assertContains(response, default_avatar_url('s'))
+
+    def test_users_index_users_dict(self):
+        """
+        Los templates existentes pueden seguir usando users_dict en el
+        listado; los usuarios se cargan solo si se usan.
+        """
+
+        response = self.client_get('users_index')
+        self.assertEquals(response.status_code, 200)
+
+        users_dict = response.context['users_dict']
+        self.assertEquals(users_dict._data, None)
+
+        users_count = User.objects.count()
+        with self.assertNumQueries(1):
+            self.assertEquals(users_dict['1'].username, 'admin')
+            self.assertEquals(users_dict[str(self.user.id)], self.user)
+            self.assertEquals(len(users_dict), users_count)
+
+    def test_subdomain_profile(self):
+        """
+        Los subdominios de los usuarios se atienden con el perfil y los
+        enlaces llevan directamente al subdominio.
+        """
+
+        from django.core.urlresolvers import resolve
+        from users.middleware import SubdomainProfileMiddleware, profile_username
+        from users.utils import profile_domain, profile_url
+
+        domain = profile_domain()
+        self.assertEquals(profile_username('Admin.%s:80' % domain, domain), 'admin')
+        self.assertEquals(profile_username('www.%s' % domain, domain), None)
+        self.assertEquals(profile_username('a.b.%s' % domain, domain), None)
+        self.assertEquals(profile_username(domain, domain), None)
+
+        request = self.request_factory.get('/', HTTP_HOST='admin.%s' % domain)
+        self.assertEquals(SubdomainProfileMiddleware().process_request(request), None)
+        self.assertEquals(request.profile_username, 'admin')
+
+        match = resolve('/', urlconf=request.urlconf)
+        self.assertEquals(match.url_name, 'users_subdomain_profile')
+
+        profile = Profile.objects.get(user__username='admin')
+        self.assertEquals(profile.get_absolute_url(), 'http://admin.%s' % domain)
+        self.assertEquals(profile_url('admin'), 'http://admin.%s' % domain)
+
+    def test_email_uniqueness(self):
+        """
+        Los emails se comparan sin distinguir mayúsculas usando el email
+        normalizado de los perfiles.
+        """
+
+        from django.core.management import call_command
+        from users.forms import RegisterForm
+
+        self.object.email = u' Admin@Example.com'
+        self.object.save()
+        self.assertEquals(Profile.objects.get(user=self.object).email_normalized,
+                          u'admin@example.com')
+
+        self.data['email'] = u'ADMIN@example.com'
+        form = RegisterForm(self.data)
+        self.assertFalse(form.is_valid())
+        self.assertTrue('email' in form.errors)
+
+        self.assertFalse(Profile.objects.email_taken(u'admin@example.com', 'admin'))
+
+        # El comando completa los perfiles sin email normalizado.
+        Profile.objects.update(email_normalized=None)
+        call_command('users_backfill_emails', verbosity=0)
+        self.assertTrue(Profile.objects.email_taken(u'admin@EXAMPLE.com'))
+
+    def test_email_legacy_users(self):
+        """
+        Mientras haya perfiles sin email normalizado los emails también se
+        buscan en los usuarios.
+        """
+
+        from users import managers
+
+        User.objects.filter(pk=self.object.pk).update(email=u'Legacy@Example.com')
+        Profile.objects.filter(user=self.object).update(email_normalized=None)
+
+        # Por defecto no se consulta auth_user.
+        self.assertFalse(Profile.objects.email_taken(u'legacy@example.com'))
+
+        old_check = managers.EMAIL_LEGACY_CHECK
+        managers.EMAIL_LEGACY_CHECK = True
+        try:
+            self.data['email'] = u'legacy@example.COM'
+            form = RegisterForm(self.data)
+            self.assertFalse(form.is_valid())
+            self.assertTrue('email' in form.errors)
+
+            # El mismo usuario puede conservar su email.
+            self.assertFalse(Profile.objects.email_taken(u'legacy@example.com',
+                                                         self.object.username))
+        finally:
+            managers.EMAIL_LEGACY_CHECK = old_check
+
+    def test_email_sync_conflict(self):
+        """
+        Si otro perfil ya tiene el email, el perfil del usuario se sincroniza
+        sin email normalizado y el usuario se guarda igual.
+        """
+
+        # Los usuarios del fixture se cargan sin sincronizar el perfil.
+        self.object.save()
+
+        other = User.objects.get(pk=2)
+        User.objects.filter(pk=other.pk).update(email=self.object.email.upper())
+        other = User.objects.get(pk=other.pk)
+
+        other.first_name = u'Duplicado'
+        other.save()
+
+        profile = Profile.objects.get(user=other)
+        self.assertEquals(profile.first_name, u'Duplicado')
+        self.assertEquals(profile.email_normalized, None)
+        self.assertEquals(Profile.objects.get(user=self.object).email_normalized,
+                          normalize_email(self.object.email))
+
+    def test_backfill_emails_oldest(self):
+        """
+        Si varios usuarios tienen el mismo email, el backfill lo deja en el
+        perfil del más antiguo aunque otro perfil ya lo tenga.
+        """
+
+        from django.core.management import call_command
+
+        email = u'shared@example.com'
+        User.objects.filter(pk__in=[2, 3]).update(email=email)
+        Profile.objects.update(email_normalized=None)
+        Profile.objects.filter(user=3).update(email_normalized=email)
+
+        call_command('users_backfill_emails', verbosity=0)
+
+        self.assertEquals(Profile.objects.get(user=2).email_normalized, email)
+        self.assertEquals(Profile.objects.get(user=3).email_normalized, None)
+        self.assertEquals(Profile.objects.get(user=1).email_normalized,
+                          normalize_email(self.object.email))
+
+    def test_availability(self):
+        """
+        La vista de disponibilidad valida con las reglas del registro y
+        detecta los nombres de usuario y emails en uso.
+        """
+
+        from django.core.management import call_command
+        from django.utils import simplejson as json
+        from users.availability import availability_index
+
+        # Los usuarios del fixture se cargan sin email normalizado.
+        call_command('users_backfill_emails', verbosity=0)
+
+        # La base de datos de los tests no se comparte con otros hilos.
+        availability_index.reset()
+        availability_index.background = False
+
+        def check(**data):
+            response = self.client_get('users_availability', data=data)
+            self.assertEquals(response.status_code, 200)
+            return json.loads(response.content)
+
+        self.assertFalse(check(username='admin')['available'])
+        self.assertTrue(check(username='nadie')['available'])
+        self.assertFalse(check(username='No Valido')['valid'])
+        self.assertFalse(check(username='www')['valid'])
+        self.assertFalse(check(email='Contact@JoseZambrana.com')['available'])
+        self.assertTrue(check(email='nadie@example.com')['available'])
+        self.assertFalse(check(email='nadie')['valid'])
+
+        # Los usuarios nuevos se agregan al filtro con la señal.
+        User.objects.create_user('nadie', 'nadie@example.com', 'pass')
+        self.assertFalse(check(username='nadie')['available'])
+
+        availability_index.reset()
+        availability_index.background = True
+
+    def test_availability_other_processes(self):
+        """
+        El filtro incorpora los cambios de nombre de usuario y email hechos
+        por otros procesos, y mientras se construye consulta la base de
+        datos.
+        """
+
+        from users.availability import AvailabilityIndex
+
+        index = AvailabilityIndex(snapshot=None, refresh=0, background=False)
+        self.assertTrue(index.username_available('renombrado'))
+        self.assertTrue(index.email_available('renombrado@example.com'))
+
+        # Otro proceso cambia el nombre de usuario y el email: la señal no
+        # llega a este índice.
+        User.objects.filter(pk=self.object.pk).update(username='renombrado',
+                                                      email='renombrado@example.com')
+        user = User.objects.get(pk=self.object.pk)
+        post_save.disconnect(sender=User, dispatch_uid='users.update_availability')
+        try:
+            user.save()
+        finally:
+            post_save.connect(update_availability, sender=User,
+                              dispatch_uid='users.update_availability')
+
+        self.assertFalse(index.username_available('renombrado'))
+        self.assertFalse(index.email_available('Renombrado@example.com'))
+
+        # Mientras el filtro se construye en otro hilo se consulta la base
+        # de datos.
+        loading = AvailabilityIndex(snapshot=None, background=True)
+        loading.start_loading = lambda: None
+        self.assertFalse(loading.username_available('renombrado'))
+        self.assertTrue(loading.username_available('libre'))
+        self.assertFalse(loading.email_available('renombrado@example.com'))
+        self.assertFalse(loading.loaded)
+
+    def test_bloom_filter(self):
+        """
+        El filtro no tiene falsos negativos y se puede guardar en disco.
+        """
+
+        from users.availability import BloomFilter
+
+        bloom = BloomFilter(capacity=100, error_rate=0.01)
+        for index in range(100):
+            bloom.add(u'u:user%s' % index)
+
+        self.assertTrue(all(u'u:user%s' % index in bloom for index in range(100)))
+        false_positives = sum(1 for index in range(1000) if u'x:%s' % index in bloom)
+        self.assertTrue(false_positives < 50)
+
+        loaded, watermark = BloomFilter.loads(bloom.dumps(watermark=42))
+        self.assertEquals(watermark, 42)
+        self.assertEquals(loaded.count, 100)
+        self.assertTrue(u'u:user7' in loaded)
+
+    def test_users_search(self):
+        """
+        El listado de usuarios busca por prefijo en el índice de búsqueda,
+        que se actualiza al guardar los perfiles.
+        """
+
+        from django.core.management import call_command
+
+        call_command('users_reindex_search', verbosity=0)
+
+        response = self.client_get('users_index', data={'q': 'adm'})
+        self.assertEquals(response.status_code, 200)
+        usernames = [p.username for p in response.context['object_list']]
+        self.assertEquals(usernames, ['admin'])
+
+        profile = Profile.objects.get(user__username='testaccount')
+        profile.description = u'Fotógrafo aficionado'
+        profile.save()
+
+        response = self.client_get('users_index', data={'q': 'fotog'})
+        usernames = [p.username for p in response.context['object_list']]
+        self.assertEquals(usernames, ['testaccount'])
+
+        response = self.client_get('users_index', data={'q': 'nadie'})
+        self.assertEquals(list(response.context['object_list']), [])
+
+    def test_users_search_disabled(self):
+        """
+        Sin USERS_SEARCH_PATH los perfiles se guardan sin índice y el listado
+        ignora las búsquedas.
+        """
+
+        search_index.path = None
+
+        response = self.client_post('users_register', data=self.data)
+        self.assertEquals(response.status_code, 302)
+        profile = Profile.objects.get(user__username=self.data['username'])
+        profile.description = u'Fotógrafo aficionado'
+        profile.save()
+
+        response = self.client_get('users_index', data={'q': 'adm'})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.context['search_page'], None)
+        self.assertEquals(len(response.context['object_list']), Profile.objects.count())
+        self.assertNotContains(response, 'users-search')
+
+        profile.delete()
+
+    def test_user_cards(self):
+        """
+        Las tarjetas del listado se guardan en el cache por versión del
+        perfil y se vuelven a renderizar al modificarlo.
+        """
+
+        from django.core.cache import get_cache
+        from users.cards import render_cards, card_key
+
+        cache = get_cache('django.core.cache.backends.locmem.LocMemCache')
+        profiles = list(Profile.objects.listing().order_by('id'))
+
+        html = render_cards(profiles, cache=cache)
+        self.assertEquals(html, render_cards(profiles, cache=False))
+        self.assertEquals(len(cache.get_many([card_key(p, 's') for p in profiles])),
+                          len(profiles))
+
+        # Con el cache lleno no se vuelve a renderizar ninguna tarjeta.
+        from users import cards
+        rendered = []
+        old_render_card = cards.render_card
+        def render_card(profile, size, template=None):
+            rendered.append(profile.pk)
+            return old_render_card(profile, size, template)
+        cards.render_card = render_card
+
+        try:
+            self.assertEquals(render_cards(profiles, cache=cache), html)
+            self.assertEquals(rendered, [])
+        finally:
+            cards.render_card = old_render_card
+
+        # Al guardar el perfil cambia su versión.
+        profile = Profile.objects.get(pk=profiles[0].pk)
+        profile.first_name = u'Cambiado'
+        profile.save()
+        self.assertNotEquals(card_key(profile, 's'), card_key(profiles[0], 's'))
+        self.assertTrue(u'Cambiado' in render_cards([profile], cache=cache))
+
+    def test_conditional_get(self):
+        """
+        El listado y el perfil responden con 304 mientras no cambien.
+        """
+
+        from users.views import UsersProfile
+
+        response = self.client_get('users_index')
+        self.assertEquals(response.status_code, 200)
+        etag = response['ETag']
+        self.assertTrue('Cookie' in response['Vary'])
+
+        response = self.client_get('users_index', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 304)
+        self.assertEquals(response.content, '')
+
+        self.object.first_name = u'Otro'
+        self.object.save()
+        response = self.client_get('users_index', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+
+        # El perfil usa también la fecha de modificación.
+        request = self.request_factory.get('/')
+        self._anonymous_user(request)
+        response = UsersProfile.as_view()(request, username='admin')
+        etag, last_modified = response['ETag'], response['Last-Modified']
+
+        request = self.request_factory.get('/', HTTP_IF_NONE_MATCH=etag)
+        self._anonymous_user(request)
+        response = UsersProfile.as_view()(request, username='admin')
+        self.assertEquals(response.status_code, 304)
+
+        request = self.request_factory.get('/', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self._anonymous_user(request)
+        response = UsersProfile.as_view()(request, username='admin')
+        self.assertEquals(response.status_code, 304)
+
+    def test_current_site(self):
+        """
+        El sitio actual se obtiene por el host de la petición, incluso desde
+        los subdominios, y se actualiza al modificar el sitio.
+        """
+
+        from django.contrib.sites.models import Site
+        from users.sites import get_current_site, clear_site_cache
+
+        clear_site_cache()
+        site = Site.objects.get(pk=settings.SITE_ID)
+        other = Site.objects.create(domain='other.com', name='Other')
+
+        request = self.request_factory.get('/', HTTP_HOST='admin.other.com:8000')
+        self.assertEquals(get_current_site(request), other)
+
+        request = self.request_factory.get('/', HTTP_HOST='unknown.org')
+        self.assertEquals(get_current_site(request), site)
+
+        site.name = u'Renombrado'
+        site.save()
+        self.assertEquals(get_current_site().name, u'Renombrado')
+
+        other.delete()
+
+    def test_current_site_other_processes(self):
+        """
+        Los procesos que no modificaron el sitio lo vuelven a cargar cuando
+        cambia su versión en el cache compartido.
+        """
+
+        from django.core.cache import get_cache
+        from django.contrib.sites.models import Site
+        from users import sites
+
+        sites.clear_site_cache()
+        name = sites.get_current_site().name
+
+        # Otro proceso modifica el sitio y su versión en el cache compartido.
+        Site.objects.filter(pk=settings.SITE_ID).update(name=u'Otro proceso')
+        get_cache(sites.SITES_CACHE_BACKEND).set(sites.SITES_VERSION_KEY, 'otro')
+        self.assertEquals(sites.get_current_site().name, name)
+
+        old_interval = sites.SITES_CHECK_INTERVAL
+        sites.SITES_CHECK_INTERVAL = 0
+        try:
+            self.assertEquals(sites.get_current_site().name, u'Otro proceso')
+        finally:
+            sites.SITES_CHECK_INTERVAL = old_interval
+            Site.objects.filter(pk=settings.SITE_ID).update(name=name)
+            sites.clear_site_cache()
+
+    def test_profile_display_fields(self):
+        """
+        Los perfiles mantienen una copia de los datos del usuario que se
+        muestran en los listados.
+        """
+
+        from django.core.management import call_command
+
+        self.user.first_name = u'Pepe'
+        self.user.last_name = u'Grillo'
+        self.user.save()
+
+        profile = Profile.objects.get(user=self.user)
+        self.assertEquals(profile.first_name, u'Pepe')
+        self.assertEquals(profile.last_name, u'Grillo')
+
+        response = self.client_get('users_index')
+        self.assertContains(response, u'Grillo')
+
+        # Los cambios que no envían señales se corrigen con el comando.
+        User.objects.filter(pk=self.user.pk).update(last_name=u'Cri')
+        call_command('users_reconcile_profiles', verbosity=0)
+
+        profile = Profile.objects.get(user=self.user)
+        self.assertEquals(profile.last_name, u'Cri')
+
+    def test_theme_css(self):
+        """
+        El diseño se compila en una hoja de estilo con el hash de su contenido
+        que los navegadores guardan sin volver a pedirla.
+        """
+
+        from users.themes import compile_theme
+        from users.views import UsersProfile
+
+        self._login()
+        data = {
+            'background_color': '#fff',
+            'links_color': '#888',
+            'button_background': '#444',
+            'button_color': '#aaa',
+        }
+        response = self.client_post('users_design', data=data)
+        self.assertEquals(response.status_code, 302)
+
+        profile = Profile.objects.get(user=self.user)
+        self.assertEquals(len(profile.theme_hash), 16)
+
+        response = self.client.get(profile.theme_url())
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response['Content-Type'], 'text/css')
+        self.assertTrue('immutable' in response['Cache-Control'])
+        self.assertContains(response, 'color: #888;')
+
+        response = self.client.get(profile.theme_url(),
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEquals(response.status_code, 304)
+
+        request = self.request_factory.get('/')
+        self._anonymous_user(request)
+        response = UsersProfile.as_view()(request, username=self.user.username)
+        self.assertContains(response.render(), profile.theme_url())
+
+        # Otro perfil con el mismo diseño usa la misma hoja de estilo.
+        other = Profile.objects.exclude(pk=profile.pk)[0]
+        for field, value in data.items():
+            setattr(other, field, value)
+        self.assertEquals(compile_theme(other), profile.theme_hash)
+
+        # Sin diseño no hay hoja de estilo.
+        data = dict((field, '') for field in data)
+        self.client_post('users_design', data=data)
+        self.assertEquals(Profile.objects.get(pk=profile.pk).theme_url(), None)
+
+    def test_profile_changed_fields(self):
+        """
+        Los formularios de configuración guardan solo los campos modificados
+        y no hacen nada si no cambió ninguno.
+        """
+
+        from users.signals import profile_changed, user_changed
+
+        saved = []
+        def changed(sender, instance, fields, **kwargs):
+            saved.append((sender, sorted(fields)))
+
+        profile_changed.connect(changed)
+        user_changed.connect(changed)
+
+        profile = Profile.objects.get(user=self.user)
+        self.assertEquals(profile.changed_fields(), [])
+        self.assertEquals(profile.save_changed(), [])
+
+        profile.background_color = '#fff'
+        profile.button_background = '#444'
+        profile.button_color = '#000'
+        profile.save()
+        self.assertEquals(profile.changed_fields(), [])
+
+        profile.links_color = '#888'
+        self.assertEquals(profile.changed_fields(), ['links_color'])
+        self.assertEquals(profile.save_changed(), ['links_color'])
+        self.assertEquals(profile.changed_fields(), [])
+        self.assertEquals(Profile.objects.get(pk=profile.pk).links_color, '#888')
+
+        self._login()
+        data = {
+            'background_color': '#fff',
+            'links_color': '#888',
+            'button_background': '#444',
+            'button_color': '#aaa',
+        }
+        response = self.client_post('users_design', data=data)
+        self.assertEquals(response.status_code, 302)
+
+        # Enviar otra vez los mismos datos no guarda nada.
+        response = self.client_post('users_design', data=data)
+        self.assertEquals(response.status_code, 302)
+
+        data = {
+            'first_name': u'Pepe',
+            'last_name': u'Grillo',
+            'email': self.user.email,
+        }
+        response = self.client_post('users_account', data=data)
+        self.assertEquals(response.status_code, 302)
+        self.assertEquals(Profile.objects.get(pk=profile.pk).last_name, u'Grillo')
+
+        profile_changed.disconnect(changed)
+        user_changed.disconnect(changed)
+
+        self.assertEquals(saved, [(Profile, ['links_color']),
+                                  (Profile, ['button_color', 'theme_hash']),
+                                  (User, ['first_name', 'last_name'])])
+
+    def test_profile_extras(self):
+        """
+        Los extras se modifican por clave sin guardar el resto del perfil y
+        sin perder los cambios de otros procesos.
+        """
+
+        profile = Profile.objects.get(user=self.user)
+        other = Profile.objects.get(user=self.user)
+
+        profile.set_extra('theme', 'dark')
+        self.assertEquals(profile.incr_extra('visits'), 1)
+
+        # La otra instancia no conoce los cambios anteriores pero no los pisa.
+        self.assertEquals(other.incr_extra('visits', 2), 3)
+        self.assertEquals(other.extras, {'theme': 'dark', 'visits': 3})
+        self.assertEquals(other.extras_version, 3)
+
+        self.assertTrue(profile.delete_extra('theme'))
+        self.assertFalse(profile.delete_extra('theme'))
+
+        saved = Profile.objects.get(pk=profile.pk)
+        self.assertEquals(saved.extras, {'visits': 3})
+        self.assertEquals(saved.extras_version, 4)
+
+        # Si otro proceso escribe en cada intento se abandona.
+        def mutate(extras):
+            Profile.objects.filter(pk=profile.pk).update(
+                extras_version=models.F('extras_version') + 1)
+            extras['lost'] = True
+            return True, None
+
+        self.assertRaises(ExtrasConflict, Profile.objects.update_extras,
+                          profile.pk, mutate, retries=2)
+        self.assertFalse('lost' in Profile.objects.get(pk=profile.pk).extras)
+
+        # Los listados no cargan los extras.
+        listed = Profile.objects.profiles_dict([self.user.pk])[str(self.user.pk)]
+        self.assertFalse('extras' in listed.__dict__)
+
+    def test_profile_extras_stale_save(self):
+        """
+        Guardar completa una instancia con extras viejos no pisa los extras
+        guardados después por otra instancia.
+        """
+
+        stale = Profile.objects.get(user=self.user)
+        other = Profile.objects.get(user=self.user)
+        other.set_extra('theme', 'dark')
+
+        stale.first_name = u'Nuevo'
+        stale.save()
+
+        saved = Profile.objects.get(pk=stale.pk)
+        self.assertEquals(saved.first_name, u'Nuevo')
+        self.assertEquals(saved.extras, {'theme': 'dark'})
+        self.assertEquals(saved.extras_version, other.extras_version)
+
+        # Una actualización posterior parte de los extras guardados.
+        stale.set_extra('visits', 1)
+        self.assertEquals(Profile.objects.get(pk=stale.pk).extras,
+                          {'theme': 'dark', 'visits': 1})
+
+    def test_profile_extras_assigned_save(self):
+        """
+        Los extras asignados en la instancia se guardan con save, que envía
+        las señales con sus argumentos normales.
+        """
+
+        received = []
+        def receiver(sender, **kwargs):
+            received.append(kwargs)
+        models.signals.pre_save.connect(receiver, sender=Profile)
+        post_save.connect(receiver, sender=Profile)
+
+        profile = Profile.objects.get(user=self.user)
+        version = profile.extras_version
+        profile.extras = {'theme': 'light'}
+
+        try:
+            profile.save()
+        finally:
+            models.signals.pre_save.disconnect(receiver, sender=Profile)
+            post_save.disconnect(receiver, sender=Profile)
+
+        saved = Profile.objects.get(pk=profile.pk)
+        self.assertEquals(saved.extras, {'theme': 'light'})
+        self.assertEquals(saved.extras_version, version + 1)
+        self.assertEquals(profile.extras_version, version + 1)
+
+        self.assertEquals(len(received), 2)
+        for kwargs in received:
+            self.assertEquals(kwargs['using'], 'default')
+            self.assertEquals(kwargs['raw'], False)
+        self.assertEquals(received[1]['created'], False)
+
     def _read_signup_email(self, email):
         urlmatch = re.search(r"https?://[^/]*(/.*reset/\S*)", email.body)
         self.assertTrue(urlmatch is not None, "No URL found in sent email")
         return urlmatch.group(), urlmatch.groups()[0]
-        
-    
+
+
+class TestRegisterTransaction(TransactionTestCase):
+    """
+    El usuario y su mail de bienvenida se guardan en la misma transacción.
+    """
+
+    def setUp(self):
+        self.data = {
+            "first_name": "Test",
+            "last_name": "Fake",
+            "username": "testfake",
+            "password1": "fakepass",
+            "password2": "fakepass",
+            "email": "test@fake.com",
+        }
+
+        self.old_workers = disable_workers()
+        self.search_paths = temp_search_index()
+        self.__enqueue_mail = outbox.enqueue_mail
+
+    def tearDown(self):
+        outbox.enqueue_mail = self.__enqueue_mail
+        restore_search_index(self.search_paths)
+        restore_workers(self.old_workers)
+
+    def test_register_rollback(self):
+        """
+        Si no se puede encolar el mail de bienvenida no se crea el usuario.
+        """
+
+        def failing_enqueue_mail(*args, **kwargs):
+            raise IOError('Bandeja de salida no disponible')
+        outbox.enqueue_mail = failing_enqueue_mail
+
+        form = RegisterForm(self.data)
+        self.assertTrue(form.is_valid())
+        self.assertRaises(IOError, form.save)
+
+        self.assertFalse(User.objects.filter(username=self.data['username']).exists())
+        self.assertFalse(Profile.objects.filter(username=self.data['username']).exists())
+        self.assertFalse(OutboxMail.objects.exists())
+
+    def test_register_commit(self):
+        """
+        El usuario y su mail de bienvenida quedan guardados juntos.
+        """
+
+        form = RegisterForm(self.data)
+        self.assertTrue(form.is_valid())
+        user = form.save()
+
+        self.assertTrue(User.objects.filter(pk=user.pk).exists())
+        self.assertEquals(OutboxMail.objects.filter(to_email=user.email).count(), 1)
+
+
+class TestUsersImport(UsersTestBase):
+    """
+    Importación masiva de usuarios con users_import.
+    """
+
+    fixtures = ['users']
+
+    records = [
+        'username,email,first_name,last_name,password,date_joined',
+        'importado1,imp1@example.com,Ana,Uno,sha1$abc$def,2012-01-02 10:00:00',
+        'admin,otro@example.com,Dup,Licado,,',
+        'importado2,CONTACT@josezambrana.com,Beto,Dos,,',
+        ',sinnombre@example.com,Sin,Nombre,,',
+        'importado3,imp3@example.com,Carla,Tres,,fecha-mala',
+        'importado4,imp4@example.com,Dani,Cuatro,,',
+    ]
+
+    def setUp(self):
+        UsersTestBase.setUp(self)
+
+        self.paths = []
+        for suffix in ('.csv', '.csv.state'):
+            fd, name = tempfile.mkstemp(suffix=suffix)
+            os.close(fd)
+            self.paths.append(name)
+        self.csv_path, self.state_path = self.paths
+
+        with open(self.csv_path, 'wb') as f:
+            f.write('\n'.join(self.records) + '\n')
+        os.remove(self.state_path)
+
+    def tearDown(self):
+        for name in self.paths:
+            if os.path.exists(name):
+                os.remove(name)
+        UsersTestBase.tearDown(self)
+
+    def run_import(self, **options):
+        from StringIO import StringIO
+        from django.core.management import call_command
+
+        stdout, stderr = StringIO(), StringIO()
+        call_command('users_import', self.csv_path, state=self.state_path,
+                     batch_size=2, verbosity=1, stdout=stdout, stderr=stderr,
+                     **options)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_import(self):
+        """
+        Los registros válidos se importan con su perfil, los nombres de
+        usuario repetidos y los registros inválidos se omiten.
+        """
+
+        stdout, stderr = self.run_import()
+
+        imported = User.objects.filter(username__startswith='importado')
+        self.assertEquals(sorted(imported.values_list('username', flat=True)),
+                          ['importado1', 'importado2', 'importado4'])
+        self.assertTrue('3 users inserted, 2 errors' in stdout)
+        self.assertTrue('Record 4 skipped' in stderr)
+        self.assertTrue('Record 5 skipped' in stderr)
+
+        user = User.objects.get(username='importado1')
+        self.assertEquals(user.password, 'sha1$abc$def')
+        self.assertEquals(user.date_joined, datetime(2012, 1, 2, 10, 0))
+
+        profile = Profile.objects.get(user=user)
+        self.assertEquals(profile.username, 'importado1')
+        self.assertEquals(profile.first_name, 'Ana')
+        self.assertEquals(profile.email_normalized, 'imp1@example.com')
+
+        # El usuario existente no cambia y el email repetido no se normaliza.
+        self.assertEquals(User.objects.get(username='admin').email,
+                          'contact@josezambrana.com')
+        self.assertEquals(Profile.objects.get(user__username='importado2').email_normalized,
+                          None)
+
+        # Los perfiles importados están en el índice de búsqueda.
+        ids, has_next = search_index.search('importado')
+        self.assertEquals(sorted(ids), sorted(Profile.objects.filter(
+                          user__in=imported).values_list('id', flat=True)))
+
+        # Importar de nuevo no duplica los usuarios.
+        stdout, stderr = self.run_import(restart=True)
+        self.assertTrue('0 users inserted' in stdout)
+        self.assertEquals(imported.count(), 3)
+
+    def test_import_resume(self):
+        """
+        Una importación interrumpida continúa después del último lote
+        confirmado.
+        """
+
+        with open(self.state_path, 'w') as f:
+            f.write('3')
+
+        # Antes de importarlo el nombre se resuelve como inexistente.
+        self.assertEquals(usernames_cache.resolve('importado4', lambda username: None),
+                          None)
+
+        stdout, stderr = self.run_import()
+        self.assertTrue('Resuming after 3 records' in stdout)
+
+        imported = User.objects.filter(username__startswith='importado')
+        self.assertEquals(list(imported.values_list('username', flat=True)),
+                          ['importado4'])
+        with open(self.state_path) as f:
+            self.assertEquals(f.read(), '6')
+
+        # El nombre importado ya no se resuelve como inexistente.
+        user_id = User.objects.get(username='importado4').id
+        self.assertEquals(usernames_cache.resolve('importado4',
+                                                  lambda username: user_id),
+                          user_id)
+
+    def test_bulk_insert(self):
+        """
+        bulk_insert inserta todos los objetos con una sola sentencia.
+        """
+
+        from users.utils import bulk_insert
+
+        self.assertEquals(bulk_insert(OutboxMail, []), 0)
+
+        mails = [OutboxMail(to_email='bulk%s@example.com' % index,
+                            from_email='site@example.com',
+                            subject=u'Asunto %s' % index, body=u'Mensaje')
+                 for index in range(3)]
+        self.assertEquals(bulk_insert(OutboxMail, mails), 3)
+
+        saved = OutboxMail.objects.filter(to_email__startswith='bulk').order_by('to_email')
+        self.assertEquals([mail.subject for mail in saved],
+                          [u'Asunto 0', u'Asunto 1', u'Asunto 2'])
+        self.assertTrue(all(mail.status == OutboxMail.PENDING and
+                            mail.attempts == 0 for mail in saved))
+
+
+class TestActorsCache(UsersTestBase):
+    fixtures = ['users']
+
+    def setUp(self):
+        UsersTestBase.setUp(self)
+        self.cache = ActorCache(backend=LRUCache(max_size=2))
+        self.loaded = []
+
+    def _loader(self, ids):
+        self.loaded.extend(ids)
+        return dict((actor_id, 'actor-%s' % actor_id) for actor_id in ids)
+
+    def test_hits_and_misses(self):
+        """
+        Los actores se cargan una sola vez y luego se obtienen del cache.
+        """
+
+        actors = self.cache.get_many(['1', 2], self._loader)
+        self.assertEquals(actors, {1: 'actor-1', 2: 'actor-2'})
+        self.assertEquals(self.cache.stats()['misses'], 2)
+
+        actors = self.cache.get_many([1, 2], self._loader)
+        self.assertEquals(sorted(self.loaded), [1, 2])
+        self.assertEquals(self.cache.stats()['hits'], 2)
+
+        # El LRU descarta al menos usado recientemente.
+        self.cache.get_many([3], self._loader)
+        self.cache.get_many([1, 2], self._loader)
+        self.assertEquals(self.loaded.count(1) + self.loaded.count(2), 3)
+
+    def test_request_identity_map(self):
+        """
+        Dentro de una misma petición los actores se obtienen del request.
+        """
+
+        request = self.request_factory.get('/')
+        self.cache.get_many([1], self._loader, request=request)
+        self.cache.clear()
+        self.cache.get_many([1], self._loader, request=request)
+
+        self.assertEquals(self.loaded, [1])
+        self.assertEquals(self.cache.stats()['request_hits'], 1)
+
+    def test_invalidate_on_save(self):
+        """
+        Al modificar un usuario o su perfil se invalida su entrada del cache.
+        """
+
+        user = User.objects.get(pk=1)
+        actors_cache.get_many([user.id], self._loader)
+
+        user.first_name = 'Otro'
+        user.save()
+        actors_cache.get_many([user.id], self._loader)
+        self.assertEquals(self.loaded, [user.id, user.id])
+
+        user.get_profile().save()
+        actors_cache.get_many([user.id], self._loader)
+        self.assertEquals(len(self.loaded), 3)
+
+    def test_actors_for(self):
+        """
+        Los actores se retornan con claves enteras en el orden de los ids.
+        """
+
+        actors = Profile.objects.actors_for(['2', 1, 999])
+        self.assertEquals(actors.keys(), [2, 1])
+        self.assertEquals(actors[1].user.id, 1)
+        self.assertEquals(actors[1].profile.user_id, 1)
+
+
+class TestUsernameResolver(UsersTestBase):
+    fixtures = ['users']
+
+    def setUp(self):
+        UsersTestBase.setUp(self)
+        self.resolver = UsernameResolver(backend=LRUCache(max_size=10))
+        self.loaded = []
+
+    def _loader(self, username):
+        self.loaded.append(username)
+        return {'admin': 1}.get(username)
+
+    def test_resolve(self):
+        """
+        Los nombres de usuario, existentes o no, se resuelven una sola vez.
+        """
+
+        self.assertEquals(self.resolver.resolve('admin', self._loader), 1)
+        self.assertEquals(self.resolver.resolve('nobody', self._loader), None)
+        self.assertEquals(self.resolver.resolve('admin', self._loader), 1)
+        self.assertEquals(self.resolver.resolve('nobody', self._loader), None)
+        self.assertEquals(self.loaded, ['admin', 'nobody'])
+
+        stats = self.resolver.stats()
+        self.assertEquals(stats['lookups'], 4)
+        self.assertEquals(stats['db'], 2)
+        self.assertEquals(stats['local'], 2)
+        self.assertEquals(stats['negative'], 2)
+
+        # El cache compartido sirve a los procesos con el LRU vacío.
+        self.resolver.local.clear()
+        self.resolver.resolve('admin', self._loader)
+        self.assertEquals(self.resolver.stats()['shared'], 1)
+
+        self.resolver.invalidate(['admin'])
+        self.resolver.resolve('admin', self._loader)
+        self.assertEquals(self.loaded, ['admin', 'nobody', 'admin'])
+
+    def test_profile_lookup(self):
+        """
+        Las vistas de perfil resuelven el nombre de usuario con el cache y
+        ven a los usuarios creados, renombrados y eliminados.
+        """
+
+        url = reverse('users_profile', args=['newuser'])
+        self.assertEquals(self.client.get(url).status_code, 404)
+
+        user = User.objects.create_user('newuser', 'new@example.com', 'pass')
+        self.assertEquals(self.client.get(url).status_code, 302)
+        self.assertEquals(usernames_cache.stats()['negative'], 1)
+
+        user.username = 'renamed'
+        user.save()
+        self.assertEquals(self.client.get(url).status_code, 404)
+
+        url = reverse('users_profile', args=['renamed'])
+        self.assertEquals(self.client.get(url).status_code, 302)
+
+        user.delete()
+        self.assertEquals(self.client.get(url).status_code, 404)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# Copyright 2012 Mandla Web Studio
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+__author__ = 'Jose Maria Zambrana Arze'
+__email__ = 'contact@josezambrana.com'
+__version__ = '0.1'
+__copyright__ = 'Copyright 2012, Mandla Web Studio'
+
+
+import os
+import re
+import hashlib
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.template.loader import render_to_string
+
+
+#: Directorio del storage donde se guardan las hojas de estilo compiladas.
+THEMES_DIR = getattr(settings, 'USERS_THEMES_DIR', 'themes')
+
+#: Segundos que los navegadores guardan una hoja de estilo. Su nombre cambia
+#: con su contenido, así que nunca se vuelve a pedir.
+THEMES_MAX_AGE = getattr(settings, 'USERS_THEMES_MAX_AGE', 60 * 60 * 24 * 365)
+
+#: Campos del perfil que forman parte del diseño.
+THEME_FIELDS = ('background', 'background_color', 'links_color',
+                'button_background', 'button_color')
+
+#: Template de las hojas de estilo.
+THEME_TEMPLATE = 'style.users.theme.css'
+
+#: Intentos de guardar la hoja de estilo recompilada de un perfil cuyo
+#: diseño otro proceso modifica al mismo tiempo.
+THEMES_MAX_RETRIES = 5
+
+BLANK_LINES_RE = re.compile(r'\n\s*\n+')
+
+
+def render_theme(profile):
+    """
+    Retorna la hoja de estilo con el diseño de *profile*, vacía si no tiene
+    ningún valor de diseño.
+    """
+
+    context = dict((field, getattr(profile, field)) for field in THEME_FIELDS)
+    if not any(context.values()):
+        return u''
+
+    if profile.background:
+        from users.backgrounds import background_variants
+
+        # Las pantallas más angostas usan las variantes reducidas.
+        variants = background_variants(profile)
+        context['background_url'] = variants[-1][1]
+        context['background_variants'] = list(reversed(variants[:-1]))
+    css = render_to_string(THEME_TEMPLATE, context)
+    return BLANK_LINES_RE.sub('\n', css).strip() + '\n'
+
+
+def theme_name(digest):
+    """
+    Retorna el nombre en el storage de la hoja de estilo *digest*.
+    """
+
+    return os.path.join(THEMES_DIR, '%s.css' % digest)
+
+
+def compile_theme(profile):
+    """
+    Compila el diseño de *profile* y lo guarda en el storage con el hash de
+    su contenido como nombre. Retorna el hash, o una cadena vacía si el
+    perfil no tiene diseño. Los perfiles con el mismo diseño comparten el
+    archivo.
+    """
+
+    css = render_theme(profile)
+    if not css:
+        return ''
+
+    css = css.encode('utf-8')
+    digest = hashlib.md5(css).hexdigest()[:16]
+    name = theme_name(digest)
+
+    if not default_storage.exists(name):
+        default_storage.save(name, ContentFile(css))
+
+    return digest
+
+
+def recompile_theme(profile_id, retries=THEMES_MAX_RETRIES):
+    """
+    Vuelve a leer el diseño del perfil *profile_id*, lo compila y guarda su
+    hash solo si el diseño no cambió mientras tanto; si cambió se repite con
+    los valores nuevos. Retorna el hash guardado o None si se agotaron los
+    intentos, en cuyo caso el hash lo guarda quien modificó el diseño.
+    """
+
+    from users.models import Profile
+
+    # La hoja de estilo depende de la versión y el ancho de la imagen.
+    fields = THEME_FIELDS + ('background_version', 'background_width')
+
+    for attempt in range(retries):
+        profile = Profile.objects.only('id', *fields).get(pk=profile_id)
+        theme_hash = compile_theme(profile)
+
+        current = {}
+        for field in fields:
+            value = getattr(profile, field)
+            if field == 'background':
+                value = value.name
+            if value is None:
+                current['%s__isnull' % field] = True
+            else:
+                current[field] = value
+
+        profiles = Profile.objects.filter(pk=profile_id, **current)
+        if profiles.update(theme_hash=theme_hash):
+            return theme_hash
+
+    return None
+
+
+def read_theme(digest):
+    """
+    Retorna el contenido de la hoja de estilo *digest* o None si no existe.
+    """
+
+    name = theme_name(digest)
+    if not default_storage.exists(name):
+        return None
+
+    theme = default_storage.open(name, 'rb')
+    try:
+        return theme.read()
+    finally:
+        theme.close()
@@ -61,6 +61,8 @@ urlpatterns += patterns('users.views',
     url(r'^cuenta$', UsersUpdate.as_view(), name='users_account'),
     url(r'^personal$', UsersUpdateProfile.as_view(), name='users_personal'),
     url(r'^diseno$', UsersUpdateDesign.as_view(), name='users_design'),
+    url(r'^disponible$', 'availability', name='users_availability'),
+    url(r'^temas/(?P<digest>[0-9a-f]{16})\.css$', 'theme', name='users_theme'),
     url(r'^profile$', 'profile', name='users_profile'),
     url(r'^(?P<username>[\w\-]+)', 'profile', name='users_profile')
 )
@@ -20,6 +20,49 @@ __version__ = '0.1'
 __copyright__ = 'Copyright 2012, Mandla Web Studio'
 
 
+from django.conf import settings
+from django.db import connections, router
+from django.db.models import AutoField
+
+
+#: Dominio de los perfiles de usuario (http://<username>.<dominio>). Por
+#: defecto el dominio del sitio actual.
+PROFILE_DOMAIN = getattr(settings, 'USERS_PROFILE_DOMAIN', None)
+
+
+def profile_domain(request=None):
+    """
+    Retorna el dominio bajo el cual cada usuario tiene su subdominio, el del
+    sitio de *request* si se indica.
+    """
+
+    if PROFILE_DOMAIN:
+        return PROFILE_DOMAIN
+
+    from users.sites import get_current_site
+    return get_current_site(request).domain
+
+
+def profile_url(username):
+    """
+    Retorna la url del perfil de *username* en su subdominio, así los enlaces
+    llevan directamente al perfil sin pasar por la redirección de la vista
+    *profile*.
+    """
+
+    return 'http://%s.%s' % (username, profile_domain())
+
+
+def normalize_email(email):
+    """
+    Retorna *email* en la forma con la que se compara la unicidad de los
+    emails (sin espacios y en minúsculas) o None si está vacío.
+    """
+
+    email = (email or '').strip().lower()
+    return email or None
+
+
 def get_dict_by_related(query, related):
     """
     Retorna un diccionario con los ids de los objetos de query como claves y 
@@ -60,3 +103,107 @@ def get_dict_by_ids(model, ids):
         objects_dict[key] = obj
 
     return objects_dict
+
+
+class LazyDict(object):
+    """
+    Diccionario de solo lectura que se construye con *loader* la primera vez
+    que se consulta, para los datos del contexto que un template puede no
+    usar.
+    """
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self._loader()
+        return self._data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getattr__(self, name):
+        # get, keys, items, values...
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.data, name)
+
+
+def bulk_insert(model, objects, using=None):
+    """
+    Inserta en la base de datos los objetos *objects* del modelo *model* con
+    una sola sentencia executemany. No envía señales ni asigna los ids a los
+    objetos.
+    """
+
+    if not objects:
+        return 0
+
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+
+    fields = [field for field in model._meta.local_fields
+                    if not isinstance(field, AutoField)]
+
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        qn(model._meta.db_table),
+        ', '.join([qn(field.column) for field in fields]),
+        ', '.join(['%s'] * len(fields)))
+
+    rows = []
+    for obj in objects:
+        rows.append([field.get_db_prep_save(field.pre_save(obj, True),
+                                            connection=connection)
+                     for field in fields])
+
+    cursor = connection.cursor()
+    cursor.executemany(sql, rows)
+
+    return len(rows)
+
+
+def save_fields(instance, fields, signal=None, using=None):
+    """
+    Guarda solo las columnas de los campos *fields* de *instance* con un
+    UPDATE en la base de datos *using*, más las de los campos con auto_now.
+    No envía post_save; si se indica *signal* se envía con la instancia y los
+    campos *fields*. Retorna el número de filas actualizadas.
+    """
+
+    if not fields:
+        return 0
+
+    model = instance.__class__
+    if model._deferred:
+        model = model._meta.proxy_for_model
+
+    fields = list(fields)
+    auto_now = [field.name for field in model._meta.fields
+                           if getattr(field, 'auto_now', False)]
+
+    values = {}
+    for name in fields + auto_now:
+        field = model._meta.get_field(name)
+        # pre_save asigna las fechas y guarda en el storage los archivos nuevos.
+        values[field.name] = field.pre_save(instance, False)
+
+    using = using or router.db_for_write(model, instance=instance)
+    updated = model._default_manager.using(using).filter(pk=instance.pk).update(**values)
+
+    if signal is not None:
+        signal.send(sender=model, instance=instance, fields=fields)
+
+    return updated
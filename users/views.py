@@ -23,8 +23,12 @@ __copyright__ = 'Copyright 2012, Mandla Web Studio'
 import logging
 import traceback
 
+from functools import partial
+
 from django import template
 from django.http import Http404
+from django.http import HttpResponse
+from django.http import HttpResponseNotModified
 from django.shortcuts import render_to_response
 from django.shortcuts import redirect
 from django.shortcuts import get_object_or_404
@@ -33,7 +37,7 @@ from django.core.urlresolvers import reverse
 from django.conf import settings
 from django.contrib import messages
 
-from django.contrib.auth import authenticate, login as auth_login
+from django.contrib.auth import login as auth_login
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.views import login as login_view
 from django.contrib.auth.views import logout as logout_view
@@ -45,12 +49,16 @@ from django.contrib.auth.views import password_reset_done as django_reset_done
 from django.contrib.auth.views import password_reset_confirm as django_reset_confirm
 from django.contrib.auth.views import password_reset_complete as django_reset_complete
 
-from django.contrib.sites.models import Site
 from django.utils.translation import ugettext_lazy as _
+from django.utils.datastructures import SortedDict
+from django.utils import simplejson as json
+from django.core.validators import validate_email
+from django.core.exceptions import ValidationError
 
 from django.views.generic.list import ListView
 
 from common.views import UpdateView
+from common.views import ModelFormMixin
 from common.views import LoginRequiredMixin
 from common.views import ListView
 from common.views import DetailView
@@ -61,12 +69,31 @@ from users.forms import RegisterForm
 from users.forms import UserForm
 from users.forms import ProfileForm
 from users.forms import DesignForm
+from users.forms import validate_username
 
-from users.utils import get_dict_by_ids
 from users.models import Profile
+from users.managers import Actor
+from users.cache import actors_cache, usernames_cache
+from users.avatars import avatar_url
+from users.pagination import CursorPaginationMixin
+from users.utils import profile_url, LazyDict
+from users.sites import get_current_site
+from users.availability import availability_index
+from users.search import search_index, SearchPage
+from users.conditional import ConditionalGetMixin
+from users.themes import THEMES_MAX_AGE, read_theme
+
+
+def login_new_user(request, user):
+    """
+    Identifica en el sitio al usuario que se acaba de registrar. La contraseña
+    se acaba de cifrar al crearlo, así que no se vuelve a verificar con
+    authenticate (el paso más costoso del registro), se le asigna
+    directamente el primer backend de settings.AUTHENTICATION_BACKENDS.
+    """
 
-
-current_site = Site.objects.get_current()
+    user.backend = settings.AUTHENTICATION_BACKENDS[0]
+    auth_login(request, user)
 
 
 def register(request, **kwargs):
@@ -82,11 +109,9 @@ def register(request, **kwargs):
         
         if form.is_valid():
             user = form.save()
-            messages.success(request, _("Bienvenido a %s" % current_site.name))
-
-            user = authenticate(username=form.cleaned_data['username'],
-                                password=form.cleaned_data['password1'])
-            auth_login(request, user)
+            site = get_current_site(request)
+            messages.success(request, _("Bienvenido a %s" % site.name))
+            login_new_user(request, user)
 
             return redirect(reverse('home'))
     
@@ -98,6 +123,48 @@ def register(request, **kwargs):
     return render_to_response('page.users.register.html', c)
 
 
+def availability(request):
+    """
+    Retorna en formato json si el nombre de usuario (?username=) o el email
+    (?email=) son válidos y están disponibles, para verificarlos mientras el
+    usuario llena el formulario de registro::
+
+        {"field": "username", "value": "pepe", "valid": true,
+         "available": false, "errors": []}
+
+    La mayoría de las respuestas se obtienen del filtro de Bloom en memoria
+    sin consultar la base de datos.
+    """
+
+    if 'username' in request.GET:
+        field, validator = 'username', validate_username
+        check = availability_index.username_available
+    elif 'email' in request.GET:
+        field, validator = 'email', validate_email
+        check = availability_index.email_available
+    else:
+        raise Http404(u'Se necesita un nombre de usuario o un email')
+
+    value = request.GET[field].strip()
+    result = {
+        'field': field,
+        'value': value,
+        'valid': True,
+        'available': False,
+        'errors': [],
+    }
+
+    try:
+        validator(value)
+    except ValidationError, e:
+        result['valid'] = False
+        result['errors'] = [unicode(message) for message in e.messages]
+    else:
+        result['available'] = check(value)
+
+    return HttpResponse(json.dumps(result), 'application/json')
+
+
 # password reset
 def password_reset(request):
     kwargs = {
@@ -137,33 +204,99 @@ class AttachActors(object):
     Añade la lista de actores que intervienen en la vista al contexto
     """
 
+    #: Tamaño de los avatares que se añaden al contexto.
+    avatar_size = 's'
+
     def get_actors_ids(self, context):
         """
         Retorna los ids de todos los actores que intervienen en esta vista.
         """
 
         raise NotImplementedError
-        
+
+    def get_actors(self, context, users_ids):
+        """
+        Retorna un diccionario con los actores de *users_ids* indexados por su
+        id. Por defecto se obtienen del cache de actores.
+        """
+
+        return actors_cache.get_many(users_ids, Profile.objects.actors_for,
+                                     request=self.request)
+
+    def load_users(self, users_dict, users_ids):
+        """
+        Agrega a *users_dict* los usuarios de *users_ids* y lo retorna.
+        """
+
+        for user in User.objects.filter(pk__in=users_ids):
+            users_dict[str(user.pk)] = user
+
+        return users_dict
+
+    def load_avatars(self, actors):
+        """
+        Retorna un diccionario con las urls de los avatares de *actors*.
+        """
+
+        avatars_dict = {}
+        for actor_id, actor in actors.items():
+            avatars_dict[str(actor_id)] = avatar_url(actor.profile, self.avatar_size)
+
+        return avatars_dict
+
     def get_context_data(self, **kwargs):
         """
-        Retorna el contexto con el diccionario de usuarios y perfiles.
+        Retorna el contexto con los actores y los diccionarios de usuarios y
+        perfiles.
         """
         context = super(AttachActors, self).get_context_data(**kwargs)
         
-        # Añadimos al contexto los perfiles de los actores en un diccionario.
-        users_ids = self.get_actors_ids(context)
-        context['users_dict'] = get_dict_by_ids(User, users_ids)
-        context['profiles_dict'] = Profile.objects.profiles_dict(users_ids)
+        # Añadimos al contexto los actores en el orden de sus ids.
+        users_ids = [int(user_id) for user_id in self.get_actors_ids(context)]
+        cached = self.get_actors(context, users_ids)
+
+        actors = SortedDict()
+        for user_id in users_ids:
+            if user_id in cached:
+                actors[user_id] = cached[user_id]
+
+        # Diccionarios con claves de texto para los templates existentes.
+        users_dict = {}
+        profiles_dict = {}
+        for actor_id, actor in actors.items():
+            key = str(actor_id)
+            if actor.user is not None:
+                users_dict[key] = actor.user
+            if actor.profile is not None:
+                profiles_dict[key] = actor.profile
+
+        # Los usuarios de los actores creados solo con el perfil se cargan
+        # si el template los usa.
+        missing = [actor_id for actor_id, actor in actors.items()
+                            if actor.user is None]
+        if missing:
+            users_dict = LazyDict(partial(self.load_users, users_dict, missing))
+
+        # Las urls de los avatares solo se calculan si el template las usa,
+        # el listado las obtiene de las tarjetas.
+        context['actors'] = actors
+        context['users_dict'] = users_dict
+        context['profiles_dict'] = profiles_dict
+        context['avatars_dict'] = LazyDict(partial(self.load_avatars, actors))
          
         return context
 
 
-class UsersIndex(AttachActors, ListView):
+class UsersIndex(ConditionalGetMixin, AttachActors, CursorPaginationMixin, ListView):
     """
-    Muestra los usuarios registrados en el sistema.
+    Muestra los usuarios registrados en el sistema. El listado trabaja solo
+    con la tabla de perfiles, que tiene una copia de los datos del usuario
+    que se muestran. Con ?q= muestra los resultados de la búsqueda ordenados
+    por relevancia.
     """
 
-    model = User
+    model = Profile
+    queryset = Profile.objects.listing()
     view_name = 'users-index'
     app_name = 'users'
     
@@ -171,13 +304,92 @@ class UsersIndex(AttachActors, ListView):
         'html': 'page.users.index.html'
     }
 
+    # Paginación por cursor: 'recent' sigue el orden de registro (el perfil
+    # se crea junto con el usuario) y 'active' el de la última publicación.
+    cursor_pagination = getattr(settings, 'USERS_CURSOR_PAGINATION', False)
+    cursor_orderings = {
+        'recent': ('id', ),
+        'active': ('last_published', 'id'),
+    }
+
+    #: Resultados por página de las búsquedas (?q=).
+    search_per_page = 50
+
+    def get_search_query(self):
+        if not search_index.enabled:
+            return ''
+
+        return self.request.GET.get('q', '').strip()
+
+    def get_queryset(self):
+        query = self.get_search_query()
+        if not query:
+            return super(UsersIndex, self).get_queryset()
+
+        try:
+            number = int(self.request.GET.get('page', 1))
+        except ValueError:
+            raise Http404(u'Página inválida')
+        if number < 1:
+            raise Http404(u'Página inválida')
+
+        ids, has_next = search_index.search(query, self.search_per_page,
+                                            (number - 1) * self.search_per_page)
+        self.search_page = SearchPage(query, number, has_next)
+
+        # Los perfiles en el orden de relevancia.
+        profiles = Profile.objects.listing().in_bulk(ids)
+        return [profiles[profile_id] for profile_id in ids if profile_id in profiles]
+
+    def get_paginate_by(self, queryset):
+        if self.get_search_query():
+            return None
+
+        return super(UsersIndex, self).get_paginate_by(queryset)
+
+    def get_context_data(self, **kwargs):
+        context = super(UsersIndex, self).get_context_data(**kwargs)
+        context['search_page'] = getattr(self, 'search_page', None)
+        context['search_enabled'] = search_index.enabled
+        return context
+
     def get_actors_ids(self, context):
         """
         Retorna los ids de los usuario de la vista.
         """
         
-        return [user.id for user in context['object_list']]
-        
+        return [profile.user_id for profile in context['object_list']]
+
+    def get_validators(self, context):
+        """
+        La página depende de los perfiles listados, sus versiones y el estado
+        de la paginación. No se usa Last-Modified porque eliminar un perfil
+        cambia la página sin cambiar las fechas.
+        """
+
+        values = [self.request.get_full_path()]
+        values.extend('%s:%s' % (profile.pk, profile.updated_at)
+                      for profile in context['object_list'])
+
+        paginator = context.get('paginator')
+        if paginator is not None:
+            values.append(paginator.count)
+
+        for name in ('cursor_page', 'search_page'):
+            page = context.get(name)
+            if page is not None:
+                values.append('%s:%s:%s' % (name, page.has_previous, page.has_next))
+
+        return values, None
+
+    def get_actors(self, context, users_ids):
+        """
+        Los perfiles del listado ya tienen todo lo necesario.
+        """
+
+        return dict((profile.user_id, Actor(profile=profile))
+                    for profile in context['object_list'])
+
 
 class UsersUpdate(OwnerRequiredMixin, UpdateView):
     """
@@ -200,14 +412,15 @@ class UsersUpdate(OwnerRequiredMixin, UpdateView):
         return user.id == current_user.id
 
     def form_valid(self, form):
-        user = form.save()
+        self.object = form.save()
         
         self.success_message = _(u'Tu cuenta fue actualizada.')
         
-        return super(UsersUpdate, self).form_valid(form)
+        # ModelFormMixin.form_valid volvería a guardar el formulario.
+        return super(ModelFormMixin, self).form_valid(form)
     
     def get_success_redirect_url(self):
-        return reverse('users_profile', args=[self.request.user.username])
+        return profile_url(self.request.user.username)
 
 
 class UsersUpdateProfile(OwnerRequiredMixin, UpdateView):
@@ -224,17 +437,22 @@ class UsersUpdateProfile(OwnerRequiredMixin, UpdateView):
         'html': 'page.users.settings.html'
     }
     
+    #: Mensaje que se muestra al guardar el formulario.
+    updated_message = _(u'Tus datos fueron actualizados.')
+
     def get_object(self):
         profile = self.request.user.get_profile()
         return profile
     
     def form_valid(self, form):
-        profile = form.save()
-        self.success_message = _(u'Tus datos fueron actualizados.')
-        return super(UsersUpdateProfile, self).form_valid(form)
+        self.object = form.save()
+        self.success_message = self.updated_message
+
+        # ModelFormMixin.form_valid volvería a guardar el formulario.
+        return super(ModelFormMixin, self).form_valid(form)
     
     def get_success_redirect_url(self):
-        return reverse('users_profile', args=[self.request.user.username])
+        return profile_url(self.request.user.username)
 
 
 class UsersUpdateDesign(UsersUpdateProfile):
@@ -244,32 +462,62 @@ class UsersUpdateDesign(UsersUpdateProfile):
     form_class = DesignForm
 
     view_name = 'users-design'
-    
-    def form_valid(self, form):
-        """
-        Procesa el formulario.
-        """
-        profile = form.save()
-        self.success_message = _(u'El diseño fue actualizado correctamente')
-        return super(UsersUpdateDesign, self).form_valid(form)
+
+    updated_message = _(u'El diseño fue actualizado correctamente')
+
+
+def load_user_id(username):
+    """
+    Retorna el id del usuario *username* o None si no existe.
+    """
+
+    ids = User.objects.filter(username=username).values_list('id', flat=True)
+    ids = list(ids[:1])
+    return ids[0] if ids else None
+
+
+def get_actor_or_404(request, username):
+    """
+    Retorna el actor (usuario y perfil) de *username* usando los caches de
+    nombres de usuario y de actores. Lanza Http404 si el usuario no existe.
+    """
+
+    for attempt in range(2):
+        user_id = usernames_cache.resolve(username, load_user_id)
+        if user_id is None:
+            break
+
+        actors = actors_cache.get_many([user_id], Profile.objects.actors_for,
+                                       request=request)
+        actor = actors.get(user_id)
+        if actor is not None and actor.user is not None and \
+           actor.user.username.lower() == username.lower():
+            return actor
+
+        # El usuario fue renombrado o eliminado, volvemos a resolverlo.
+        usernames_cache.invalidate([username])
+
+    logging.debug('usernames cache: %s' % usernames_cache.stats())
+    raise Http404(u'No existe el usuario %s' % username)
 
 
 def profile(request, username=None):
     """
     Redirecciona la página de usuario con el subdominio: http://<username>.<domain>
+
+    Los enlaces deben usar directamente *users.utils.profile_url*, esta vista
+    se mantiene para las urls antiguas.
     """
     
     if username is None:
         user = request.user
     else:
-        user = get_object_or_404(User, username=username)
-    
-    user_url = 'http://%s.%s' % (user.username, current_site.domain)
+        user = get_actor_or_404(request, username).user
     
-    return redirect(user_url)
+    return redirect(profile_url(user.username))
 
 
-class UsersProfile(DetailView):
+class UsersProfile(ConditionalGetMixin, DetailView):
     """
     Muestra el perfil del usuario.
     """
@@ -284,12 +532,51 @@ class UsersProfile(DetailView):
     }
 
     def get_object(self):
-        username = self.kwargs.get('username', self.request.user.username)
-        return get_object_or_404(User, username=username)
+        # En los subdominios el nombre lo resuelve SubdomainProfileMiddleware.
+        username = self.kwargs.get('username') or \
+                   getattr(self.request, 'profile_username', None) or \
+                   self.request.user.username
+        self.actor = get_actor_or_404(self.request, username)
+        return self.actor.user
 
     def get_context_data(self, **kwargs):
         context = super(UsersProfile, self).get_context_data(**kwargs)
-        context['user_profile'] = context['object'].get_profile()
+        context['user_profile'] = self.actor.profile or context['object'].get_profile()
         return context
 
+    def get_validators(self, context):
+        """
+        La página depende de los datos del usuario (sin contar su último
+        acceso), de la versión del perfil y de su última publicación.
+        """
+
+        user = context['object']
+        profile = context['user_profile']
+
+        values = [user.pk, user.username, user.first_name, user.last_name,
+                  user.is_active, profile.pk, profile.updated_at,
+                  profile.last_published]
+
+        dates = [date for date in (profile.updated_at, profile.last_published) if date]
+        return values, max(dates) if dates else None
+
+
+def theme(request, digest):
+    """
+    Retorna la hoja de estilo compilada *digest* con el diseño de un perfil.
+    Su contenido nunca cambia, se guarda en los navegadores sin volver a
+    validarse.
+    """
+
+    if digest in request.META.get('HTTP_IF_NONE_MATCH', ''):
+        response = HttpResponseNotModified()
+    else:
+        css = read_theme(digest)
+        if css is None:
+            raise Http404(u'No existe la hoja de estilo %s' % digest)
+
+        response = HttpResponse(css, mimetype='text/css')
 
+    response['ETag'] = '"%s"' % digest
+    response['Cache-Control'] = 'public, max-age=%d, immutable' % THEMES_MAX_AGE
+    return response